@@ -1,8 +1,119 @@
-import collections
+import sys
+import time
+import socket
 import threading
 from Databases.database import Database
+from Databases.query import record_from_row, parse_path
 from clickhouse_driver import Client
-from queue import Queue
+from bgpqueue import BGPQueue
+from bgpmetrics import metrics
+
+SCHEMAS = ["legacy", "optimized"]
+# legacy: bgp table with String columns
+# optimized: bgp_v2 table with LowCardinality, IP and Array columns
+
+COLUMNS = [
+    "time",
+    "type",
+    "peer",
+    "collector",
+    "project",
+    "country",
+    "source",
+    "prefix",
+    "path",
+]
+# Columns of bgp table, in insert order
+
+OPTIMIZED_COLUMNS = [
+    "time",
+    "type",
+    "peer",
+    "collector",
+    "project",
+    "country",
+    "origin",
+    "ip_version",
+    "prefix_v4",
+    "prefix_v6",
+    "prefix_len",
+    "path",
+]
+# Columns of bgp_v2 table, in insert order
+
+CREATE_OPTIMIZED = (
+    "CREATE TABLE IF NOT EXISTS bgp_v2 ("
+    "time DateTime64(3),"
+    "type LowCardinality(String),"
+    "peer UInt32,"
+    "collector LowCardinality(String),"
+    "project LowCardinality(String),"
+    "country LowCardinality(String),"
+    "origin UInt32,"
+    "ip_version UInt8,"
+    "prefix_v4 IPv4,"
+    "prefix_v6 IPv6,"
+    "prefix_len UInt8,"
+    "path Array(UInt32),"
+    "INDEX origin_idx origin TYPE bloom_filter GRANULARITY 4,"
+    "INDEX prefix_v4_idx prefix_v4 TYPE minmax GRANULARITY 4,"
+    "INDEX prefix_v6_idx prefix_v6 TYPE minmax GRANULARITY 4"
+    ") ENGINE = MergeTree PARTITION BY toYYYYMMDD(time)"
+    " ORDER BY (toStartOfHour(time), origin, prefix_v4, prefix_v6, prefix_len, time)"
+    " SETTINGS old_parts_lifetime=10"
+)
+
+MIGRATE_QUERY = (
+    f"INSERT INTO bgp_v2 ({', '.join(OPTIMIZED_COLUMNS)}) SELECT "
+    "toDateTime64(time, 3), type, toUInt32(peer), collector, project, country,"
+    " toUInt32OrZero(source),"
+    " if(position(prefix, ':') = 0, 4, 6),"
+    " if(position(prefix, ':') = 0,"
+    " toIPv4OrDefault(splitByChar('/', prefix)[1]), toIPv4('0.0.0.0')),"
+    " if(position(prefix, ':') = 0, toIPv6('::'),"
+    " toIPv6OrDefault(splitByChar('/', prefix)[1])),"
+    " toUInt8OrZero(splitByChar('/', prefix)[2]),"
+    " arrayMap(x -> toUInt32(x), extractAll(path, '[0-9]+'))"
+    " FROM bgp"
+)
+# Copy rows of legacy bgp table into bgp_v2.
+# Paths are converted like `Databases.query.parse_path()`: AS sets members
+# are kept, their origin is 0.
+# if() may evaluate both branches on a whole block, conversions of the other
+# ip version must not throw: *OrDefault variants give 0.0.0.0 and ::
+
+SELECTS = {
+    "legacy": (
+        "toFloat64(time), type, peer, collector, project, country, source,"
+        " prefix, path"
+    ),
+    "optimized": (
+        "toFloat64(time), type, peer, collector, project, country,"
+        " if(origin = 0, '', toString(origin)),"
+        " concat(if(ip_version = 4, toString(prefix_v4), toString(prefix_v6)),"
+        " '/', toString(prefix_len)),"
+        " arrayStringConcat(arrayMap(x -> toString(x), path), ' ')"
+    ),
+}
+# Select expressions returning the same columns for both schemas
+
+IPV6_ZERO = bytes(16)
+
+
+def split_prefix(prefix):
+    """Split a CIDR prefix for bgp_v2 columns
+
+    Args:
+        prefix (str): Example: 130.0.192.0/21
+
+    Returns:
+        Tuple[int, int, bytes, int]: ip version, IPv4 as integer,
+            packed IPv6, prefix length
+    """
+    address, length = prefix.split("/", 1)
+    if ":" in address:
+        return 6, 0, socket.inet_pton(socket.AF_INET6, address), int(length)
+    return 4, int.from_bytes(socket.inet_aton(address), "big"), IPV6_ZERO, int(length)
 
 
 class ClickHouseDB(Database):
@@ -12,47 +123,116 @@ class ClickHouseDB(Database):
         """
         Args:
             config (dict): Format :
-                            {"host":"127.0.0.1", "port":9000, "batch_size":15000}
+                            {"host":"127.0.0.1", "port":9000, "batch_size":15000,
+                             "max_age":1, "queue_size":1000000,
+                             "queue_policy":"block", "threads":1,
+                             "stop_timeout":30}
         """
         super().__init__()
         self.started = False
         self.BATCH_SIZE = int(config["batch_size"]) if "batch_size" in config else 15000
-        self.queue = Queue()
-        self.client = Client(
-            host=config["host"], port=int(config["port"]), compression="lz4"
-        )
-        self.client.execute(
-            "CREATE TABLE IF NOT EXISTS bgp ("
-            "time DateTime,"
-            "type FixedString(1),"
-            "peer Int32,"
-            "collector String,"
-            "project String,"
-            "country String,"
-            "source String,"
-            "prefix String,"
-            "path String"
-            ") ENGINE = MergeTree ORDER BY (time, prefix, path)"
-            "SETTINGS old_parts_lifetime=10"
+        self.MAX_AGE = float(config.get("max_age", 1))
+        """Max age in seconds of a batch before insert"""
+        self.THREADS = int(config.get("threads", 1))
+        """Number of parallel insert threads"""
+        self.STOP_TIMEOUT = float(config.get("stop_timeout", 30))
+        """Max time in seconds to insert waiting rows when stopping"""
+        self.queue = BGPQueue(
+            int(config.get("queue_size", 1000000)),
+            config.get("queue_policy", "block"),
         )
-        print("Clickhouse : Generated BGP table :D")
+        self.conf = {"host": config["host"], "port": int(config["port"])}
+        self.threads = []
+        self.received = 0
+        """Number of rows given to `ClickHouseDB.save_many()`"""
+        self.inserted = 0
+        """Number of inserted rows"""
+        self.failed = 0
+        """Number of rows lost by failed inserts"""
+        self.__written = threading.Condition()
+        self.__synced_losses = 0
+        self.schema = config.get("schema", "legacy")
+        """`legacy` or `optimized`, see `SCHEMAS`"""
+        if self.schema not in SCHEMAS:
+            raise ValueError(f"Invalid clickhouse schema. Valid schemas : {SCHEMAS}")
+        self.client = self.__client()
+        if self.schema == "optimized":
+            self.table = "bgp_v2"
+            self.columns = OPTIMIZED_COLUMNS
+            self.client.execute(CREATE_OPTIMIZED)
+            if str(config.get("migrate", "false")).lower() in ["true", "yes", "1"]:
+                self.migrate()
+        else:
+            self.table = "bgp"
+            self.columns = COLUMNS
+            self.client.execute(
+                "CREATE TABLE IF NOT EXISTS bgp ("
+                "time DateTime,"
+                "type FixedString(1),"
+                "peer Int32,"
+                "collector String,"
+                "project String,"
+                "country String,"
+                "source String,"
+                "prefix String,"
+                "path String"
+                ") ENGINE = MergeTree ORDER BY (time, prefix, path)"
+                "SETTINGS old_parts_lifetime=10"
+            )
+        print(f"Clickhouse : Generated {self.table} table :D")
+
+    def migrate(self):
+        """Copy rows from legacy bgp table to bgp_v2 table.
+        Skipped if bgp table doesn't exist or if bgp_v2 already contains rows."""
+        if not self.client.execute("EXISTS TABLE bgp")[0][0]:
+            return
+        if self.client.execute("SELECT count() FROM bgp_v2")[0][0] > 0:
+            print("Clickhouse : bgp_v2 isn't empty, migration skipped")
+            return
+        print("Clickhouse : Migrating bgp table to bgp_v2")
+        self.client.execute(MIGRATE_QUERY)
+
+    def __client(self):
+        return Client(host=self.conf["host"], port=self.conf["port"], compression="lz4")
 
     def start(self):
         """
         Create bgp table
         (time DateTime, type, peer, collector, country, source, prefix, path)
-        Start thread for batch inserts
+        Start threads for batch inserts, each one with its own connection
         """
         # self.client.execute("DROP TABLE IF EXISTS bgp")
         self.started = True
-        threading.Thread(
-            target=self.insert_batches, daemon=True, name="BGP monitor - clickhouse"
-        ).start()
+        self.threads = [
+            threading.Thread(
+                target=self.insert_batches,
+                args=(self.__client(),),
+                daemon=True,
+                name=f"BGP monitor - clickhouse {i}",
+            )
+            for i in range(self.THREADS)
+        ]
+        for t in self.threads:
+            t.start()
 
     def stop(self):
-        """Stop inserts"""
+        """Stop inserts, wait up to STOP_TIMEOUT seconds for waiting rows"""
         if self.started:
             self.started = False
+            self.queue.close()
+            deadline = time.monotonic() + self.STOP_TIMEOUT
+            for t in self.threads:
+                t.join(max(0, deadline - time.monotonic()))
+            if any(t.is_alive() for t in self.threads):
+                print(
+                    f"Clickhouse : stop timeout, {self.queue.qsize()} rows waiting",
+                    file=sys.stderr,
+                )
+            print(
+                f"Clickhouse : {self.inserted} rows inserted, {self.failed} failed,"
+                f" queue {self.queue.stats()}",
+                file=sys.stderr,
+            )
 
     ###############
     #   INSERTS   #
@@ -64,75 +244,228 @@ class ClickHouseDB(Database):
         Args:
             data (BGPElem): bgp element to save
         """
-        self.queue.put(data)
+        self.save_many([data])
 
-    def get_data(self):
-        """Retrieve data for inserts
-        Yields:
-            dict: Data to insert
+    def save_many(self, records):
+        """Input a batch of records in queue for processing
+
+        Args:
+            records (List[BGPElem]): bgp elements to save
         """
-        for idx in range(self.BATCH_SIZE):
-            rec = self.queue.get()
-            yield {
-                "time": int(rec["time"]),
-                "type": rec["type"],
-                "peer": rec["peer_asn"],
-                "collector": rec["collector"],
-                "country": rec["country_code"] or "",
-                "source": rec["source"] or "",
-                "prefix": rec["prefix"],
-                "path": rec.get("as-path", ""),
-                "project": rec["project"],
-            }
-            if self.queue.qsize() == 0 and not self.started:
-                print("Clickhouse : Inserting last batch")
-                return
+        self.queue.put_many(records)
+        with self.__written:
+            self.received += len(records)
+
+    def sync(self) -> bool:
+        """Wait up to STOP_TIMEOUT seconds until rows saved before are inserted,
+        see `Database.sync()`
+
+        Returns:
+            bool: False if rows are still waiting, or were lost since the previous
+                call by a failed insert or dropped from the queue (`drop-oldest`)
+        """
+        with self.__written:
+            received = self.received
+            done = self.__written.wait_for(
+                lambda: not self.started
+                or self.inserted + self.failed + self.queue.dropped >= received,
+                self.STOP_TIMEOUT,
+            )
+            done = done and self.inserted + self.failed + self.queue.dropped >= received
+            losses = self.failed + self.queue.dropped
+            lost = losses - self.__synced_losses
+            self.__synced_losses = losses
+        return done and not lost
+
+    @staticmethod
+    def _columns(records):
+        """Convert records to bgp table columns, see `COLUMNS`"""
+        return [
+            [int(r["time"]) for r in records],
+            [r["type"] for r in records],
+            [r["peer_asn"] for r in records],
+            [r["collector"] for r in records],
+            [r["project"] for r in records],
+            [r["country_code"] or "" for r in records],
+            [r["source"] or "" for r in records],
+            [r["prefix"] for r in records],
+            [r.get("as-path", "") for r in records],
+        ]
 
-    def insert_batches(self):
+    def insert_batches(self, client):
         """
-        Insert BATCH_SIZE(15000 lines) batches
-        https://clickhouse.com/docs/en/about-us/performance/"""
-        while self.started:
-            self.client.execute("INSERT INTO bgp VALUES ", self.get_data())
+        Insert batches of BATCH_SIZE(15000 lines) rows,
+        or less if the oldest row is waiting for more than MAX_AGE seconds.
+        Returns when the queue is closed and empty.
+        https://clickhouse.com/docs/en/about-us/performance/
+
+        Args:
+            client (Client): Connection used by this thread
+        """
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0, deadline - time.monotonic())
+            rows = self.queue.get_batch(self.BATCH_SIZE - len(batch), timeout)
+            if rows:
+                if not batch:
+                    deadline = time.monotonic() + self.MAX_AGE
+                batch.extend(rows)
+            closed = not rows and self.queue.closed
+            if batch and (
+                closed or len(batch) >= self.BATCH_SIZE or time.monotonic() >= deadline
+            ):
+                self.__insert(client, batch)
+                batch = []
+            elif closed:
+                return
+
+    @staticmethod
+    def _optimized_columns(records):
+        """Convert records to bgp_v2 table columns, see `OPTIMIZED_COLUMNS`"""
+        prefixes = [split_prefix(r["prefix"]) for r in records]
+        return [
+            [int(r["time"] * 1000) for r in records],
+            [r["type"] for r in records],
+            [r["peer_asn"] for r in records],
+            [r["collector"] for r in records],
+            [r["project"] for r in records],
+            [r["country_code"] or "" for r in records],
+            [int(r["source"]) if (r["source"] or "").isdigit() else 0 for r in records],
+            [p[0] for p in prefixes],
+            [p[1] for p in prefixes],
+            [p[2] for p in prefixes],
+            [p[3] for p in prefixes],
+            [parse_path(r.get("as-path", "")) for r in records],
+        ]
+
+    def __insert(self, client, records):
+        to_columns = (
+            self._optimized_columns if self.schema == "optimized" else self._columns
+        )
+        try:
+            start = time.perf_counter()
+            client.execute(
+                f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES",
+                to_columns(records),
+                columnar=True,
+            )
+            metrics.histogram("database_write_seconds", database=self.name).observe(
+                time.perf_counter() - start
+            )
+            with self.__written:
+                self.inserted += len(records)
+                self.__written.notify_all()
+        except Exception as e:
+            with self.__written:
+                self.failed += len(records)
+                self.__written.notify_all()
+            print(
+                f"Clickhouse : insert of {len(records)} rows failed ({e})",
+                file=sys.stderr,
+            )
 
     ##############
     #   GETTER   #
     ##############
 
     var_names = {
-        "time_start": "time_start",
-        "time_end": "time_end",
+        "time": "time",
         "record_type": "type",
         "peer_asn": "peer",
         "collectors": "collector",
         "countries": "country",
         "as_numbers": "source",
-        "prefixes": "prefix",
         "as_paths": "path",
     }
-    # Used in `ClickHouseDB.get` function as arg_name:db_column_name
-
-    def get(
-        self,
-        time_start,
-        time_end,
-        record_type=None,
-        peer_asn=None,
-        collectors=None,
-        countries=None,
-        as_numbers=None,
-        prefixes=None,
-        as_paths=None,
-    ):
-        query = "SELECT * FROM bgp WHERE"
-        params = {key: value for key, value in locals() if value is not None}
-
-        if len(params) > 0:
-            for k, v in params:
-                query += (
-                    f" %({ClickHouseDB.var_names[k]}) "
-                    + ("IN " if isinstance(v, collections.Sequence) else "== ")
-                    + f"%({k}) and"
-                )
-            query += query.rsplit(" ", 1)[0]
-        return self.client.execute_iter(query, params)
+    # Used in `ClickHouseDB.query` function as filter_name:db_column_name
+
+    def _convert(self, name, value):
+        """Convert a filter value for the current schema"""
+        if self.schema == "optimized":
+            if name == "as_numbers":
+                return int(value)
+            if name == "as_paths":
+                return parse_path(value)
+        return value
+
+    def _prefix_condition(self, prefix, match, name, params):
+        """Build a condition on prefix column(s)
+
+        Args:
+            prefix (str): CIDR format
+            match (str): exact, more, less or any
+            name (str): Name of the query parameter
+            params (dict): Query parameters, updated
+
+        Returns:
+            str: Condition
+        """
+        version, v4, v6, length = split_prefix(prefix)
+        params[name] = prefix.split("/", 1)[0]
+        params[f"{name}_len"] = length
+        if self.schema == "optimized":
+            col = "prefix_v4" if version == 4 else "prefix_v6"
+            ip = f"to{'IPv4' if version == 4 else 'IPv6'}(%({name})s)"
+            cidr_range = f"IPv{version}CIDRToRange({col}, prefix_len)"
+            conditions = {
+                "exact": f"{col} = {ip} AND prefix_len = %({name}_len)s",
+                "more": (
+                    f"{col} BETWEEN tupleElement(IPv{version}CIDRToRange({ip},"
+                    f" %({name}_len)s), 1) AND tupleElement(IPv{version}CIDRToRange("
+                    f"{ip}, %({name}_len)s), 2) AND prefix_len >= %({name}_len)s"
+                ),
+                "less": (
+                    f"{ip} BETWEEN tupleElement({cidr_range}, 1)"
+                    f" AND tupleElement({cidr_range}, 2)"
+                    f" AND prefix_len <= %({name}_len)s"
+                ),
+            }
+            version_condition = f"ip_version = {version} AND "
+        else:
+            address_col = "splitByChar('/', prefix)[1]"
+            length_col = "toUInt8OrZero(splitByChar('/', prefix)[2])"
+            conditions = {
+                "exact": f"prefix = %({name}_prefix)s",
+                "more": (
+                    f"isIPAddressInRange({address_col}, %({name}_prefix)s)"
+                    f" AND {length_col} >= %({name}_len)s"
+                ),
+                "less": (
+                    f"isIPAddressInRange(%({name})s, prefix)"
+                    f" AND {length_col} <= %({name}_len)s"
+                ),
+            }
+            params[f"{name}_prefix"] = prefix
+            version_condition = (
+                f"position(prefix, ':') {'=' if version == 4 else '>'} 0 AND "
+            )
+        if match == "any":
+            condition = f"(({conditions['more']}) OR ({conditions['less']}))"
+        else:
+            condition = f"({conditions[match]})"
+        return f"({version_condition}{condition})"
+
+    def query(self, query, chunk_size=10000):
+        """
+        Retrieve records ordered by time, streamed by blocks of chunk_size rows.
+        With optimized schema, prefix and AS number filters use table indexes.
+
+        See `Database.get()`
+        """
+        columns = dict(ClickHouseDB.var_names)
+        if self.schema == "optimized":
+            columns["as_numbers"] = "origin"
+        where, params, _ = query.compile(
+            columns,
+            convert=self._convert,
+            prefix_condition=self._prefix_condition,
+        )
+        rows = self.client.execute_iter(
+            f"SELECT {SELECTS[self.schema]} FROM {self.table}"
+            f" WHERE {where} ORDER BY time",
+            params,
+            settings={"max_block_size": chunk_size},
+        )
+        for row in rows:
+            yield record_from_row(row)
@@ -1,11 +1,60 @@
 from Databases.database import Database
+from Databases.query import record_from_row
 import redis
 
+ROUTE_SCRIPT = """
+local old = redis.call("HGET", KEYS[1], ARGV[2]) or ""
+if old ~= ARGV[3] then
+    return redis.error_reply("route of " .. ARGV[2] .. " changed by another writer")
+end
+if old == ARGV[4] then
+    return 0
+end
+local function ref(field, set, member, index, delta)
+    local count = redis.call("HINCRBY", KEYS[2], field, delta)
+    if delta > 0 and count == 1 then
+        redis.call("SADD", set, member)
+        if index then redis.call("SADD", index, ARGV[1]) end
+    elseif count <= 0 then
+        redis.call("HDEL", KEYS[2], field)
+        redis.call("SREM", set, member)
+        if index then redis.call("SREM", index, ARGV[1]) end
+    end
+end
+if ARGV[4] ~= "" then
+    local source, country, path = string.match(ARGV[4], "^([^|]*)|([^|]*)|(.*)$")
+    redis.call("HSET", KEYS[1], ARGV[2], ARGV[4])
+    ref("as:" .. source, KEYS[3], source, KEYS[6], 1)
+    ref("country:" .. country, KEYS[4], country, KEYS[7], 1)
+    ref("path:" .. path, KEYS[5], path, nil, 1)
+else
+    redis.call("HDEL", KEYS[1], ARGV[2])
+end
+if old ~= "" then
+    local source, country, path = string.match(old, "^([^|]*)|([^|]*)|(.*)$")
+    ref("as:" .. source, KEYS[3], source, KEYS[8], -1)
+    ref("country:" .. country, KEYS[4], country, KEYS[9], -1)
+    ref("path:" .. path, KEYS[5], path, nil, -1)
+end
+return 1
+"""
+# Replace or remove the route of a peer for a prefix in live state.
+# Members of live sets are reference counted by routes, a prefix leaves
+# a set when the last peer routing it withdraws it.
+# KEYS: routes-{cidr}, refs-{cidr}, as-{cidr}, countries-{cidr}, paths-{cidr},
+#       prefixes-{new source}, prefixes-{new country},
+#       prefixes-{old source}, prefixes-{old country}
+# ARGV: cidr, peer, expected old route, new route ("" for a withdrawal)
+# Routes are "source|country|path"
+
 
 class KvrocksDB(Database):
     """
     This database store data as live
-    --> When a withdraw is received, concerned prefixes are removed
+    --> When the last peer routing a prefix withdraws it, the prefix is removed
+
+    A single monitor must write a database: the current route of each peer,
+    read before a batch, must not change until the batch is written.
     """
 
     name = "kvrocks"
@@ -15,6 +64,7 @@ class KvrocksDB(Database):
         self.client = redis.Redis(
             host=config["host"], port=config["port"], db=config["db"]
         )
+        self.__route = self.client.register_script(ROUTE_SCRIPT)
 
     def start(self):
         print(f"Database size : {self.client.dbsize()}")
@@ -27,89 +77,191 @@ class KvrocksDB(Database):
     ###############
 
     def save(self, record):
+        """Store a single record, see `KvrocksDB.save_many()`
+
+        Args:
+            record (`BGPElem`): BGP Element to save
+        """
+        self.save_many([record])
+
+    def save_many(self, records):
+        """Store a batch of records, commands are pipelined
+        so a batch costs two round-trips: current routes of its peers,
+        then the updates
+
+        Args:
+            records (List[`BGPElem`]): BGP Elements to save
+        """
+        routes = self.__current_routes(records)
+        pipe = self.client.pipeline(transaction=False)
+        for record in records:
+            self._save(pipe, record, routes)
+        pipe.execute()
+
+    @staticmethod
+    def _peer(record) -> str:
+        return (
+            f"{record['collector']}:{record['peer_asn']}:{record.get('peer_address')}"
+        )
+
+    def __current_routes(self, records) -> dict:
+        """Current routes of peers of a batch
+
+        Returns:
+            Dict[Tuple[str, str], str]: {(prefix, peer): "source|country|path"}
+        """
+        keys = list(
+            {
+                (r["prefix"], self._peer(r))
+                for r in records
+                if r["type"] in ("A", "R", "W")
+            }
+        )
+        pipe = self.client.pipeline(transaction=False)
+        for prefix, peer in keys:
+            pipe.hget(f"routes-{prefix}", peer)
+        return {
+            key: route.decode() if route is not None else ""
+            for key, route in zip(keys, pipe.execute())
+        }
+
+    def _save(self, client, record, routes):
         """Store data in a sorted set named "bgp" with a scorebased on Time
 
         Format :
             bgp-prefix:path:source time time:type:peer_asn:collector:country_code
 
+        Live state, members are kept while a peer routes them :
+            prefixes-{ASN} : (cidr, cidr)
+            prefixes-{LU} : (cidr, cidr)
+            as-{cidr} : (as, as, as)
+            countries-{cidr} : (LU, FR)
+            paths-{cidr} : (path, path, path)
+            routes-{cidr} : {peer: source|country|path}
+            refs-{cidr} : {as:{as}|country:{LU}|path:{path}: number of routes}
+
         Args:
+            client (redis.client.Pipeline): Pipeline receiving commands
             record (`BGPElem`): BGP Element to save
+            routes (dict): Current routes, see `KvrocksDB.__current_routes()`,
+                updated with the record
         """
         e = record
+        prefix = e["prefix"]
+        country = e["country_code"] or ""
+        if e["type"] not in ("A", "R", "W"):
+            return
 
-        if e["type"] == "A":
-            self.client.sadd(
-                f"prefixes-{e['source']}", e["prefix"]
-            )  # prefixes-{ASN} : (cidr, cidr)
-            self.client.sadd(
-                f"prefixes-{e['country_code']}", e["prefix"]
-            )  # prefixes-{LU} : (cidr, cidr)
-            self.client.sadd(
-                f"as-{e['prefix']}", e["source"]
-            )  # as-{cidr} : (as, as, as)
-            self.client.sadd(
-                f"countries-{e['prefix'] or ''}", e["country_code"]
-            )  # countries-{cidr} : (LU, FR)
-            self.client.sadd(
-                f"paths-{e['prefix']}", e.get("as-path")
-            )  # paths-{cidr} : (path, path, path)
-
-            self.client.zadd(
-                "bgp-{}:{}:{}".format(e["prefix"], e.get("as-path"), e["source"]),
+        peer = self._peer(e)
+        old = routes[prefix, peer]
+        old_source, old_country = old.split("|")[:2] if old else ("", country)
+        if e["type"] == "W":
+            source, country, new = old_source, old_country, ""
+        else:
+            source = e["source"]
+            new = f"{source}|{country}|{e.get('as-path')}"
+        routes[prefix, peer] = new
+        # every key is declared, for clusters
+        self.__route(
+            keys=[
+                f"routes-{prefix}",
+                f"refs-{prefix}",
+                f"as-{prefix}",
+                f"countries-{prefix}",
+                f"paths-{prefix}",
+                f"prefixes-{source}",
+                f"prefixes-{country}",
+                f"prefixes-{old_source}",
+                f"prefixes-{old_country}",
+            ],
+            args=[prefix, peer, old, new],
+            client=client,
+        )
+
+        if e["type"] in ("A", "R"):
+            client.zadd(
+                "bgp-{}:{}:{}".format(prefix, e.get("as-path"), e["source"]),
                 {
                     f"{e['time']}:{e['type']}:{e['peer_asn']}:"
-                    f"{e['collector']}:{e['country_code']}": int(float(e["time"]))
+                    f"{e['collector']}:{country}": int(float(e["time"]))
                 },
             )
-        #            self.client.execute()
 
-        elif e["type"] == "W":
-            return
-            for as_source in self.client.smembers(f"as-{e['prefix']}"):
-                self.client.srem(
-                    f"prefixes-{as_source}", e["prefix"]
-                )  # pr AS {cidr, cidr}
-
-            for pr in self.client.smembers(f"country-{e['prefix']}"):
-                self.client.srem(
-                    f"prefixes-{e['country_code']}", pr
-                )  # pr LU {cidr, cidr}
-
-            self.client.delete(f"countries-{e['prefix']}")  # countries-cidr {LU, FR}
-            self.client.delete(f"as-{e['prefix']}")  # as-cidr {as, as, as }
-            self.client.delete(f"paths-{e['prefix']}")  # paths-cidr {path, path, path}
-
-            self.client.zadd(
-                "bgp-{}".format(e["prefix"]),
+        else:
+            client.zadd(
+                f"bgp-{prefix}",
                 {
                     f"{e['time']}:{e['type']}:{e['peer_asn']}:{e['collector']}": int(
                         float(e["time"])
                     )
                 },
             )
-            self.client.zadd(
-                "bgp-{}:{}".format(e["prefix"], e.get("as-path")),
-                {
-                    f"{e['time']}:{e['type']}:{e['peer_asn']}:"
-                    f"{e['collector']}": int(float(e["time"]))
-                },
-            )
 
     ##############
     #   GETTER   #
     ##############
 
-    def get(
-        self,
-        time_start,
-        time_end,
-        record_type=None,
-        peer_asn=None,
-        collectors=None,
-        countries=None,
-        as_numbers=None,
-        prefixes=None,
-        as_paths=None,
-    ):
-        """Can't be tested now"""
-        pass
+    @staticmethod
+    def _parse_key(key):
+        """Split a history key, prefixes may contain ':'
+
+        Args:
+            key (str): bgp-{cidr}:{path}:{source} or bgp-{cidr}
+
+        Returns:
+            Tuple[str, str, str]: prefix, path and source (None for withdrawals)
+        """
+        slash = key.index("/")
+        end = slash + 1
+        while end < len(key) and key[end].isdigit():
+            end += 1
+        if end == len(key):
+            return key[4:], None, None
+        path, source = key[end + 1 :].rsplit(":", 1)  # noqa: E203
+        return key[4:end], path, source
+
+    def query(self, query, chunk_size=10000):
+        """
+        Retrieve records from history sorted sets.
+        Keys are scanned by chunk_size, records are ordered by time within a key.
+        With exact prefix match, only keys of these prefixes are read.
+
+        See `Database.get()`
+        """
+        if query.prefixes is not None and query.match == "exact":
+            patterns = [f"bgp-{p}*" for p in query.prefixes]
+        else:
+            patterns = ["bgp-*"]
+        keys = []
+        for pattern in patterns:
+            for key in self.client.scan_iter(match=pattern, count=chunk_size):
+                keys.append(key.decode())
+                if len(keys) >= chunk_size:
+                    yield from self.__read_keys(keys, query)
+                    keys = []
+        yield from self.__read_keys(keys, query)
+
+    def __read_keys(self, keys, query):
+        """Read history of keys with a single round-trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrangebyscore(key, int(query.time_start), query.time_end)
+        for key, members in zip(keys, pipe.execute()):
+            prefix, path, source = self._parse_key(key)
+            for member in members:
+                fields = member.decode().split(":")
+                record = record_from_row(
+                    (
+                        float(fields[0]),
+                        fields[1],
+                        int(fields[2]),
+                        fields[3],
+                        None,
+                        fields[4] if len(fields) > 4 else None,
+                        source,
+                        prefix,
+                        path,
+                    )
+                )
+                if query.matches(record):
+                    yield record
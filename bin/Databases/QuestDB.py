@@ -1,16 +1,258 @@
-import collections
-from Databases.database import Database
+import sys
+import time
 import socket
+import datetime
+import threading
+from Databases.database import Database
+from Databases.query import record_from_row
+from bgpmetrics import metrics
 import psycopg2
 
+TAG_ESCAPES = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n"})
+# Characters escaped in InfluxDB Line protocol measurement, tag keys and tag values
+FIELD_ESCAPES = str.maketrans({'"': '\\"', "\\": "\\\\", "\n": "\\n"})
+# Characters escaped in InfluxDB Line protocol string field values
+
+
+class ILPSender:
+    """
+    Buffered InfluxDB Line protocol sender over TCP
+
+    - Lines are accumulated in a preallocated buffer, sent when the buffer is full
+        or older than flush_interval seconds
+    - If the connection drops, it reconnects at once and sends the unflushed
+        buffer again, preceded by the previous one which may have been lost
+        in the closed socket (lines received before the error may be duplicated)
+    - While the server is unreachable, lines stay in the buffer and connections
+        are retried by the next flushes, with exponential backoff.
+        Writers never wait for the server: when the buffer is full, its lines
+        are dropped and counted in `ILPSender.dropped_bytes`
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        buffer_size=1 << 20,
+        flush_interval=1.0,
+        max_backoff=30.0,
+        timeout=10.0,
+    ):
+        """
+        Args:
+            host (str): QuestDB host
+            port (int): InfluxDB Line protocol TCP port
+            buffer_size (int): Buffer capacity in bytes
+            flush_interval (float): Max age of buffered lines in seconds
+            max_backoff (float): Max delay between reconnections in seconds
+            timeout (float): Max duration of a connection or a send in seconds
+        """
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.sock = None
+        self.bytes_sent = 0
+        """Number of bytes sent to server"""
+        self.dropped_bytes = 0
+        """Number of bytes dropped while the server was unreachable"""
+        self.flushes = 0
+        """Number of buffer flushes"""
+        self.reconnections = 0
+        """Number of connection errors"""
+        self.flush_latency = 0.0
+        """Duration of the last flush in seconds"""
+        self.max_flush_latency = 0.0
+        """Longest flush duration in seconds"""
+        self.closed = False
+
+        # Two preallocated buffers, swapped at each flush
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        self.__length = 0
+        self.__previous = memoryview(bytearray(buffer_size))
+        self.__previous_length = 0
+        self.__resend = False
+        self.__dropping = False
+        self.__oldest = None
+        self.__backoff = 0.1
+        self.__retry_at = 0
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__flusher = None
+        self.__send_time = metrics.histogram("database_write_seconds", database="quest")
+
+    def stats(self) -> dict:
+        """Sender counters"""
+        return {
+            "bytes_sent": self.bytes_sent,
+            "buffered": self.__length,
+            "dropped_bytes": self.dropped_bytes,
+            "flushes": self.flushes,
+            "reconnections": self.reconnections,
+            "flush_latency": self.flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    def start(self):
+        """Connect to server and start time-based flushes"""
+        self.closed = False
+        self.__connect()
+        self.__stopped.clear()
+        self.__flusher = threading.Thread(
+            target=self.__flush_old_lines, daemon=True, name="BGP monitor - quest"
+        )
+        self.__flusher.start()
+
+    def close(self):
+        """Send buffered lines and close connection, they are dropped
+        if the server is unreachable"""
+        if self.__flusher is not None:
+            self.__stopped.set()
+            self.__flusher.join()
+            self.__flusher = None
+        self.closed = True
+        with self.__lock:
+            self.__retry_at = 0  # last attempt
+            self.__flush(full=True)
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def write(self, data: bytes):
+        """Add complete lines to the buffer
+
+        Args:
+            data (bytes): One or many lines, each ended by \\n
+        """
+        size = len(data)
+        with self.__lock:
+            if self.__length + size > len(self.__buffer):
+                self.__flush(full=True)
+            if size > len(self.__buffer):
+                if not self.__send(data):
+                    self.__drop(size)
+                return
+            self.__buffer[self.__length : self.__length + size] = data  # noqa: E203
+            self.__length += size
+            if self.__oldest is None:
+                self.__oldest = time.monotonic()
+
+    def flush(self):
+        """Send buffered lines, they are kept if the server is unreachable"""
+        with self.__lock:
+            self.__flush()
+
+    def __flush(self, full=False):
+        """Send buffered lines, lock must be held
+
+        Args:
+            full (bool): The buffer can't take more lines, drop them if unsent
+        """
+        if not self.__length:
+            return
+        t = time.perf_counter()
+        if not self.__send(self.__view[: self.__length]):
+            if full:
+                self.__drop(self.__length)
+                self.__length = 0
+                self.__oldest = None
+            return
+        self.__buffer, self.__previous = self.__previous.obj, self.__view
+        self.__view = memoryview(self.__buffer)
+        self.__previous_length = self.__length
+        self.__length = 0
+        self.__oldest = None
+        self.flushes += 1
+        self.flush_latency = time.perf_counter() - t
+        self.max_flush_latency = max(self.max_flush_latency, self.flush_latency)
+
+    def __drop(self, size):
+        if not self.__dropping:
+            print("QuestDB : server unreachable, dropping lines", file=sys.stderr)
+            self.__dropping = True
+        self.dropped_bytes += size
+
+    def __flush_old_lines(self):
+        while not self.__stopped.wait(self.flush_interval / 2):
+            oldest = self.__oldest
+            if oldest is not None and time.monotonic() - oldest >= self.flush_interval:
+                self.flush()
+
+    def __connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __send(self, data) -> bool:
+        """Send data, reconnect at once if the connection dropped.
+        Doesn't wait: while the server is unreachable, connections are only
+        attempted after the backoff delay.
+
+        Returns:
+            bool: True if data was sent
+        """
+        start = time.perf_counter()
+        for attempt in range(2):
+            if self.sock is None and time.monotonic() < self.__retry_at:
+                return False
+            try:
+                if self.sock is None:
+                    self.__connect()
+                    if self.__resend and self.__previous_length:
+                        self.sock.sendall(self.__previous[: self.__previous_length])
+                    self.__resend = False
+                self.sock.sendall(data)
+            except OSError as e:
+                connected = self.sock is not None
+                if connected:
+                    self.sock.close()
+                    self.sock = None
+                self.__resend = True
+                self.reconnections += 1
+                if connected and not attempt:
+                    continue
+                print(
+                    f"QuestDB : connection error ({e}),"
+                    f" retrying in {self.__backoff:.1f}s",
+                    file=sys.stderr,
+                )
+                self.__retry_at = time.monotonic() + self.__backoff
+                self.__backoff = min(self.__backoff * 2, self.max_backoff)
+                return False
+            self.__backoff = 0.1
+            self.bytes_sent += len(data)
+            self.__send_time.observe(time.perf_counter() - start)
+            if self.__dropping:
+                print(
+                    f"QuestDB : reconnected, {self.dropped_bytes} bytes dropped",
+                    file=sys.stderr,
+                )
+                self.__dropping = False
+            return True
+        return False
+
+
+TAGS = [
+    ("type", "type"),
+    ("project", "project"),
+    ("collector", "collector"),
+    ("country", "country_code"),
+]
+# InfluxDB Line protocol tags as (tag name, record key)
+
 
 class QuestDB(Database):
     name = "quest"
 
     def __init__(self, config):
+        """
+        Args:
+            config (dict): Format :
+                {"host":"127.0.0.1", "tcp_port":9009, "pg_port":8812,
+                 "buffer_size":1048576, "flush_interval":1}
+        """
         super().__init__()
-        # For UDP, change socket.SOCK_STREAM to socket.SOCK_DGRAM
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         # Required args for line protocol and postgre connection
         self.conf = {
@@ -18,11 +260,18 @@ class QuestDB(Database):
             "tcp_port": int(config["tcp_port"]),
             "pg_port": int(config["pg_port"]),
         }
+        self.sender = ILPSender(
+            self.conf["host"],
+            self.conf["tcp_port"],
+            buffer_size=int(config.get("buffer_size", 1 << 20)),
+            flush_interval=float(config.get("flush_interval", 1)),
+        )
         self.connection = None
+        self.__synced_drops = 0
 
     def start(self):
         """Connect to server using etc/config.cfg file"""
-        self.sock.connect((self.conf["host"], self.conf["tcp_port"]))
+        self.sender.start()
         self.connection = psycopg2.connect(
             host=self.conf["host"],
             port=self.conf["pg_port"],
@@ -33,7 +282,8 @@ class QuestDB(Database):
 
     def stop(self):
         """Close connection to server"""
-        self.sock.close()
+        self.sender.close()
+        print(f"QuestDB : {self.sender.stats()}", file=sys.stderr)
         if self.connection:
             self.connection.close()
             print("PostgreSQL connection is closed")
@@ -45,81 +295,129 @@ class QuestDB(Database):
     def save(self, record):
         """Save bgp record using InfluxDB Line protocol
 
+        Args:
+            record (BGPElem)
+        """
+        self.send_utf8(self._line(record))
+
+    def save_many(self, records):
+        """Save a batch of bgp records
+
+        Args:
+            records (List[BGPElem])
+        """
+        self.send_utf8("".join(map(self._line, records)))
+
+    @staticmethod
+    def _line(record):
+        """Format a record using InfluxDB Line protocol, empty tags are skipped
+
         Format :
                 bgp,type={record['type']},project={record['project']},
-                collector={record['collector']},country={record['country_code'] or ''}
+                collector={record['collector']},country={record['country_code']}
                  peer={record["peer_asn"]},prefix="{record["prefix"]}",
                 path="{record.get("as-path", "")}",source="{record["source"]}"
                  {int(record['time']*1000000000)}\n
-
-        Args:
-            record (BGPElem)
         """
-
-        self.send_utf8(
-            (
-                f"bgp,type={record['type']},project={record['project']},"
-                f"collector={record['collector']},"
-                f"country={record['country_code'] or ''}"
-                f' peer={record["peer_asn"]},prefix="{record["prefix"]}",'
-                f'path="{record.get("as-path", "")}",source="{record["source"]}"'
-                f" {int(record['time']*1000000000)}\n"
-            )
+        tags = "bgp"
+        for tag, key in TAGS:
+            if record.get(key):
+                tags += f",{tag}={str(record[key]).translate(TAG_ESCAPES)}"
+        return (
+            f'{tags} peer={record["peer_asn"]},'
+            f'prefix="{str(record["prefix"]).translate(FIELD_ESCAPES)}",'
+            f'path="{record.get("as-path", "").translate(FIELD_ESCAPES)}",'
+            f'source="{(record["source"] or "").translate(FIELD_ESCAPES)}"'
+            f" {int(record['time']*1000000000)}\n"
         )
 
+    def sync(self) -> bool:
+        """Send buffered lines, see `Database.sync()`
+
+        Line protocol has no acknowledgement, lines written to the socket are
+        confirmed: after a connection error, the previous buffer is sent again.
+
+        Returns:
+            bool: False if lines are still buffered, or were dropped since the
+                previous call
+        """
+        if not self.sender.closed:
+            self.sender.flush()
+        stats = self.sender.stats()
+        dropped = stats["dropped_bytes"] - self.__synced_drops
+        self.__synced_drops = stats["dropped_bytes"]
+        return not stats["buffered"] and not dropped
+
     def send_utf8(self, msg):
-        """Encode message and send it to server"""
-        self.sock.sendall(msg.encode())
+        """Encode lines and add them to the sender buffer"""
+        self.sender.write(msg.encode())
 
     ##############
     #   GETTER   #
     ##############
-    # The followings aren't used
 
     var_names = {
-        "time_start": "time_start",
-        "time_end": "time_end",
+        "time": "timestamp",
         "record_type": "type",
         "peer_asn": "peer",
         "collectors": "collector",
         "countries": "country",
         "as_numbers": "source",
-        "prefixes": "prefix",
         "as_paths": "path",
     }
-    # Used in `QuestDB.get` function as arg_name:db_column_name
+    # Used in `QuestDB.query` function as filter_name:db_column_name
 
-    def get(
-        self,
-        time_start,
-        time_end,
-        record_type=None,
-        peer_asn=None,
-        collectors=None,
-        countries=None,
-        as_numbers=None,
-        prefixes=None,
-        as_paths=None,
-    ):
+    @staticmethod
+    def _prefix_condition(prefix, match, name, params):
+        """Only exact match is done by QuestDB, prefixes are strings"""
+        if match != "exact":
+            return None
+        params[name] = prefix
+        return f"prefix = %({name})s"
+
+    def query(self, query, chunk_size=10000):
         """
-        Retrieve data from QuestDB using psycopg2 (Postgre) connection
+        Retrieve data from QuestDB using psycopg2 (Postgre) connection.
+        Records are ordered by time and retrieved by pages of chunk_size rows,
+        each page starts at the time of the last record of the previous one.
 
         See `Database.get()`
         """
-        if not self.cursor:
-            self.cursor = self.connection.cursor()
-
-        query = "SELECT * FROM bgp WHERE"
-        params = {key: value for key, value in locals() if value is not None}
-
-        if len(params) > 0:
-            for k, v in params:
-                query += (
-                    f" {QuestDB.var_names[k]} "
-                    + ("IN " if isinstance(v, collections.Sequence) else "== ")
-                    + "%s and"
-                )
-            query += query.rsplit(" ", 1)[0]
-
-        self.cursor.execute(query, params.values())
-        return self.cursor.fetchall()
+        where, params, residual = query.compile(
+            QuestDB.var_names,
+            time_format=lambda t: datetime.datetime.fromtimestamp(
+                t, datetime.timezone.utc
+            ).replace(tzinfo=None),
+            prefix_condition=self._prefix_condition,
+        )
+        select = (
+            "SELECT timestamp, type, peer, collector, project, country, source,"
+            f" prefix, path FROM bgp WHERE {where}"
+        )
+        last_time = None
+        skip = 0
+        with self.connection.cursor() as cursor:
+            while True:
+                page = select
+                if last_time is not None:
+                    page += " AND timestamp >= %(last_time)s"
+                    params["last_time"] = last_time
+                page += f" ORDER BY timestamp LIMIT {skip}, {skip + chunk_size}"
+                cursor.execute(page, params)
+                rows = cursor.fetchall()
+                for row in rows:
+                    record = record_from_row(row)
+                    record["time"] = (
+                        row[0].replace(tzinfo=datetime.timezone.utc).timestamp()
+                    )
+                    record["peer_asn"] = int(row[2])
+                    if not residual or query.matches_prefix(record["prefix"]):
+                        yield record
+                if len(rows) < chunk_size:
+                    return
+                # Rows at the last timestamp are skipped on next page
+                if row[0] == last_time:
+                    skip += sum(1 for r in rows if r[0] == last_time)
+                else:
+                    last_time = row[0]
+                    skip = sum(1 for r in rows if r[0] == last_time)
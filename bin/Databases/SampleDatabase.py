@@ -24,29 +24,25 @@ class SampleDatabase(Database):
     ###############
 
     def save(self, record):
-        """All records are sent one by one using this function"""
+        """Save a single record"""
         pass
 
+    def save_many(self, records):
+        """All records are sent by batches using this function
+
+        Optional, default calls `SampleDatabase.save()` for each record"""
+        for record in records:
+            self.save(record)
+
     ##############
     #   GETTER   #
     ##############
-    # The followings aren't used
-
-    def get(
-        self,
-        time_start,
-        time_end,
-        record_type=None,
-        peer_asn=None,
-        collectors=None,
-        countries=None,
-        as_numbers=None,
-        prefixes=None,
-        as_paths=None,
-    ):
+
+    def query(self, query, chunk_size=10000):
         """
-        Retrieve data and return it as iterable
+        Retrieve data and yield it as records
 
-        See `Database.get()`
+        See `Database.get()`, use `query.compile()` to build a SQL WHERE clause
+        or `query.matches(record)` to filter records
         """
-        pass
+        return iter([])
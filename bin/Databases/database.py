@@ -1,4 +1,9 @@
+import sys
+import time
+import threading
 from abc import ABC, abstractmethod
+from Databases.query import BGPQuery
+from bgpmetrics import metrics
 
 
 class Database(ABC):
@@ -14,6 +19,31 @@ class Database(ABC):
     def save(self, record):
         pass
 
+    def save_many(self, records):
+        """Save a batch of records
+
+        Default calls `Database.save()` for each record,
+        override it to send the whole batch at once.
+
+        Args:
+            records (List[dict]): BGP elements to save
+        """
+        for record in records:
+            self.save(record)
+
+    def sync(self) -> bool:
+        """Wait until records saved before are written
+
+        Default returns True, for databases writing records in `Database.save()`.
+        Override it if records are queued or buffered.
+
+        Returns:
+            bool: True if every record saved before is written,
+                False if some were lost since the previous call or are still
+                waiting
+        """
+        return True
+
     @abstractmethod
     def start(self):
         pass
@@ -22,27 +52,119 @@ class Database(ABC):
     def stop(self):
         pass
 
-    @abstractmethod
     def get(
         self,
         time_start,
         time_end,
         record_type=None,
         peer_asn=None,
-        collector=None,
-        country=None,
-        asn=None,
-        prefix=None,
-        path=None,
+        collectors=None,
+        countries=None,
+        as_numbers=None,
+        prefixes=None,
+        as_paths=None,
+        match="exact",
+        chunk_size=10000,
     ):
+        """
+        Retrieve records between time_start and time_end
+
+        Args:
+            time_start, time_end (int|str): Timestamp or YYYY-MM-DD hh:mm:ss (UTC)
+            record_type, peer_asn, collectors, countries, as_numbers, as_paths:
+                value or list of values
+            prefixes (List[str]): CIDR prefixes
+            match (str): Prefix match type, exact, more, less or any.
+                See `bgpfilter.BGPFilter.prefix_filter`
+            chunk_size (int): Number of records retrieved at once
+
+        Returns:
+            Iterator[dict]: Records with the same keys as `bgpfilter.BGPFilter` output
+        """
+        return self.query(
+            BGPQuery(
+                time_start,
+                time_end,
+                record_type=record_type,
+                peer_asn=peer_asn,
+                collectors=collectors,
+                countries=countries,
+                as_numbers=as_numbers,
+                prefixes=prefixes,
+                as_paths=as_paths,
+                match=match,
+            ),
+            chunk_size,
+        )
+
+    @abstractmethod
+    def query(self, query, chunk_size=10000):
+        """Run a query built by `Database.get()`
+
+        Args:
+            query (`Databases.query.BGPQuery`): time range and filters
+            chunk_size (int): Number of records retrieved at once
+
+        Yields:
+            dict: Records, see `Databases.query.RECORD_KEYS`
+        """
         pass
 
 
+def load_database(config, name) -> Database:
+    """Create the database named name, without starting it
+
+    Args:
+        config (dict): `databases` section of config.cfg
+        name (str): `Database.name` of the database
+
+    Raises:
+        ValueError: If the database isn't configured or doesn't exist
+    """
+    if config is None or not isinstance(config.get(name), dict):
+        raise ValueError(f"Database {name} isn't configured in config file")
+    for db_class in Database.__subclasses__():
+        if db_class.name == name:
+            return db_class(config[name])
+    raise ValueError(f"Unknown database {name}")
+
+
 class BGPDatabases:
+    """
+    Send records to every loaded database
+
+    Records are accumulated in micro-batches, a batch is sent to databases
+    when it contains `BGPDatabases.batch_size` records
+    or when it is older than `BGPDatabases.batch_age` seconds.
+    """
+
     def __init__(self, database_conf=[]):
+        """
+        Args:
+            database_conf (dict): `databases` section of config.cfg
+        """
         self.__databases = []
+        self.batch_size: int = 5000
+        """Max number of records in a batch"""
+        self.batch_age: float = 0.2
+        """Max age of a batch in seconds"""
+        self.watermarks = {}
+        """Time of the latest record written to each database, by collector:
+        {database: {collector: time}}. Moved by `BGPDatabases.sync()`"""
+        if isinstance(database_conf, dict):
+            self.batch_size = int(database_conf.get("batch_size", self.batch_size))
+            self.batch_age = float(database_conf.get("batch_age", self.batch_age))
         self.databases = database_conf
-        self.start()
+
+        self.__batch = []
+        self.__batch_time = None
+        self.__sent = {}
+        self.__unconfirmed = {}
+        self.__unsynced = set()
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__flusher = None
 
     @property
     def databases(self) -> list:
@@ -57,18 +179,120 @@ class BGPDatabases:
     def databases(self, config):
         if config is not None:
             for db in config:
+                if not isinstance(config[db], dict):
+                    continue
                 for db_class in Database.__subclasses__():
                     if db_class.name == db:
                         self.__databases.append(db_class(config[db]))
 
     def save(self, record):
+        """Add a record to the current batch"""
+        if self.__databases:
+            self.save_batch([record])
+
+    def save_batch(self, records):
+        """Add records to the current batch, send it if full
+
+        Args:
+            records (List[dict]): BGP elements to save
+        """
+        if not self.__databases:
+            return
+        with self.__lock:
+            if not self.__batch:
+                self.__batch_time = time.monotonic()
+            self.__batch.extend(records)
+            full = len(self.__batch) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Send the current batch to every database"""
+        with self.__flush_lock:
+            self.__flush()
+
+    def __flush(self):
+        """Send the current batch, flush lock must be held"""
+        with self.__lock:
+            batch = self.__batch
+            self.__batch = []
+        if not batch:
+            return
+        latest = {}
+        earliest = {}
+        for r in batch:
+            if r["time"] > latest.get(r["collector"], 0):
+                latest[r["collector"]] = r["time"]
+            if r["time"] < earliest.get(r["collector"], r["time"] + 1):
+                earliest[r["collector"]] = r["time"]
         for db in self.__databases:
-            db.save(record)
+            start = time.perf_counter()
+            db.save_many(batch)
+            metrics.histogram("database_flush_seconds", database=db.name).observe(
+                time.perf_counter() - start
+            )
+            metrics.counter("database_records", database=db.name).inc(len(batch))
+            self.__sent.setdefault(db.name, {}).update(latest)
+            unconfirmed = self.__unconfirmed.setdefault(db.name, {})
+            for collector, t in earliest.items():
+                unconfirmed.setdefault(collector, t)
+
+    def sync(self):
+        """Send the current batch, wait for databases to write it, then move their
+        `BGPDatabases.watermarks` to the latest records sent
+
+        Watermarks of a database that lost records or didn't write them yet
+        (see `Database.sync()`) stay at its last confirmed write, or at the first
+        unconfirmed record of collectors never confirmed: a resume reads records
+        after them again. Losses are reported once, the next confirmed sync moves
+        watermarks past lost records. Batches wait during the sync.
+        """
+        with self.__flush_lock:
+            self.__flush()
+            for db in self.__databases:
+                if db.name not in self.__sent:
+                    continue
+                # replaced, not updated: checkpoints may read it from another thread
+                if db.sync():
+                    self.watermarks[db.name] = dict(self.__sent[db.name])
+                    self.__unconfirmed[db.name] = {}
+                    self.__unsynced.discard(db.name)
+                    continue
+                self.watermarks[db.name] = {
+                    **self.__unconfirmed[db.name],
+                    **self.watermarks.get(db.name, {}),
+                }
+                if db.name not in self.__unsynced:
+                    self.__unsynced.add(db.name)
+                    print(
+                        f"Databases : {db.name} didn't confirm its writes,"
+                        " watermarks kept at the last confirmed write",
+                        file=sys.stderr,
+                    )
+
+    def __flush_old_batches(self):
+        """Send batches older than `BGPDatabases.batch_age`"""
+        while not self.__stopped.wait(self.batch_age / 2):
+            if self.__batch and time.monotonic() - self.__batch_time >= self.batch_age:
+                self.flush()
 
     def start(self):
         for db in self.__databases:
             db.start()
+        if self.__databases:
+            self.__stopped.clear()
+            self.__flusher = threading.Thread(
+                target=self.__flush_old_batches,
+                daemon=True,
+                name="BGP monitor - databases flush",
+            )
+            self.__flusher.start()
 
     def stop(self):
+        if self.__flusher is not None:
+            self.__stopped.set()
+            self.__flusher.join()
+            self.__flusher = None
+        self.flush()
         for db in self.__databases:
             db.stop()
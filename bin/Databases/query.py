@@ -0,0 +1,228 @@
+"""
+Backend independent description of a `Database.get()` call
+"""
+
+import re
+import datetime
+import ipaddress
+
+RECORD_KEYS = [
+    "time",
+    "type",
+    "peer_asn",
+    "collector",
+    "project",
+    "country_code",
+    "source",
+    "prefix",
+    "as-path",
+]
+# Columns of rows read by `Database.get()`, see `record_from_row()`
+
+MATCH_TYPES = ["exact", "more", "less", "any"]
+
+
+def to_timestamp(value) -> float:
+    """Convert a time to a UTC timestamp
+
+    Args:
+        value (int|float|str|datetime): Timestamp, datetime
+            or YYYY-MM-DD hh:mm:ss string (UTC, as `bgpfilter.BGPFilter.record_mode()`)
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def record_from_row(row) -> dict:
+    """Build a record from a row ordered as `RECORD_KEYS`
+
+    Keys and order are the ones of `bgpfilter.BGPFilter` records: fields
+    databases don't store (peer_address, router, router_ip) are None,
+    withdrawals have no as-path, empty country_code and source are None.
+    """
+    values = dict(zip(RECORD_KEYS, row))
+    record = {
+        "type": values["type"],
+        "time": values["time"],
+        "peer_address": None,
+        "peer_asn": values["peer_asn"],
+        "collector": values["collector"],
+        "project": values["project"],
+        "router": None,
+        "router_ip": None,
+        "prefix": values["prefix"],
+    }
+    if record["type"] != "W":
+        record["as-path"] = values["as-path"] or ""
+    record["country_code"] = values["country_code"] or None
+    source = values["source"]
+    record["source"] = None if source in ("", None) else str(source)
+    return record
+
+
+_NUMBERS = re.compile("[0-9]+")
+
+
+def parse_path(path) -> list:
+    """Convert an AS path to a list of AS numbers, AS sets members are included
+
+    Same conversion as `Databases.ClickHouseDB.MIGRATE_QUERY`: every number
+    of the path, in order
+
+    Args:
+        path (str): Example: 25160 2914 {5511,8697}
+    """
+    return [int(asn) for asn in _NUMBERS.findall(path)]
+
+
+class BGPQuery:
+    """
+    Time range and filters of a `Database.get()` call
+
+    Backends compile it to a parameterized query with `BGPQuery.compile()`,
+    or evaluate it on records with `BGPQuery.matches()`
+    """
+
+    def __init__(
+        self,
+        time_start,
+        time_end,
+        record_type=None,
+        peer_asn=None,
+        collectors=None,
+        countries=None,
+        as_numbers=None,
+        prefixes=None,
+        as_paths=None,
+        match="exact",
+    ):
+        """
+        Args:
+            time_start, time_end: See `to_timestamp()`
+            prefixes (List[str]): CIDR prefixes
+            match (str): Prefix match type, exact, more, less or any.
+                See `bgpfilter.BGPFilter.prefix_filter`
+            Others: value or list of values
+
+        Raises:
+            ValueError: Invalid interval, match type or prefix
+        """
+        self.time_start = to_timestamp(time_start)
+        self.time_end = to_timestamp(time_end)
+        if self.time_start > self.time_end:
+            raise ValueError("Invalid interval. Beginning must precede the end")
+        if match not in MATCH_TYPES:
+            raise ValueError(f"Match type must be one of {MATCH_TYPES}")
+        self.match = match
+        self.filters = {}
+        """Filter name: list of values, for filters that are set"""
+        values = {
+            "record_type": record_type,
+            "peer_asn": peer_asn,
+            "collectors": collectors,
+            "countries": countries,
+            "as_numbers": as_numbers,
+            "as_paths": as_paths,
+        }
+        for name, v in values.items():
+            if v is not None:
+                self.filters[name] = (
+                    list(v) if isinstance(v, (list, tuple, set)) else [v]
+                )
+        if "as_numbers" in self.filters:
+            self.filters["as_numbers"] = [str(a) for a in self.filters["as_numbers"]]
+        if "peer_asn" in self.filters:
+            self.filters["peer_asn"] = [int(a) for a in self.filters["peer_asn"]]
+        self.prefixes = None
+        """List of `ipaddress.ip_network`, None if not filtered"""
+        if prefixes is not None:
+            self.prefixes = [ipaddress.ip_network(p) for p in prefixes]
+
+    def compile(self, columns, time_format=None, convert=None, prefix_condition=None):
+        """
+        Build a parameterized WHERE clause (pyformat: %(name)s)
+
+        Args:
+            columns (dict): filter name or "time": column name
+            time_format (Callable): Convert a timestamp to the time parameter
+            convert (Callable): (filter name, value) -> parameter value
+            prefix_condition (Callable): (prefix, match type, parameter name, params)
+                -> condition, or None if it can't be done by the backend
+
+        Returns:
+            Tuple[str, dict, bool]: WHERE clause, parameters
+                and True if prefixes must be checked with `BGPQuery.matches_prefix()`
+        """
+        time_format = time_format or (lambda t: t)
+        params = {
+            "time_start": time_format(self.time_start),
+            "time_end": time_format(self.time_end),
+        }
+        conditions = [
+            f"{columns['time']} >= %(time_start)s",
+            f"{columns['time']} <= %(time_end)s",
+        ]
+        for name, values in self.filters.items():
+            names = []
+            for i, v in enumerate(values):
+                params[f"{name}_{i}"] = convert(name, v) if convert else v
+                names.append(f"%({name}_{i})s")
+            if len(names) == 1:
+                conditions.append(f"{columns[name]} = {names[0]}")
+            else:
+                conditions.append(f"{columns[name]} IN ({', '.join(names)})")
+
+        residual = False
+        if self.prefixes is not None:
+            prefix_conditions = []
+            for i, p in enumerate(self.prefixes):
+                c = None
+                if prefix_condition is not None:
+                    c = prefix_condition(str(p), self.match, f"prefix_{i}", params)
+                if c is None:
+                    residual = True
+                    break
+                prefix_conditions.append(c)
+            if not residual:
+                conditions.append(f"({' OR '.join(prefix_conditions)})")
+        return " AND ".join(conditions), params, residual
+
+    def matches_prefix(self, prefix) -> bool:
+        """Check a record prefix against prefixes filter and match type"""
+        if self.prefixes is None:
+            return True
+        if prefix is None:
+            return False
+        p = ipaddress.ip_network(prefix)
+        for f in self.prefixes:
+            if p.version != f.version:
+                continue
+            if self.match in ["exact", "more", "any"] and p == f:
+                return True
+            if self.match in ["more", "any"] and p.subnet_of(f):
+                return True
+            if self.match in ["less", "any"] and p.supernet_of(f):
+                return True
+        return False
+
+    def matches(self, record) -> bool:
+        """Check a record against every filter, for backends without query language"""
+        if not self.time_start <= record["time"] <= self.time_end:
+            return False
+        keys = {
+            "record_type": "type",
+            "peer_asn": "peer_asn",
+            "collectors": "collector",
+            "countries": "country_code",
+            "as_numbers": "source",
+            "as_paths": "as-path",
+        }
+        for name, values in self.filters.items():
+            if record.get(keys[name]) not in values:
+                return False
+        return self.matches_prefix(record["prefix"])
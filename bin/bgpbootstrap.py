@@ -0,0 +1,319 @@
+"""
+Initial routing table of `bgprib.BGPRib`, loaded from RIB dumps before the stream
+"""
+
+__all__ = ["BGPBootstrap"]
+
+import os
+import sys
+import json
+import time
+import signal
+import datetime
+import urllib.parse
+import urllib.request
+import multiprocessing
+from queue import Empty, Full
+from typing import List, Tuple
+
+BROKER_URL = "https://broker.bgpstream.caida.org/v2/data"
+"""BGPStream broker API listing dump files of an interval"""
+
+
+class BGPBootstrap:
+    """
+    Fill `bgpout.BGPOut.rib` before `bgpfilter.BGPFilter` starts its stream,
+    so the routing table is complete from the first record
+
+    - Broker (no files): the latest RIB dump of each collector before the start
+        time is found with `BGPBootstrap.find_dumps()`. Each collector is
+        loaded from its dump, then updates from the dump time to the start time
+        are replayed, so collectors dumped at different times end up consistent.
+        In live mode, the start time is the opening of the live stream and the
+        replay waits for archives of the last minutes to be published.
+    - Files: MRT RIB dumps given as `<collector>=<path>` are loaded as routes of
+        this collector, then its updates are replayed from the dump time to the
+        start time like broker dumps. Without collector, the dump is loaded as is,
+        its records belong to the `singlefile` collector like records of
+        `--input_data` files: live updates of a collector would never replace them.
+
+    Each collector or file is parsed by a forked process, records are enriched and
+    filtered like the stream (prefixes, AS numbers, ip version, countries).
+    Routes are sent by batches to the current process, which owns the RIB.
+    Bootstrap records aren't sent to outputs.
+    If a process dies (OOM kill, crash of libbgpstream), the others are
+    terminated and the bootstrap fails. Processes exit if the current one dies.
+    """
+
+    def __init__(self, bgp_filter, files=None, processes=None, batch_size=10000):
+        """
+        Args:
+            bgp_filter (BGPFilter): Configured filter, with an output RIB
+            files (List[str]): MRT RIB dumps as `<collector>=<path>` or `<path>`,
+                the broker is used if empty
+            processes (int): Max number of parsing processes. Default: CPU count
+            batch_size (int): Number of routes sent at once by a process
+        """
+        self.filter = bgp_filter
+        self.files: List[Tuple[str, str]] = [_split(f) for f in files or []]
+        """MRT RIB dumps: (collector or None, path), the broker is used if empty"""
+        self.processes: int = processes or os.cpu_count() or 1
+        """Max number of parsing processes"""
+        self.batch_size = batch_size
+        self.window: int = 86400
+        """Seconds before the start time where broker dumps are searched"""
+        self.dumps = {}
+        """Loaded dumps: {collector or file: dump time}"""
+        self.__tasks = None
+        self.__results = None
+        self.__parent = None
+        self.__exited = False
+
+    def find_dumps(self, at) -> List[dict]:
+        """Latest RIB dump of each collector before a time
+
+        Collectors and project of the filter are used.
+
+        Args:
+            at (int): Unix time
+
+        Returns:
+            List[dict]: {"collector", "time", "url"}, sorted by collector
+
+        Raises:
+            OSError: Broker can't be reached
+            ValueError: Invalid answer of the broker
+        """
+        params = [
+            ("human", "false"),
+            ("intervals[]", f"{at - self.window},{at}"),
+            ("types[]", "ribs"),
+            ("projects[]", self.filter.project),
+        ]
+        params += [("collectors[]", c) for c in self.filter.collectors or []]
+        url = BROKER_URL + "?" + urllib.parse.urlencode(params)
+        data = json.load(urllib.request.urlopen(url, timeout=30))
+        if not isinstance(data.get("data"), dict):
+            raise ValueError(f"Invalid broker answer : {data.get('error')}")
+        resources = data["data"].get("resources", data["data"].get("dumpFiles", []))
+        latest = {}
+        for r in resources:
+            if r.get("type") != "ribs" or r["initialTime"] > at:
+                continue
+            c = r["collector"]
+            if c not in latest or r["initialTime"] > latest[c]["time"]:
+                latest[c] = {"collector": c, "time": r["initialTime"], "url": r["url"]}
+        return [latest[c] for c in sorted(latest)]
+
+    def run(self) -> int:
+        """Load dumps into the RIB, blocks until every dump is loaded
+
+        Returns:
+            int: Number of routes in the RIB
+
+        Raises:
+            ValueError: No RIB in output, or no dump found
+            RuntimeError: A dump couldn't be loaded
+        """
+        rib = self.filter.out.rib
+        if rib is None:
+            raise ValueError("Bootstrap requires a RIB, see bgpout.BGPOut.rib")
+        start = _timestamp(self.filter.start_time)
+        if self.files:
+            tasks = [
+                (path, path, collector, None, None if collector is None else start - 1)
+                for collector, path in self.files
+            ]
+        else:
+            tasks = [
+                (d["collector"], None, d["collector"], d["time"], start - 1)
+                for d in self.find_dumps(start)
+            ]
+        if not tasks:
+            raise ValueError("No RIB dump found for bootstrap")
+
+        t = time.time()
+        print(f"Bootstrap : loading {len(tasks)} RIB dumps", file=sys.stderr)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        ctx = multiprocessing.get_context("fork")
+        self.__parent = os.getpid()
+        self.__exited = False
+        self.__tasks = ctx.Queue()
+        self.__results = ctx.Queue(2 * self.processes)
+        for task in tasks:
+            self.__tasks.put(task)
+        processes = [
+            ctx.Process(target=self._worker, name=f"BGP bootstrap {i}")
+            for i in range(min(self.processes, len(tasks)))
+        ]
+        for p in processes:
+            self.__tasks.put(None)
+            p.start()
+
+        errors = []
+        remaining = len(processes)
+        while remaining:
+            try:
+                item = self.__results.get(timeout=1)
+            except Empty:
+                self.__check(processes, len(processes) - remaining)
+                continue
+            if item is None:
+                remaining -= 1
+            elif item[0] == "routes":
+                for kind, collector, peer_asn, peer_address, prefix, path in item[1]:
+                    if kind == "W":
+                        rib.withdraw(collector, peer_asn, peer_address, prefix)
+                    else:
+                        rib.announce(collector, peer_asn, peer_address, prefix, path)
+            elif item[0] == "done":
+                _, name, dump_time, count = item
+                self.dumps[name] = dump_time
+                print(
+                    f"Bootstrap : {name} loaded, {count} records,"
+                    f" {rib.routes} routes in RIB",
+                    file=sys.stderr,
+                )
+            else:
+                errors.append(f"{item[1]} ({item[2]})")
+        for p in processes:
+            p.join()
+        self.__tasks = self.__results = None
+        if errors:
+            raise RuntimeError(f"Bootstrap failed for {', '.join(errors)}")
+        print(
+            f"Bootstrap : {rib.routes} routes in {time.time() - t:.0f}s",
+            file=sys.stderr,
+        )
+        return rib.routes
+
+    def __check(self, processes, finished):
+        """
+        Checks that no process failed or exited before sending its end of tasks
+
+        A process sends its end of tasks then exits, the end of tasks may still
+        be in the results queue: clean exits are only checked once every process
+        exited and the queue stayed empty since the previous check.
+
+        Args:
+            processes: Bootstrap processes
+            finished (int): Number of ends of tasks received
+
+        Raises:
+            RuntimeError: A process exited early, others are terminated
+        """
+        dead = next((p for p in processes if p.exitcode), None)
+        if dead is None:
+            missing = finished < len(processes)
+            if not missing or any(p.exitcode is None for p in processes):
+                self.__exited = False
+                return
+            if not self.__exited:
+                self.__exited = True  # its results are read by the next get
+                return
+            dead = processes[0]
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        # pending items would never be read, don't wait for them on exit
+        self.__tasks.cancel_join_thread()
+        self.__results.cancel_join_thread()
+        raise RuntimeError(
+            f"Bootstrap : {dead.name} exited with code {dead.exitcode}"
+            f" after {finished} of {len(processes)} ends of tasks"
+        )
+
+    ###########
+    # WORKERS #
+    ###########
+
+    def _worker(self):
+        """Load tasks until the None sentinel"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                self.__put(None)
+                return
+            try:
+                self.__load(*task)
+            except Exception as e:
+                self.__put(("error", task[0], f"{type(e).__name__}: {e}"))
+
+    def __put(self, item):
+        """Send a result, exit if the bootstrapping process died"""
+        while True:
+            try:
+                self.__results.put(item, timeout=1)
+                return
+            except Full:
+                if os.getppid() != self.__parent:
+                    print("Bootstrap : parent process died, exiting", file=sys.stderr)
+                    os._exit(1)
+
+    def __load(self, name, path, collector, dump_time, until):
+        """Send routes of a dump, and of updates of its collector until `until`"""
+        f = self.filter
+        if path is not None:
+            dump = f._new_stream("ribs", None, None, file=(path, "mrt"))
+        else:
+            dump = f._new_stream("ribs", dump_time, dump_time, collectors=[collector])
+        count = 0
+        batch = []
+        streams = [dump]
+        for stream in streams:
+            for e in stream:
+                msg = f._make_msg(e)
+                if dump_time is None:
+                    dump_time = msg["time"]
+                if collector is not None:
+                    msg["collector"] = collector
+                if not f._process(msg):
+                    continue
+                if msg["type"] != "W" and msg.get("as-path") is None:
+                    continue
+                batch.append(
+                    (
+                        msg["type"],
+                        msg["collector"],
+                        msg["peer_asn"],
+                        msg["peer_address"],
+                        msg["prefix"],
+                        msg.get("as-path"),
+                    )
+                )
+                count += 1
+                if len(batch) >= self.batch_size:
+                    self.__put(("routes", batch))
+                    batch = []
+            # the time of a file dump is known once read
+            if stream is dump and until is not None and dump_time is not None:
+                if until >= dump_time:
+                    streams.append(
+                        f._new_stream(
+                            "updates",
+                            dump_time,
+                            until,
+                            collectors=[collector],
+                            live=not f.isRecord,
+                        )
+                    )
+        if batch:
+            self.__put(("routes", batch))
+        self.__put(("done", name, dump_time, count))
+
+
+def _split(file) -> Tuple[str, str]:
+    """Collector (or None) and path of a `<collector>=<path>` or `<path>` dump"""
+    collector, sep, path = file.partition("=")
+    return (collector, path) if sep else (None, file)
+
+
+def _timestamp(value) -> int:
+    """Unix time of a start time of `bgpfilter.BGPFilter.record_mode()`"""
+    if isinstance(value, str):
+        date = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        return int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+    return int(value)
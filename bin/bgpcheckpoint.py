@@ -0,0 +1,143 @@
+"""
+Checkpoints of the stream position and in-memory state, to resume after a restart
+"""
+
+__all__ = ["BGPCheckpoint"]
+
+import os
+import sys
+import time
+import zlib
+import pickle
+import threading
+
+MAGIC = b"BGPMCKP1"
+"""First bytes of a checkpoint file, followed by a zlib compressed pickle"""
+
+
+class BGPCheckpoint:
+    """
+    Periodic snapshot of what has been sent to outputs
+
+    A checkpoint contains:
+    - `positions`: time of the latest record sent to outputs, by collector
+    - `watermarks`: time of the latest record written to each database,
+        by collector, see `Databases.database.BGPDatabases.watermarks`
+    - `rib`: `bgprib.BGPRib`, if enabled
+    - `history`: `bgphistory.BGPHistory` of the AS graph, if enabled
+
+    The state is pickled by the caller thread, so it is consistent.
+    Compression (zlib releases the GIL) and writing are done by a thread:
+    the file is written next to the previous one, synced, then renamed over it,
+    a crash never leaves a partial checkpoint.
+    """
+
+    def __init__(self, path, interval=60.0):
+        """
+        Args:
+            path (str): Checkpoint file
+            interval (float): Seconds between two checkpoints
+        """
+        self.path = path
+        self.interval = interval
+        self.positions = {}
+        """Time of the latest record sent to outputs, by collector"""
+        self.saved = 0
+        """Number of written checkpoints"""
+        self.__last = time.monotonic()
+        self.__writer = None
+
+    def track(self, record) -> bool:
+        """Move the position of the record collector
+
+        Returns:
+            bool: True if a checkpoint is due
+        """
+        t = record["time"]
+        if t > self.positions.get(record["collector"], 0):
+            self.positions[record["collector"]] = t
+        return time.monotonic() - self.__last >= self.interval
+
+    def save(self, watermarks=None, rib=None, history=None):
+        """Serialize the state now, write it in a thread
+
+        Waits for the previous checkpoint to be written.
+
+        Args:
+            watermarks (dict): {database: {collector: time}}
+            rib (BGPRib): Routing table
+            history (BGPHistory): Past states of the AS graph
+        """
+        state = {
+            "time": time.time(),
+            "positions": dict(self.positions),
+            "watermarks": watermarks or {},
+            "rib": rib,
+            "history": history,
+        }
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        self.wait()
+        self.__last = time.monotonic()
+        self.__writer = threading.Thread(
+            target=self.__write, args=(data,), name="BGP monitor - checkpoint"
+        )
+        self.__writer.start()
+
+    def wait(self):
+        """Wait for the checkpoint being written"""
+        if self.__writer is not None:
+            self.__writer.join()
+            self.__writer = None
+
+    def __write(self, data):
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(MAGIC)
+                f.write(zlib.compress(data, 1))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.saved += 1
+        except OSError as e:
+            print(f"Checkpoint : unable to write {self.path} ({e})", file=sys.stderr)
+
+    def load(self) -> dict:
+        """Read the checkpoint file
+
+        Returns:
+            dict: Saved state, None if there is no checkpoint
+
+        Raises:
+            ValueError: Not a checkpoint or corrupted file
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} isn't a checkpoint file")
+            try:
+                return pickle.loads(zlib.decompress(f.read()))
+            except (zlib.error, pickle.UnpicklingError, EOFError) as e:
+                raise ValueError(f"Corrupted checkpoint {self.path} ({e})")
+
+    @staticmethod
+    def resume_positions(state) -> dict:
+        """Time to resume from, by collector
+
+        A collector resumes from its position, or from an older database
+        watermark if records weren't written to every database.
+
+        Args:
+            state (dict): Result of `BGPCheckpoint.load()`
+
+        Returns:
+            Dict[str, float]: {collector: time}
+        """
+        positions = dict(state["positions"])
+        for marks in state["watermarks"].values():
+            for collector, t in marks.items():
+                if t < positions.get(collector, t):
+                    positions[collector] = t
+        return positions
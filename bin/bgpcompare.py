@@ -0,0 +1,211 @@
+"""
+Streaming comparison of JSON outputs, element by element
+"""
+
+__all__ = ["BGPCompare", "iter_json"]
+
+import json
+import hashlib
+import itertools
+import collections
+
+_decoder = json.JSONDecoder()
+
+
+def iter_json(f, chunk_size=1 << 20):
+    """Iterate over the elements of a JSON array or NDJSON file
+    without loading the whole file
+
+    Args:
+        f (File): Text file, read from its beginning
+        chunk_size (int): Characters read at once
+
+    Yields:
+        dict: Elements of the file
+
+    Raises:
+        json.JSONDecodeError: Invalid file
+    """
+    f.seek(0)
+    buffer = ""
+    position = 0
+    eof = False
+    while True:
+        # skip whitespaces and array separators
+        while position < len(buffer) and buffer[position] in " \t\r\n[],":
+            position += 1
+        if position >= len(buffer):
+            if eof:
+                return
+            buffer = f.read(chunk_size)
+            position = 0
+            eof = not buffer
+            continue
+        try:
+            element, end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # element cut by the end of the chunk
+            chunk = f.read(chunk_size)
+            buffer = buffer[position:] + chunk
+            position = 0
+            eof = not chunk
+            continue
+        yield element
+        position = end
+
+
+class BGPCompare:
+    """
+    Compare a result to an expected result, both read as streams
+
+    Ordered mode: elements are compared by index.
+    Unordered mode: elements may come in another order, as long as they stay
+    in the same time bucket of `BGPCompare.bucket_size` seconds
+    (or the next one). Elements are hashed and counted per bucket,
+    and only unmatched elements are kept in memory.
+
+    The first `BGPCompare.max_diffs` differences are kept in `BGPCompare.diffs`.
+    """
+
+    def __init__(self, unordered=False, bucket_size=60, max_diffs=10):
+        """
+        Args:
+            unordered (bool): Ignore order of elements in a time bucket
+            bucket_size (float): Seconds of a time bucket, in unordered mode
+            max_diffs (int): Number of differences kept for the report
+        """
+        self.unordered = unordered
+        self.bucket_size = bucket_size
+        self.max_diffs = max_diffs
+        self.diffs: list = []
+        """First differences: (index of expected, expected element,
+        index of result, result element). Missing side is None"""
+        self.count = 0
+        """Number of differences"""
+        self.elements = [0, 0]
+        """Number of expected and result elements read"""
+
+    def compare(self, expected, result) -> bool:
+        """
+        Args:
+            expected, result (File): JSON array or NDJSON files
+
+        Returns:
+            bool: True if both files have the same elements
+        """
+        self.diffs = []
+        self.count = 0
+        self.elements = [0, 0]
+        if self.unordered:
+            self.__compare_unordered(iter_json(expected), iter_json(result))
+        else:
+            self.__compare_ordered(iter_json(expected), iter_json(result))
+        return self.count == 0
+
+    def __diff(self, expected_index, expected, result_index, result):
+        self.count += 1
+        if len(self.diffs) < self.max_diffs:
+            self.diffs.append((expected_index, expected, result_index, result))
+
+    def __compare_ordered(self, expected, result):
+        for i, (e, r) in enumerate(itertools.zip_longest(expected, result)):
+            if e is not None:
+                self.elements[0] += 1
+            if r is not None:
+                self.elements[1] += 1
+            if e != r:
+                self.__diff(
+                    i if e is not None else None, e, i if r is not None else None, r
+                )
+
+    #####################
+    # UNORDERED COMPARE #
+    #####################
+
+    def __bucket(self, element):
+        return int(element.get("time", 0) // self.bucket_size)
+
+    @staticmethod
+    def __digest(element):
+        text = json.dumps(element, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def __compare_unordered(self, expected, result):
+        # bucket: digest: [balance, pending elements of the side in excess]
+        # balance > 0: more expected than result elements
+        buckets = collections.defaultdict(dict)
+        latest = [None, None]
+        streams = [enumerate(expected), enumerate(result)]
+        running = [True, True]
+        while any(running):
+            for side in (0, 1):
+                if not running[side]:
+                    continue
+                item = next(streams[side], None)
+                if item is None:
+                    running[side] = False
+                    continue
+                index, element = item
+                self.elements[side] += 1
+                bucket = self.__bucket(element)
+                if latest[side] is None or bucket > latest[side]:
+                    latest[side] = bucket
+                self.__match(buckets[bucket], side, index, element)
+
+            # a bucket is complete once both sides are two buckets later
+            if None not in latest:
+                done = min(latest[s] if running[s] else float("inf") for s in (0, 1))
+                for bucket in [b for b in buckets if b < done - 1]:
+                    self.__flush(buckets.pop(bucket))
+        for bucket in sorted(buckets):
+            self.__flush(buckets[bucket])
+
+    def __match(self, counts, side, index, element):
+        digest = self.__digest(element)
+        entry = counts.get(digest)
+        if entry is None:
+            entry = counts[digest] = [0, collections.deque()]
+        sign = 1 if side == 0 else -1
+        if entry[0] * sign < 0:
+            # matches an element of the other side
+            entry[1].popleft()
+        else:
+            entry[1].append((index, element))
+        entry[0] += sign
+        if entry[0] == 0:
+            del counts[digest]
+
+    def __flush(self, counts):
+        """Report unmatched elements of a complete bucket"""
+        pending = []
+        for balance, elements in counts.values():
+            side = 0 if balance > 0 else 1
+            pending.extend((index, side, element) for index, element in elements)
+        for index, side, element in sorted(pending, key=lambda p: (p[0], p[1])):
+            if side == 0:
+                self.__diff(index, element, None, None)
+            else:
+                self.__diff(None, None, index, element)
+
+    def report(self) -> str:
+        """Differences in text format"""
+        if self.count == 0:
+            return f"Result is as expected ({self.elements[1]} elements)"
+        lines = [
+            f"Result is not as expected: {self.count} differences,"
+            f" {self.elements[0]} expected elements, {self.elements[1]} elements"
+        ]
+        for expected_index, expected, result_index, result in self.diffs:
+            if expected is None:
+                lines.append(f"  unexpected element #{result_index}: {result}")
+            elif result is None:
+                lines.append(f"  missing element #{expected_index}: {expected}")
+            else:
+                lines.append(f"  element #{expected_index} differs:")
+                lines.append(f"    expected: {expected}")
+                lines.append(f"    result:   {result}")
+        if self.count > len(self.diffs):
+            lines.append(f"  ... {self.count - len(self.diffs)} more")
+        return "\n".join(lines)
@@ -13,28 +13,95 @@ import json
 import bgpout
 import datetime
 import ipaddress
-import maxminddb
 import pycountry
-import pybgpstream
 import urllib.request
+from bgpgeo import BGPGeo
+from bgpbootstrap import BGPBootstrap
+from bgplive import BGPLive
+from bgpmetrics import metrics
+from bgpprofile import profiler
+from bgptrie import BGPTrie
+from bgppipeline import BGPPipeline
 from typing import List, Tuple
 
+try:
+    import pybgpstream
+except ImportError:
+    pybgpstream = None
+
+
+def get_collectors(refresh=False):
+    """Identify the collectors that are available
+
+    The BGPStream broker is queried once, the result is cached on disk
+    in `COLLECTORS_CACHE` for `COLLECTORS_TTL` seconds.
+    If the broker can't be reached, an outdated cache is used.
+
+    Args:
+        refresh (bool): Ignore cached lists
+
+    Returns:
+        Dict[str, List[str]]: project: collectors. None if unknown (offline, no cache)
+    """
+    global _collectors
+    if _collectors is not None and not refresh:
+        return _collectors
+
+    cached = None
+    if os.path.isfile(COLLECTORS_CACHE):
+        try:
+            with open(COLLECTORS_CACHE) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            pass
+        else:
+            age = time.time() - os.path.getmtime(COLLECTORS_CACHE)
+            if not refresh and age < COLLECTORS_TTL:
+                _collectors = cached
+                return _collectors
+
+    try:
+        data = json.load(urllib.request.urlopen(COLLECTORS_URL, timeout=10))
+    except (OSError, ValueError) as e:
+        print(
+            f"Unable to retrieve collectors list from broker ({e})"
+            + (", using cached list" if cached else ""),
+            file=sys.stderr,
+        )
+        _collectors = cached
+        return _collectors
 
-def get_collectors():
-    """Query the BGPStream broker and identify the collectors that are available"""
-    data = json.load(urllib.request.urlopen(COLLECTORS_URL))
     result = dict((x, []) for x in PROJECTS)
     for coll in data["data"]["collectors"]:
         p = data["data"]["collectors"][coll]["project"]
         if p in PROJECTS:
             result[p].append(coll)
-    return result
+    try:
+        os.makedirs(os.path.dirname(COLLECTORS_CACHE), exist_ok=True)
+        with open(COLLECTORS_CACHE + ".tmp", "w") as f:
+            json.dump(result, f)
+        os.replace(COLLECTORS_CACHE + ".tmp", COLLECTORS_CACHE)
+    except OSError as e:
+        print(f"Unable to cache collectors list ({e})", file=sys.stderr)
+    _collectors = result
+    return _collectors
 
 
 PROJECT_TYPES = {"ris": "ris-live", "routeviews": "routeviews-stream"}
 PROJECTS = [i for i in PROJECT_TYPES.keys()]
 COLLECTORS_URL = "https://broker.bgpstream.caida.org/v2/meta/collectors"
-COLLECTORS = get_collectors()
+COLLECTORS_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "bgp-monitor",
+    "collectors.json",
+)
+"""Collectors list cached by `get_collectors()`"""
+COLLECTORS_TTL = 86400
+"""Max age in seconds of the cached collectors list"""
+_collectors = None
+PREFIX_STREAM_LIMIT = 1000
+"""Above this number of prefixes, prefix filter is done by `bgptrie.BGPTrie`
+instead of BGPStream or source database"""
 
 
 class BGPFilter:
@@ -48,20 +115,37 @@ class BGPFilter:
         self.__end_time = ""
         self.__asn_filter = None
         self.__ipversion = ""
+        self.__version = None
         self.__prefix_filter = None
         self.__asn_list = None
         self.__prefix_match_type_filter = None
+        self.__prefix_trie = None
+        self.__prefix_in_process = False
         self.__project = PROJECTS[0]
         self.__collectors = None
         self.__countries_filter = None
         self.__data_source = {"source_type": "broker"}
+        self.__resume = None
+        self.__live = None
         self.out: bgpout.BGPOut = None
         """`bgpout.BGPOut()` instance that will receive all records"""
-        # multiprocessing.set_start_method("fork")
-        # self.queue = faster_fifo.Queue()
-        # self.process = multiprocessing.Process(
-        # target=self.process, args=(self.queue,
-        # ), daemon=True)
+        self.workers: int = 1
+        """Number of filtering processes, see `bgppipeline.BGPPipeline`"""
+        self._pipeline = None
+        self.bootstrap: BGPBootstrap = None
+        """Routing table loaded before the stream, disabled if None"""
+        self.geo: BGPGeo = BGPGeo()
+        """Country lookups, see `BGPFilter.country_file`"""
+        self._read = metrics.counter("elements_read")
+        self.__output = metrics.counter("elements_output")
+        self.__filtered = {
+            f: metrics.counter("elements_filtered", filter=f)
+            for f in ["as_number", "ipversion", "prefix", "country"]
+        }
+        self.__enrich_time = metrics.histogram("stage_seconds", stage="enrich")
+        self.__check_time = metrics.histogram("stage_seconds", stage="filter")
+        self.__output_time = metrics.histogram("stage_seconds", stage="output")
+        metrics.collect(self.__collect_metrics)
 
     ###############
     #   GETTERS   #
@@ -90,6 +174,11 @@ class BGPFilter:
         """List of prefixes (CIDR format) to filter"""
         return self.__prefix_filter
 
+    @property
+    def prefix_trie(self) -> BGPTrie:
+        """Trie of filtered prefixes, None if not filtered by prefix"""
+        return self.__prefix_trie
+
     @property
     def asn_filter(self) -> List[str]:
         """List of AS numbers"""
@@ -179,7 +268,7 @@ class BGPFilter:
             raise FileNotFoundError
         if record_type not in ["rib", "upd"]:
             raise ValueError("Input file type must be rib or upd")
-        if record_type == "rib" and file_format in ["mrt", "bmp"]:
+        if record_type == "rib" and file_format not in ["mrt", "bmp"]:
             raise ValueError("Accepted input format types for rib : mrt, bmp")
         elif record_type == "upd" and file_format not in ["mrt", "bmp", "ris-live"]:
             raise ValueError(
@@ -191,6 +280,43 @@ class BGPFilter:
             "file_path": file_path,
         }
 
+    def database_source(self, database):
+        """
+        Use records stored in a database as data source.
+            Records of the record mode interval are read back in time order
+            with `Databases.database.Database.get()`, then filtered and sent to output.
+            The database is started with the stream and stopped with `BGPFilter.stop()`
+
+        Args:
+            database (Database): Database instance, not used as output
+
+        Raises:
+            ValueError: Record mode is disabled
+        """
+        if not self.__isRecord:
+            raise ValueError("Database source requires record mode")
+        self.__data_source = {"source_type": "database", "database": database}
+
+    def resume(self, positions):
+        """
+        Continue a stopped monitor from checkpoint positions, in live mode.
+            The live stream is opened and buffered first, updates from the oldest
+            position to its opening are read from the archives of the project,
+            waiting for them to be published. Records older than the position of
+            their collector are skipped. The buffered live stream follows,
+            see `bgplive.BGPLive`.
+
+        Args:
+            positions (Dict[str, float]): Time by collector,
+                see `bgpcheckpoint.BGPCheckpoint.resume_positions()`
+
+        Raises:
+            ValueError: Record mode or data source isn't the broker
+        """
+        if self.__isRecord or self.__data_source["source_type"] != "broker":
+            raise ValueError("Resume requires live mode and the broker data source")
+        self.__resume = positions or None
+
     @prefix_filter.setter
     def prefix_filter(self, values: Tuple[List[str], str]):
         """
@@ -220,8 +346,8 @@ class BGPFilter:
                     "Match type must be specified and one of ['exact', 'less', 'more',"
                     " 'any']"
                 )
-            for c in cidr_list:
-                ipaddress.ip_network(c)
+            self.__prefix_trie = BGPTrie(cidr_list)
+            self.__prefix_in_process = len(cidr_list) > PREFIX_STREAM_LIMIT
             self.__prefix_match_type_filter = match_type
             self.__prefix_filter = cidr_list
 
@@ -254,10 +380,27 @@ class BGPFilter:
 
     @collectors.setter
     def collectors(self, collectors):
+        """
+        Collectors are checked against the broker list (see `get_collectors()`)
+        only if the data source is the broker. Set data source first.
+
+        Raises:
+            ValueError: Unknown collector
+        """
         if collectors is not None:
-            for c in collectors:
-                if c not in COLLECTORS[self.__project]:
-                    raise ValueError("Collector isn't available or isn't valid.")
+            if self.__data_source["source_type"] == "broker":
+                available = get_collectors()
+                if available is None:
+                    print(
+                        "Collectors list unavailable, collectors are not checked",
+                        file=sys.stderr,
+                    )
+                else:
+                    for c in collectors:
+                        if c not in available[self.__project]:
+                            raise ValueError(
+                                "Collector isn't available or isn't valid."
+                            )
             self.__collectors = collectors
 
     @project.setter
@@ -282,6 +425,7 @@ class BGPFilter:
             version (Integer): Possible values ["4" or "6"]
         """
         self.__ipversion = " and ipversion " + version if version in ["4", "6"] else ""
+        self.__version = int(version) if version in ["4", "6"] else None
 
     ###############
     #   COUNTRY   #
@@ -290,7 +434,7 @@ class BGPFilter:
     @property
     def country_file(self) -> str:
         """Path to the Geo Open MaxMindDB File"""
-        return self.__f_country_path
+        return self.geo.path
 
     @property
     def countries_filter(self) -> List[str]:
@@ -333,14 +477,8 @@ class BGPFilter:
         Args:
             country_file_path (String): Path to Geo Open MaxMindDB File
         """
-        if not os.path.isfile(country_file_path):
-            raise FileNotFoundError
-        self.__f_country_path = country_file_path
-
-        self.__f_country = maxminddb.open_database(
-            self.__f_country_path, maxminddb.MODE_MMAP_EXT
-        )
-        print(f"Loaded Geo Open database : {self.__f_country_path}")
+        self.geo.open(country_file_path)
+        print(f"Loaded Geo Open database : {country_file_path}")
 
     def __check_country(self, e):
         """
@@ -363,13 +501,9 @@ class BGPFilter:
 
         Returns:
             string: country code of the given prefix.
-                None if not found in GeoOpen database
+                None if not found in GeoOpen database or no database is loaded
         """
-        if p is None:
-            return None
-        else:
-            r = self.__f_country.get(p.split("/", 1)[0])
-            return None if r is None else r["country"]["iso_code"]
+        return None if p is None or self.geo.path is None else self.geo.country(p)
 
     ####################
     # PUBLIC FUNCTIONS #
@@ -381,47 +515,161 @@ class BGPFilter:
         Returns:
             (BGPStream)
         """
-        self._stream = pybgpstream.BGPStream(
-            from_time=self.start_time,
-            until_time=self.end_time,
-            data_interface=(
-                "broker"
-                if self.__data_source["source_type"] == "broker"
-                else "singlefile"
-            ),
-            record_type="updates",
-            filter="elemtype announcements withdrawals"
-            + self.__asn_filter
-            + self.__ipversion,
-        )
-
-        if self.__prefix_match_type_filter is not None:
-            self._stream._maybe_add_filter(
-                "prefix-" + self.__prefix_match_type_filter, None, self.__prefix_filter
-            )
-
-        if self.__data_source["source_type"] != "broker":
-            self._stream.set_data_interface_option(
-                "singlefile",
-                self.__data_source["source_type"] + "-file",
-                self.__data_source["file_path"],
-            )
-            self._stream.set_data_interface_option(
-                "singlefile",
-                self.__data_source["source_type"] + "-type",
-                self.__data_source["file_format"],
+        source = self.__data_source
+        if source["source_type"] == "database":
+            self._stream = self.__database_stream()
+            return self._stream
+
+        if source["source_type"] == "broker" and self.__resume is not None:
+            self._stream = self.__resume_stream(self.__live or self.__open_live())
+        elif self.__live is not None:
+            self._stream = self.__live
+        elif source["source_type"] == "broker":
+            self._stream = self._new_stream(
+                "updates",
+                self.start_time,
+                self.end_time,
+                project=(
+                    self.__project if self.__isRecord else PROJECT_TYPES[self.__project]
+                ),
             )
         else:
-            project = (
-                self.__project if self.__isRecord else PROJECT_TYPES[self.__project]
+            self._stream = self._new_stream(
+                "ribs" if source["source_type"] == "rib" else "updates",
+                self.start_time,
+                self.end_time,
+                file=(source["file_path"], source["file_format"]),
             )
-            self._stream._maybe_add_filter("project", project, None)
-            self._stream._maybe_add_filter("collector", None, self.__collectors)
 
         if self.__isRecord:
             self._stream.stream.set_live_mode()
         return self._stream
 
+    def _new_stream(
+        self,
+        record_type,
+        start,
+        end,
+        project=None,
+        collectors=None,
+        file=None,
+        live=False,
+    ):
+        """Build a stream with the used filters, for the main stream or bootstrap
+
+        Args:
+            record_type (str): ribs or updates
+            start (str|int): Beginning of the interval, None for whole files
+            end (str|int): End of the interval
+            project (str): Broker project. Default: `BGPFilter.project`
+            collectors (List[str]): Broker collectors. Default: `BGPFilter.collectors`
+            file (Tuple[str, str]): Path and format of a file read instead of broker
+            live (bool): Wait for archives of the interval not published yet
+
+        Returns:
+            (BGPStream)
+
+        Raises:
+            ImportError: pybgpstream isn't installed
+        """
+        if pybgpstream is None:
+            raise ImportError("Reading BGPStream requires pybgpstream")
+        elemtypes = "ribs" if record_type == "ribs" else "announcements withdrawals"
+        stream = pybgpstream.BGPStream(
+            from_time=start,
+            until_time=end,
+            data_interface="broker" if file is None else "singlefile",
+            record_type=record_type,
+            filter=f"elemtype {elemtypes}" + self.__asn_filter + self.__ipversion,
+        )
+
+        if self.__prefix_match_type_filter is not None and not self.__prefix_in_process:
+            stream._maybe_add_filter(
+                "prefix-" + self.__prefix_match_type_filter, None, self.__prefix_filter
+            )
+
+        if file is not None:
+            kind = "rib" if record_type == "ribs" else "upd"
+            stream.set_data_interface_option("singlefile", kind + "-file", file[0])
+            stream.set_data_interface_option("singlefile", kind + "-type", file[1])
+        else:
+            stream._maybe_add_filter("project", project or self.__project, None)
+            stream._maybe_add_filter("collector", None, collectors or self.__collectors)
+        if live:
+            stream.stream.set_live_mode()
+        return stream
+
+    def __open_live(self) -> BGPLive:
+        """Open the live stream before a catch-up from archives, it starts now
+
+        Returns:
+            BGPLive: Buffered live stream
+        """
+        since = int(time.time())
+        self.__start_time = since
+        stream = self._new_stream(
+            "updates", since, self.end_time, project=PROJECT_TYPES[self.__project]
+        )
+        return BGPLive(stream, since)
+
+    def __resume_stream(self, live):
+        """Archived updates from checkpoint positions to the opening of the live
+        stream, then live stream
+
+        Args:
+            live (BGPLive): Live stream opened before
+
+        Yields:
+            BGPElem
+        """
+        positions = self.__resume
+        since = int(min(positions.values()))
+        if since < live.since:
+            start = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(since))
+            print(f"Resuming from {start}", file=sys.stderr)
+            archive = self._new_stream("updates", since, live.since - 1, live=True)
+            for e in live.catch_up(archive):
+                if e.time >= positions.get(e.collector, 0):
+                    yield e
+        print("Resumed, switching to live stream", file=sys.stderr)
+        yield from live
+
+    def __database_stream(self):
+        """Read records from the source database
+
+        Collectors, countries, AS numbers and prefixes are filtered by the database,
+        AS numbers negation and ip version are checked here.
+
+        Yields:
+            dict: records in time order
+        """
+        database = self.__data_source["database"]
+        database.start()
+        asn_list = self.__asn_list or []
+        as_numbers = [a for a in asn_list if not a.startswith("_")]
+        excluded = [a[1:] for a in asn_list if a.startswith("_")]
+        prefixes = None if self.__prefix_in_process else self.__prefix_filter
+        records = database.get(
+            self.start_time,
+            self.end_time,
+            collectors=self.__collectors,
+            countries=self.__countries_filter,
+            as_numbers=as_numbers or None,
+            prefixes=prefixes,
+            match=self.__prefix_match_type_filter or "exact",
+        )
+        for r in records:
+            if r["source"] is not None and r["source"] in excluded:
+                self.__filtered["as_number"].inc()
+                continue
+            if (
+                self.__version is not None
+                and ipaddress.ip_network(r["prefix"]).version != self.__version
+            ):
+                self.__filtered["ipversion"].inc()
+                continue
+            yield r
+
     def cpt_update(self):
         """For debugging. Print time each 100000 elem"""
         if not hasattr(self, "timer"):
@@ -438,13 +686,108 @@ class BGPFilter:
             # sys.stderr.write(f"Queue size : {self.queue.qsize()}")
             self.timer["ot"] = self.timer["nt"]
 
+    def _make_msg(self, e):
+        """Convert a BGPElem into a record dict
+
+        Args:
+            e (BGPElem): element retrieved from BGPStream
+
+        Returns:
+            dict: record with BGPElem attributes and fields.
+                Records read from a database are returned as is
+        """
+        if self.__data_source["source_type"] == "database":
+            return e
+        msg = {
+            "type": e.type,
+            "time": e.time,
+            "peer_address": e.peer_address,
+            "peer_asn": e.peer_asn,
+            "collector": e.collector,
+            "project": e.project,
+            "router": e.router,
+            "router_ip": e.router_ip,
+        }
+        msg |= e.fields
+        if "communities" in msg:
+            # JSON encoders don't handle sets, sorted for a stable output
+            msg["communities"] = sorted(msg["communities"], key=str)
+        return msg
+
+    def _enrich(self, msg):
+        """Add country code and source AS to a record"""
+        if self.__data_source["source_type"] == "database":
+            return  # stored with country code and source AS
+        msg["country_code"] = self.__country_by_prefix(msg["prefix"])
+        msg["source"] = msg["as-path"].split()[-1] if "as-path" in msg else None
+
+    def _check(self, msg) -> bool:
+        """Return True if the record must be sent to output"""
+        if self.__prefix_in_process and not self.__prefix_trie.match(
+            msg["prefix"], self.__prefix_match_type_filter
+        ):
+            self.__filtered["prefix"].inc()
+            return False
+        if not self.__check_country(msg):
+            self.__filtered["country"].inc()
+            return False
+        return True
+
+    def _process(self, msg) -> bool:
+        """Enrich and check a record, both stages are timed if `metrics.timing`
+
+        Returns:
+            bool: True if the record must be sent to output
+        """
+        if metrics.timing:
+            t0 = time.perf_counter()
+            self._enrich(msg)
+            t1 = time.perf_counter()
+            keep = self._check(msg)
+            self.__enrich_time.observe(t1 - t0)
+            self.__check_time.observe(time.perf_counter() - t1)
+        else:
+            self._enrich(msg)
+            keep = self._check(msg)
+        if keep:
+            self.__output.inc()
+        return keep
+
+    def __collect_metrics(self, m):
+        stats = self.geo.stats()
+        if not stats["hits"] + stats["network_hits"] + stats["misses"]:
+            return  # unused copy, in pipeline reader or sink
+        for result in ["hits", "network_hits", "misses"]:
+            m.gauge("geo_lookups", result=result, process=m.process).set(stats[result])
+        m.gauge("geo_reloads", process=m.process).set(stats["reloads"])
+
     def start(self):
         """
         Start retrieving stream/records and filtering them
         - Download and load Geo-Open database
         - Build Stream
         - Send messages to bgpout.py
+
+        If `BGPFilter.workers` is greater than 1,
+        work is split across processes with `bgppipeline.BGPPipeline`
+
+        If `BGPFilter.bootstrap` is set, the routing table is loaded first.
+        In live mode, the live stream is opened and buffered before, the bootstrap
+        replays updates until its opening, see `bgplive.BGPLive`
         """
+        catch_up = self.bootstrap is not None or self.__resume is not None
+        if catch_up and not self.__isRecord:
+            if self.__data_source["source_type"] == "broker":
+                self.__live = self.__open_live()
+        if self.bootstrap is not None:
+            self.bootstrap.run()
+        if self.workers > 1:
+            print("Loading stream...")
+            self._build_stream()
+            print(f"Starting with {self.workers} workers")
+            self._pipeline = BGPPipeline(self, self.workers)
+            self._pipeline.run()
+            return
 
         self.out.start()
         print("Loading stream...")
@@ -454,27 +797,27 @@ class BGPFilter:
 
         for e in self._stream:
             self.cpt_update()
-            msg = {
-                "type": e.type,
-                "time": e.time,
-                "peer_address": e.peer_address,
-                "peer_asn": e.peer_asn,
-                "collector": e.collector,
-                "project": e.project,
-                "router": e.router,
-                "router_ip": e.router_ip,
-            }
-            msg |= e.fields
-            msg["country_code"] = self.__country_by_prefix(msg["prefix"])
-            msg["source"] = msg["as-path"].split()[-1] if "as-path" in msg else None
-
-            if self.__check_country(msg):
-                self.out.iteration(msg)
+            self._read.inc()
+            msg = self._make_msg(e)
+            if self._process(msg):
+                if metrics.timing:
+                    t = time.perf_counter()
+                    self.out.iteration(msg)
+                    self.__output_time.observe(time.perf_counter() - t)
+                else:
+                    self.out.iteration(msg)
 
     def stop(self):
         """
         Close output (JSON, Databases, etc) and stop BGPStream
         """
         print("Stream ended")
+        if self._pipeline is not None:
+            self._pipeline.stop()
         self.out.stop()
+        profiler.stop()
+        if self._pipeline is None and self.geo.path is not None:
+            print(f"Country cache : {self.geo.stats()}", file=sys.stderr)
+        if self.__data_source["source_type"] == "database":
+            self.__data_source["database"].stop()
         exit(0)
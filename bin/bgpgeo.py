@@ -0,0 +1,316 @@
+"""
+Country lookups in the Geo Open MaxMind database, with a cache,
+and background refresh of the database file
+"""
+
+__all__ = ["BGPGeo", "GeoRefresher"]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import ipaddress
+import maxminddb
+import collections
+import urllib.error
+import urllib.request
+import email.utils
+from bgptrie import BGPTrie
+
+_MISSING = object()
+
+
+class BGPGeo:
+    """
+    Country of prefixes from a Geo Open MaxMind database
+
+    Two LRU caches sit in front of the database reader:
+    - prefixes: country of already seen prefixes, keyed by prefix string
+    - networks: networks returned by the database, in a `bgptrie.BGPTrie`.
+        A new prefix whose address is in a known network doesn't need a lookup,
+        so subnets of a cached prefix are hits.
+
+    Caches are cleared when the database is (re)loaded.
+    The file is checked every `BGPGeo.watch_interval` seconds during lookups
+    and reloaded if it was replaced, for example by `GeoRefresher`.
+    Each process watches the file, so forked pipeline workers reload it too.
+    """
+
+    def __init__(self, cache_size=100000, watch_interval=60):
+        """
+        Args:
+            cache_size (int): Max number of entries of each cache, 0 disables caches
+            watch_interval (float): Seconds between two checks of the file,
+                None disables reloads
+        """
+        self.cache_size: int = cache_size
+        """Max number of prefixes and networks kept in cache"""
+        self.path: str = None
+        """Path of the loaded database"""
+        self.hits = 0
+        """Prefixes found in prefixes cache"""
+        self.network_hits = 0
+        """Prefixes found in networks cache"""
+        self.misses = 0
+        """Prefixes looked up in the database"""
+        self.evictions = 0
+        """Entries removed from caches because they were full"""
+        self.reloads = 0
+        """Number of times the file was reloaded after a change"""
+        self.watch_interval: float = watch_interval
+        """Seconds between two checks of the file"""
+        self.__reader = None
+        self.__stamp = None
+        self.__next_check = float("inf")
+        self.__clear()
+
+    def open(self, path):
+        """Load a database, replace the current one and clear caches
+
+        Args:
+            path (str): Path to Geo Open MaxMindDB File
+
+        Raises:
+            FileNotFoundError
+        """
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        stamp = self.__file_stamp(path)
+        reader = maxminddb.open_database(path, maxminddb.MODE_MMAP_EXT)
+        old, self.__reader = self.__reader, reader
+        self.path = path
+        self.__stamp = stamp
+        self.__clear()
+        if self.watch_interval is not None:
+            self.__next_check = time.monotonic() + self.watch_interval
+        if old is not None:
+            old.close()
+
+    @staticmethod
+    def __file_stamp(path):
+        st = os.stat(path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def __check_file(self):
+        """Reload the database if the file was replaced"""
+        self.__next_check = time.monotonic() + self.watch_interval
+        try:
+            if self.__file_stamp(self.path) == self.__stamp:
+                return
+            self.open(self.path)
+        except (OSError, maxminddb.InvalidDatabaseError) as e:
+            print(f"Geo Open : reload failed, {e}", file=sys.stderr)
+            return
+        self.reloads += 1
+        print(f"Reloaded Geo Open database : {self.path}", file=sys.stderr)
+
+    def __clear(self):
+        self.__prefixes = collections.OrderedDict()
+        self.__networks = collections.OrderedDict()
+        self.__trie = BGPTrie()
+
+    def stats(self) -> dict:
+        """Cache counters"""
+        return {
+            "hits": self.hits,
+            "network_hits": self.network_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "reloads": self.reloads,
+            "prefixes": len(self.__prefixes),
+            "networks": len(self.__networks),
+        }
+
+    def country(self, prefix):
+        """
+        Args:
+            prefix (str): CIDR format. Example: 130.0.192.0/21
+
+        Returns:
+            string: country code of the network address of the prefix.
+                None if not found in Geo Open database
+        """
+        if time.monotonic() >= self.__next_check:
+            self.__check_file()
+
+        country = self.__prefixes.get(prefix, _MISSING)
+        if country is not _MISSING:
+            self.__prefixes.move_to_end(prefix)
+            self.hits += 1
+            return country
+
+        address = prefix.split("/", 1)[0]
+        network = self.__trie.longest_value(address)
+        if network is not None:
+            network, country = network
+            self.__networks.move_to_end(network)
+            self.network_hits += 1
+        else:
+            record, length = self.__reader.get_with_prefix_len(address)
+            self.misses += 1
+            country = None
+            if record is not None and "country" in record:
+                country = record["country"].get("iso_code")
+            if self.cache_size <= 0:
+                return country
+            network = str(ipaddress.ip_network((address, length), strict=False))
+            self.__trie.insert(network, (network, country))
+            self.__networks[network] = None
+            if len(self.__networks) > self.cache_size:
+                self.__trie.delete(self.__networks.popitem(last=False)[0])
+                self.evictions += 1
+
+        self.__prefixes[prefix] = country
+        if len(self.__prefixes) > self.cache_size:
+            self.__prefixes.popitem(last=False)
+            self.evictions += 1
+        return country
+
+
+class GeoRefresher:
+    """
+    Keep a local copy of the Geo Open database up to date
+
+    The file is downloaded again when it is older than `GeoRefresher.max_age`
+    and the server has a newer one (ETag and Last-Modified are checked).
+    A download goes to a temporary file, is validated,
+    then atomically replaces the local copy. Running lookups are never blocked,
+    `BGPGeo` instances pick the new file up by themselves.
+    """
+
+    def __init__(self, url, path, interval=86400, max_age=86400, timeout=60):
+        """
+        Args:
+            url (str): Download URL, http(s):// or file://
+            path (str): Path of the local copy
+            interval (float): Seconds between two checks in background
+            max_age (float): Local copy younger than that isn't checked
+            timeout (float): Connection timeout in seconds
+        """
+        self.url = url
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.timeout = timeout
+        self.downloads = 0
+        """Number of times the local copy was replaced"""
+        self.not_modified = 0
+        """Checks that found the local copy up to date"""
+        self.errors = 0
+        """Failed checks or downloads"""
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    @property
+    def etag_path(self) -> str:
+        """File storing the ETag of the local copy"""
+        return self.path + ".etag"
+
+    def is_recent(self) -> bool:
+        """Local copy exists and is younger than `GeoRefresher.max_age`"""
+        try:
+            return time.time() - os.path.getmtime(self.path) < self.max_age
+        except OSError:
+            return False
+
+    def refresh(self, force=False) -> bool:
+        """Download the database if the local copy is outdated
+
+        Args:
+            force (bool): Check the server even if the local copy is recent
+
+        Returns:
+            bool: True if the local copy was replaced
+
+        Raises:
+            urllib.error.URLError, OSError: Download failed
+            maxminddb.InvalidDatabaseError: Downloaded file isn't a valid database
+        """
+        if not force and self.is_recent():
+            return False
+        request = urllib.request.Request(self.url)
+        exists = os.path.isfile(self.path)
+        if exists:
+            mtime = os.path.getmtime(self.path)
+            request.add_header(
+                "If-Modified-Since", email.utils.formatdate(mtime, usegmt=True)
+            )
+            if os.path.isfile(self.etag_path):
+                with open(self.etag_path) as f:
+                    request.add_header("If-None-Match", f.read().strip())
+
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.not_modified += 1
+                return False
+            raise
+        with response:
+            # servers or schemes (file://) ignoring conditional requests
+            etag = response.headers.get("ETag")
+            modified = response.headers.get("Last-Modified")
+            if exists and modified and not etag:
+                date = email.utils.parsedate_to_datetime(modified).timestamp()
+                if date <= mtime:
+                    self.not_modified += 1
+                    return False
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=directory, prefix=".geo-open-", suffix=".tmp", delete=False
+            ) as tmp:
+                shutil.copyfileobj(response, tmp, 1 << 20)
+
+        try:
+            maxminddb.open_database(tmp.name, maxminddb.MODE_MMAP).close()
+            os.replace(tmp.name, self.path)
+        finally:
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+        if etag:
+            with open(self.etag_path, "w") as f:
+                f.write(etag)
+        elif os.path.isfile(self.etag_path):
+            os.remove(self.etag_path)
+        self.downloads += 1
+        return True
+
+    def stats(self) -> dict:
+        """Refresh counters"""
+        return {
+            "downloads": self.downloads,
+            "not_modified": self.not_modified,
+            "errors": self.errors,
+        }
+
+    ##############
+    # BACKGROUND #
+    ##############
+
+    def start(self):
+        """Check now, then every `GeoRefresher.interval` seconds, in a thread"""
+        self.__stopped.clear()
+        self.__thread = threading.Thread(
+            target=self.__run, daemon=True, name="BGP monitor - geo open refresh"
+        )
+        self.__thread.start()
+
+    def stop(self):
+        """Stop background checks, an ongoing download is abandoned"""
+        self.__stopped.set()
+
+    def __run(self):
+        while True:
+            try:
+                if self.refresh():
+                    print(
+                        f"Downloaded Geo Open database : {self.path}", file=sys.stderr
+                    )
+            except Exception as e:
+                self.errors += 1
+                print(f"Geo Open : refresh failed, {e}", file=sys.stderr)
+            if self.__stopped.wait(self.interval):
+                return
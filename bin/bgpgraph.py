@@ -1,64 +1,310 @@
-import time
-import networkx as nx
+"""
+AS level topology, maintained from the current routes of `bgprib.BGPRib`
+"""
 
-import matplotlib.pyplot as plt
+__all__ = ["BGPGraph"]
+
+from array import array
+from typing import List, Set, Tuple, Union
+from bgphistory import BGPHistory, EDGE, ORIGIN
+
+LARGE_DEGREE = 64
+"""Above this number of neighbors, a node keeps them in a set instead of an array,
+removals of edges of large transit networks don't scan thousands of neighbors"""
 
 
 class BGPGraph:
-    def __init__(self):
-        self.graph = nx.Graph()
-        self.cpt = 0
+    """
+    Undirected graph of AS adjacencies found in current AS paths
+
+    An edge exists while at least one route (peer, prefix) has an AS path
+    containing it. The RIB counts routes of each distinct AS path, the graph
+    counts distinct AS paths of each edge: edges of a path are added when its
+    first route appears and released when its last route goes, so a withdrawal
+    removes only links no other route supports.
+
+    Storage is integer indexed:
+    - each AS number gets a node index
+    - reference counts of edges are keyed by one integer
+        (low node index << 32 | high node index)
+    - neighbors of a node are an array of node indexes, a set for nodes
+        of more than `LARGE_DEGREE` neighbors
+
+    Prepending is ignored, AS paths aren't linked across AS sets.
+    Updated by the thread updating the RIB, not thread safe either.
+
+    With `BGPGraph.keep_history()`, queries accept an `at` time:
+    changes of edges and of prefix origins are kept by `bgphistory.BGPHistory`.
+    """
+
+    def __init__(self, rib=None):
+        """
+        Args:
+            rib (BGPRib): Routing table followed by the graph
+        """
+        self.rib = None
+        """Followed routing table, see `BGPGraph.attach()`"""
+        self.history: BGPHistory = None
+        """Past states of edges and origins, see `BGPGraph.keep_history()`"""
+        self.__node_index = {}
+        self.__nodes = array("I")
+        self.__adjacent: List[Union[array, set]] = []
+        self.__edges = {}
+        self.__active = 0
+        if rib is not None:
+            self.attach(rib)
+
+    def attach(self, rib):
+        """Follow a routing table, edges are rebuilt from its current paths
+
+        Kept history is restarted from the new table.
+
+        Args:
+            rib (BGPRib): Routing table, a restored checkpoint for instance
+        """
+        if self.rib is not None:
+            self.rib.listeners.remove(self._path_changed)
+            self.rib.origin_listeners.remove(self._origin_changed)
+        history = self.history
+        self.__init__()
+        self.rib = rib
+        for path in rib.paths():
+            self._path_changed(path, True)
+        rib.listeners.append(self._path_changed)
+        rib.origin_listeners.append(self._origin_changed)
+        if history is not None:
+            # restarted from the new table, changes wouldn't apply to old snapshots
+            self.keep_history(history.interval, history.retention)
+
+    def keep_history(self, interval=3600, retention=172800):
+        """Record changes of edges and prefix origins, for queries in the past
+
+        Args:
+            interval (float): Seconds of record time between two snapshots,
+                the most changes replayed by a query
+            retention (float): Seconds of history kept
+
+        Raises:
+            ValueError: No RIB attached
+        """
+        if self.rib is None:
+            raise ValueError("History requires an attached RIB")
+        nodes, edges = self.__nodes, []
+        for k in self.__edges:
+            a, b = nodes[k >> 32], nodes[k & 0xFFFFFFFF]
+            edges += (a << 32 | b, b << 32 | a)
+        origins = [p << 32 | asn for p, asn in self.rib.origin_pairs() if asn]
+        sets = {EDGE: edges, ORIGIN: origins}
+        self.history = BGPHistory(interval, retention, sets, self.rib.time)
+
+    def stats(self) -> dict:
+        """Graph counters"""
+        return {"nodes": self.__active, "edges": len(self.__edges)}
+
+    ###########
+    # UPDATES #
+    ###########
+
+    def _path_changed(self, path, added):
+        """Add or release edges of an AS path, see `bgprib.BGPRib.listeners`"""
+        index, edges = self.__node_index, self.__edges
+        for a, b in _edges(path):
+            i, j = index.get(a), index.get(b)
+            if added:
+                if i is None:
+                    i = self.__node(a)
+                if j is None:
+                    j = self.__node(b)
+                key = i << 32 | j if i < j else j << 32 | i
+                count = edges.get(key)
+                if count:
+                    edges[key] = count + 1
+                else:
+                    edges[key] = 1
+                    self.__adjust(i, j, True)
+            else:
+                key = i << 32 | j if i < j else j << 32 | i
+                count = edges[key] - 1
+                if count:
+                    edges[key] = count
+                else:
+                    del edges[key]
+                    self.__adjust(i, j, False)
+
+    def __node(self, asn) -> int:
+        i = self.__node_index[asn] = len(self.__nodes)
+        self.__nodes.append(asn)
+        self.__adjacent.append(array("I"))
+        return i
 
-    def get(self, as_numbers=None, prefixes=None, match_type="more", countries=None):
-        pass
+    def _origin_changed(self, prefix, origin, added):
+        """Log a change of origin, see `bgprib.BGPRib.origin_listeners`"""
+        if self.history is not None and origin:
+            self.history.log(self.rib.time, ORIGIN, prefix << 32 | origin, added)
 
-    def filter_edge(self, n1, n2):
-        return not (self.graph[n1][n2]["prefix"] == self.del_prefix)
+    def __adjust(self, i, j, added):
+        """Add or remove an edge from neighbors of both nodes"""
+        if self.history is not None:
+            a, b = self.__nodes[i], self.__nodes[j]
+            self.history.log(self.rib.time, EDGE, a << 32 | b, added)
+            self.history.log(self.rib.time, EDGE, b << 32 | a, added)
+        for a, b in ((i, j), (j, i)):
+            adjacent = self.__adjacent[a]
+            if added:
+                if not adjacent:
+                    self.__active += 1
+                if isinstance(adjacent, set):
+                    adjacent.add(b)
+                else:
+                    adjacent.append(b)
+                    if len(adjacent) > LARGE_DEGREE:
+                        self.__adjacent[a] = set(adjacent)
+            else:
+                adjacent.remove(b)
+                if not adjacent:
+                    self.__active -= 1
 
-    def update(self, record) -> bool:
+    ###########
+    # QUERIES #
+    ###########
+
+    def __past(self) -> BGPHistory:
+        if self.history is None:
+            raise ValueError("No history, see BGPGraph.keep_history()")
+        return self.history
+
+    def neighbors(self, asn, at=None) -> List[int]:
+        """AS numbers adjacent to an AS number
+
+        Args:
+            asn (int): AS number
+            at (float): Time in the past, requires `BGPGraph.keep_history()`
+
+        Raises:
+            ValueError: No history, or time before its start
         """
-        Insert or delete paths in the graph.
-        Return true if graph changed.
+        if at is not None:
+            asn = int(asn)
+            edges = self.__past().keys(EDGE, at, asn << 32, asn + 1 << 32)
+            return [k & 0xFFFFFFFF for k in edges]
+        i = self.__node_index.get(int(asn))
+        if i is None:
+            return []
+        return [self.__nodes[j] for j in self.__adjacent[i]]
+
+    def degree(self, asn) -> int:
+        """Number of neighbors of an AS number"""
+        i = self.__node_index.get(int(asn))
+        return 0 if i is None else len(self.__adjacent[i])
+
+    def weight(self, a, b) -> int:
+        """Number of distinct AS paths containing the edge, 0 if absent"""
+        i, j = self.__node_index.get(int(a)), self.__node_index.get(int(b))
+        if i is None or j is None:
+            return 0
+        return self.__edges.get(i << 32 | j if i < j else j << 32 | i, 0)
+
+    def get(self, as_numbers=None, prefixes=None, at=None) -> List[Tuple[int, int]]:
+        """Edges of the graph, as (lower AS number, higher AS number)
+
+        Args:
+            as_numbers (List[int]): Keep edges of these AS numbers
+            prefixes (List[str]): Keep edges of current AS paths of these prefixes
+            at (float): Time in the past, requires `BGPGraph.keep_history()`.
+                AS paths aren't kept, prefixes can't be used
+
+        Returns:
+            List[Tuple[int, int]]: Sorted edges
+
+        Raises:
+            ValueError: No history, time before its start, or prefixes and time
         """
-        return True
-        self.cpt += 1
-        if record["type"] == "A":
-            # Node attributes : prefix, time
-            nx.add_path(
-                self.graph,
-                record["path"].split(),
-                **{record["prefix"]: record["time"], "source": record["source"]}
-            )
-            nx.set_node_attributes(
-                self.graph, {record["source"]: {record["prefix"]: record["time"]}}
-            )
+        if at is not None:
+            if prefixes is not None:
+                raise ValueError("Past edges can't be filtered by prefixes")
+            if as_numbers is None:
+                # both directions are kept, sorted keys give sorted edges
+                edges = [
+                    (k >> 32, k & 0xFFFFFFFF) for k in self.__past().keys(EDGE, at)
+                ]
+                return [e for e in edges if e[0] < e[1]]
+            edges = {
+                (min(a, b), max(a, b))
+                for a in {int(a) for a in as_numbers}
+                for b in self.neighbors(a, at)
+            }
+        elif prefixes is not None:
+            edges = {
+                (min(a, b), max(a, b))
+                for prefix in prefixes
+                for route in self.rib.get(prefix)
+                for a, b in _edges(route["as-path"])
+            }
+            if as_numbers is not None:
+                keep = {int(a) for a in as_numbers}
+                edges = {e for e in edges if e[0] in keep or e[1] in keep}
+        elif as_numbers is not None:
+            edges = {
+                (min(a, b), max(a, b))
+                for a in {int(a) for a in as_numbers}
+                for b in self.neighbors(a)
+            }
         else:
-            # remove path
-            # check if edge has any prefix/ as ? if yes remove the edge
-            self.del_prefix = record["prefix"]
-
-            # for n, v in self.graph.nodes(data=True):
-            #    if self.graph.edges[record["prefix"]]:
-            #        del self.graph.edges[n][v]
-
-            # for self.graph.edges()
-            # view = nx.subgraph_view(self.graph, filter_edge=self.filter_edge)
-            # for e in view.edges():
-            #    print
-            # print(self.graph)
-            # print(view)
-            # nx.draw(view, with_labels=True, font_weight="bold")
-            # nx.draw_shell(view, with_labels=True, font_weight="bold")
-            # plt.show()
-            # time.sleep(10)
-
-        # Check if graph is updated
-
-        if self.cpt == 50:
-            nx.draw(self.graph, with_labels=True, font_weight="bold")
-            nx.draw_shell(self.graph, with_labels=True, font_weight="bold")
-            plt.show()
-            time.sleep(10)
-            exit(0)
-
-        return True
+            nodes = self.__nodes
+            edges = {(nodes[k >> 32], nodes[k & 0xFFFFFFFF]) for k in self.__edges}
+            edges = {(min(a, b), max(a, b)) for a, b in edges}
+        return sorted(edges)
+
+    def origins(self, prefix, at=None) -> Set[int]:
+        """Origin AS numbers of a prefix, see `bgprib.BGPRib.origins()`
+
+        Args:
+            prefix (str): Prefix in CIDR format
+            at (float): Time in the past, requires `BGPGraph.keep_history()`
+
+        Raises:
+            ValueError: No history, or time before its start
+        """
+        if at is None:
+            return self.rib.origins(prefix)
+        history = self.__past()
+        p = self.rib.prefix_index(prefix)
+        if p is None:
+            return set()
+        return {k & 0xFFFFFFFF for k in history.keys(ORIGIN, at, p << 32, p + 1 << 32)}
+
+    def prefixes(self, asn, at=None) -> List[str]:
+        """Prefixes originated by an AS number, see `bgprib.BGPRib.prefixes()`
+
+        Args:
+            asn (int): AS number
+            at (float): Time in the past, requires `BGPGraph.keep_history()`
+
+        Raises:
+            ValueError: No history, or time before its start
+        """
+        if at is None:
+            return self.rib.prefixes(asn)
+        asn = int(asn)
+        return [
+            self.rib.prefix_at(k >> 32)
+            for k in self.__past().keys(ORIGIN, at)
+            if k & 0xFFFFFFFF == asn
+        ]
+
+
+def _edges(path):
+    """Adjacent AS numbers of an AS path, without prepending or AS sets
+
+    Yields:
+        Tuple[int, int]
+    """
+    prev = None
+    for token in path.split():
+        if not token.isdigit():
+            prev = None  # AS set or confederation
+            continue
+        asn = int(token)
+        if prev is not None and asn != prev:
+            yield prev, asn
+        prev = asn
@@ -0,0 +1,168 @@
+"""
+Past states of the AS graph and of prefix origins, from snapshots and change logs
+"""
+
+__all__ = ["BGPHistory"]
+
+import zlib
+import bisect
+from array import array
+from typing import List
+
+EDGE = 1
+"""AS graph edges, in both directions, key: AS << 32 | neighbor AS"""
+ORIGIN = 2
+"""Prefix origins, key: prefix index << 32 | origin AS"""
+KINDS = (EDGE, ORIGIN)
+
+
+class BGPHistory:
+    """
+    Changes of a state made of sets of 64 bits keys, one set by kind:
+    AS graph edges and (prefix, origin AS) pairs, see `EDGE` and `ORIGIN`
+
+    Only transitions are logged (a key appears or disappears), with the time
+    of the record causing it, in three arrays: times, keys and operations.
+    Every `BGPHistory.interval` seconds of record time, the current sets are
+    saved as a snapshot: sorted keys, zlib compressed.
+
+    A past state is rebuilt from the latest snapshot before the time, with
+    logged changes up to the time: at most one interval of changes is replayed.
+    Keys sharing their high 32 bits are contiguous in a snapshot, a query for
+    a range of keys only reads them and the changes in the range.
+    Changes are applied in arrival order, records of late collectors
+    may be misplaced by a few seconds around snapshots.
+
+    Snapshots and changes older than `BGPHistory.retention` are dropped,
+    when a snapshot is taken.
+    """
+
+    def __init__(self, interval=3600, retention=172800, sets=None, time=0):
+        """
+        Args:
+            interval (float): Seconds of record time between two snapshots
+            retention (float): Seconds of history kept
+            sets (Dict[int, Iterable[int]]): Current keys by kind
+            time (float): Time of the current state
+        """
+        self.interval = interval
+        self.retention = retention
+        self.__times = array("d")
+        self.__keys = array("Q")
+        self.__ops = array("b")
+        self.__offset = 0
+        self.__snapshots = []
+        self.__snapshot_times = []
+        sets = sets or {}
+        self.__save(time, {kind: sorted(sets.get(kind, ())) for kind in KINDS})
+
+    def log(self, time, kind, key, added):
+        """Add a change, take a snapshot if the last one is too old
+
+        Args:
+            time (float): Time of the record causing the change
+            kind (int): `EDGE` or `ORIGIN`
+            key (int): Key of the edge or origin
+            added (bool): Key appears or disappears
+        """
+        self.__times.append(time)
+        self.__keys.append(key)
+        self.__ops.append(kind if added else -kind)
+        if time - self.__snapshot_times[-1] >= self.interval:
+            self.snapshot(time)
+
+    def snapshot(self, time):
+        """Save the current state, taken by `BGPHistory.log()` every interval
+
+        Args:
+            time (float): Time of the current state
+        """
+        self.__save(time, {kind: self.keys(kind) for kind in KINDS})
+
+    @property
+    def start(self) -> float:
+        """Time of the oldest state available"""
+        return self.__snapshot_times[0]
+
+    def stats(self) -> dict:
+        """Number of snapshots and changes, bytes of snapshots and changes"""
+        size = sum(len(d) for _, _, sets in self.__snapshots for d in sets.values())
+        return {
+            "snapshots": len(self.__snapshots),
+            "changes": len(self.__keys),
+            "bytes": size + len(self.__keys) * 17,
+        }
+
+    ############
+    # REBUILDS #
+    ############
+
+    def keys(self, kind, at=None, low=0, high=1 << 64) -> List[int]:
+        """Keys of a kind at a time, within a range
+
+        Args:
+            kind (int): `EDGE` or `ORIGIN`
+            at (float): Time, None for the current state
+            low (int): Lowest key
+            high (int): Keys are lower than it
+
+        Returns:
+            List[int]: Sorted keys
+
+        Raises:
+            ValueError: Time before the start of the history
+        """
+        if at is None:
+            n = len(self.__snapshots) - 1
+        else:
+            n = bisect.bisect_right(self.__snapshot_times, at) - 1
+            if n < 0:
+                raise ValueError(f"History starts at {self.start}")
+        _, position, sets = self.__snapshots[n]
+        snapshot = array("Q")
+        snapshot.frombytes(zlib.decompress(sets[kind]))
+        start = position - self.__offset
+        end = (
+            self.__snapshots[n + 1][1] - self.__offset
+            if n + 1 < len(self.__snapshots)
+            else len(self.__keys)
+        )
+        # latest change of each key wins, changes are transitions
+        changed = {}
+        times, keys, ops = self.__times, self.__keys, self.__ops
+        for i in range(start, end):
+            op = ops[i]
+            if op != kind and op != -kind:
+                continue
+            key = keys[i]
+            if low <= key < high and (at is None or times[i] <= at):
+                changed[key] = op > 0
+        first = bisect.bisect_left(snapshot, low)
+        last = bisect.bisect_left(snapshot, high, first)
+        if not changed:
+            return snapshot[first:last].tolist()
+        result = [k for k in snapshot[first:last] if k not in changed]
+        result += [k for k, added in changed.items() if added]
+        result.sort()  # nearly sorted, linear
+        return result
+
+    def __save(self, time, sets):
+        """Add a snapshot of the current sorted keys, drop expired ones"""
+        sets = {kind: _pack(keys) for kind, keys in sets.items()}
+        self.__snapshots.append((time, self.__offset + len(self.__keys), sets))
+        self.__snapshot_times.append(time)
+        # keep the latest snapshot before the retention limit, base of older queries
+        n = bisect.bisect_right(self.__snapshot_times, time - self.retention) - 1
+        if n > 0:
+            del self.__snapshots[:n]
+            del self.__snapshot_times[:n]
+            drop = self.__snapshots[0][1] - self.__offset
+            del self.__times[:drop]
+            del self.__keys[:drop]
+            del self.__ops[:drop]
+            self.__offset += drop
+
+
+def _pack(keys) -> bytes:
+    """Sorted keys as compressed bytes, sorted keys compress well"""
+    return zlib.compress(array("Q", keys).tobytes(), 1)
@@ -0,0 +1,123 @@
+"""
+Live stream opened before a catch-up from archives, buffered until it is read
+"""
+
+__all__ = ["BGPLive"]
+
+import sys
+import time
+import types
+import threading
+from bgpqueue import BGPQueue
+
+
+class BGPLive:
+    """
+    Live feeds (ris-live, routeviews-stream) can't go back in time. To catch up
+    from archives (resume, bootstrap) without losing updates, the live stream is
+    opened first and read by a thread into a `bgpqueue.BGPQueue`, spilled to disk
+    when large, while archived updates before `BGPLive.since` are replayed.
+    Live elements older than `BGPLive.since` are skipped, archives contain them.
+
+    Elements are copied when read: BGPStream reuses them for the next ones.
+    """
+
+    GAP: int = 900
+    """Seconds without archived updates of a collector before `BGPLive.since`
+    reported as a possible gap, RIS and RouteViews publish updates every 5 to 15
+    minutes"""
+
+    def __init__(self, stream, since, maxsize=100000, spill_dir=None):
+        """
+        Args:
+            stream (BGPStream): Live stream, read from now on
+            since (int): Unix time the live stream was opened at
+            maxsize (int): Max number of elements kept in memory
+            spill_dir (str): Directory of the spill file. Default: system temporary
+        """
+        self.since: int = since
+        """Live elements start at this time, archives are replayed before it"""
+        self.skipped: int = 0
+        """Number of live elements older than `BGPLive.since`"""
+        self.__stream = stream
+        self.__queue = BGPQueue(maxsize, "spill", spill_dir)
+        self.__error = None
+        self.__thread = threading.Thread(
+            target=self.__read, daemon=True, name="BGP monitor - live stream"
+        )
+        self.__thread.start()
+
+    def stats(self) -> dict:
+        """Buffer counters, see `bgpqueue.BGPQueue.stats()`"""
+        return {"skipped": self.skipped} | self.__queue.stats()
+
+    def catch_up(self, archive):
+        """Elements of an archive stream before `BGPLive.since`
+
+        Collectors whose last archived update is more than `BGPLive.GAP` seconds
+        older than `BGPLive.since` are reported once the archive ends.
+
+        Args:
+            archive (BGPStream): Archived updates, ending before `BGPLive.since`
+
+        Yields:
+            BGPElem
+        """
+        last = {}
+        for e in archive:
+            if e.time < self.since:
+                last[e.collector] = e.time
+                yield e
+        late = {c: t for c, t in last.items() if t < self.since - self.GAP}
+        for collector, t in sorted(late.items()):
+            print(
+                f"Live stream : archives of {collector} end {self.since - t:.0f}s"
+                " before the live stream, updates in between may be missing",
+                file=sys.stderr,
+            )
+
+    def __iter__(self):
+        """Buffered live elements, then new ones
+
+        Yields:
+            BGPElem
+
+        Raises:
+            RuntimeError: Reading the live stream failed
+        """
+        print(
+            f"Live stream : switching, {self.__queue.qsize()} elements buffered"
+            f" in {time.time() - self.since:.0f}s",
+            file=sys.stderr,
+        )
+        while True:
+            batch = self.__queue.get_batch(1000)
+            if not batch and self.__queue.closed and not self.__queue.qsize():
+                break
+            yield from batch
+        if self.__error is not None:
+            raise RuntimeError(f"Live stream failed : {self.__error}")
+
+    def __read(self):
+        """Copy elements of the live stream to the buffer until it ends"""
+        try:
+            for e in self.__stream:
+                if e.time < self.since:
+                    self.skipped += 1
+                    continue
+                self.__queue.put(
+                    types.SimpleNamespace(
+                        type=e.type,
+                        time=e.time,
+                        peer_address=e.peer_address,
+                        peer_asn=e.peer_asn,
+                        collector=e.collector,
+                        project=e.project,
+                        router=e.router,
+                        router_ip=e.router_ip,
+                        fields=e.fields,
+                    )
+                )
+        except Exception as e:
+            self.__error = f"{type(e).__name__}: {e}"
+        self.__queue.close()
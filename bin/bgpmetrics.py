@@ -0,0 +1,345 @@
+"""
+Runtime metrics: counters, gauges and histograms,
+exposed in Prometheus text format over HTTP and as JSON log lines
+"""
+
+__all__ = ["BGPMetrics", "metrics"]
+
+import sys
+import json
+import time
+import bisect
+import threading
+import http.server
+
+DEFAULT_BUCKETS = (
+    0.000001,
+    0.000005,
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+"""Upper bounds in seconds of histogram buckets"""
+
+HELP = {
+    "elements_read": "Elements read from the data source",
+    "elements_filtered": "Elements dropped, by filter",
+    "elements_output": "Elements sent to outputs",
+    "stage_seconds": "Processing time of an element or a batch, by stage",
+    "database_records": "Records sent to a database",
+    "database_flush_seconds": (
+        "Time to hand a batch to a database client, queued by clickhouse"
+    ),
+    "database_write_seconds": (
+        "Time to write a batch to a database server:"
+        " clickhouse insert, quest line protocol send"
+    ),
+    "queue_depth": "Items waiting in a queue",
+    "queue_dropped": "Items dropped by a full queue",
+    "geo_lookups": "Country lookups, by result of the cache",
+    "geo_reloads": "Geo Open database reloads",
+    "rib_size": "Routes, prefixes, paths, peers and origins in the RIB",
+    "graph_size": "Nodes and edges of the AS graph",
+    "history_size": "Snapshots, changes and bytes of the AS graph history",
+}
+"""Description of known metrics"""
+
+
+class Counter:
+    """Monotonic value, sent as a delta by forked processes"""
+
+    type = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def take(self):
+        value, self.value = self.value, 0
+        return value
+
+    def merge(self, value):
+        self.value += value
+
+
+class Gauge:
+    """Last known value"""
+
+    type = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def take(self):
+        return self.value
+
+    def merge(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Count of observations by bucket, with their sum"""
+
+    type = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def take(self):
+        value = (self.counts, self.sum)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        return value
+
+    def merge(self, value):
+        counts, total = value
+        for i, c in enumerate(counts):
+            self.counts[i] += c
+        self.sum += total
+
+
+class BGPMetrics:
+    """
+    Registry of metrics, named without the `BGPMetrics.namespace` prefix
+
+    Hot paths keep the metric objects returned by `BGPMetrics.counter()`,
+    `BGPMetrics.gauge()` and `BGPMetrics.histogram()`, updates are plain
+    attribute changes. Values only known by other objects (queue depths,
+    cache statistics) are read by callbacks registered with
+    `BGPMetrics.collect()`, when metrics are exported.
+
+    Forked processes (see `bgppipeline.BGPPipeline`) send their values
+    to the parent with `BGPMetrics.push()`: counters and histograms as deltas,
+    gauges as last values.
+    """
+
+    def __init__(self, namespace="bgp_monitor"):
+        self.namespace = namespace
+        self.process = "main"
+        """Label of values set by collectors in this process"""
+        self.timing = False
+        """Measure processing time of every element, see `stage_seconds`"""
+        self.__metrics = {}
+        self.__collectors = []
+        self.__lock = threading.Lock()
+        self.__queue = None
+        self.__last_push = 0.0
+        self.__server = None
+        self.__stopped = threading.Event()
+
+    def __get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.__metrics.get(key)
+        if metric is None:
+            with self.__lock:
+                metric = self.__metrics.setdefault(key, cls())
+        return metric
+
+    def counter(self, name, **labels) -> Counter:
+        return self.__get(Counter, name, labels)
+
+    def gauge(self, name, **labels) -> Gauge:
+        return self.__get(Gauge, name, labels)
+
+    def histogram(self, name, **labels) -> Histogram:
+        return self.__get(Histogram, name, labels)
+
+    def collect(self, callback):
+        """Register a function called before export, to update gauges"""
+        self.__collectors.append(callback)
+
+    def reset(self):
+        """Forget values of the parent, in a newly forked process"""
+        with self.__lock:
+            for key, metric in list(self.__metrics.items()):
+                if metric.type == "gauge":
+                    del self.__metrics[key]
+                else:
+                    metric.take()
+
+    ##########
+    # MERGES #
+    ##########
+
+    def share(self, queue):
+        """Send values of forked processes to the parent through a queue
+
+        Args:
+            queue (multiprocessing.Queue): Created before forking
+        """
+        self.__queue = queue
+
+    def push(self, force=False, interval=1.0):
+        """Send values to the parent process at most every interval seconds"""
+        now = time.monotonic()
+        if self.__queue is None or (not force and now - self.__last_push < interval):
+            return
+        self.__last_push = now
+        self.__run_collectors()
+        with self.__lock:
+            items = list(self.__metrics.items())
+        delta = [(key, metric.type, metric.take()) for key, metric in items]
+        self.__queue.put(delta)
+
+    def merge(self, delta):
+        """Add values sent by `BGPMetrics.push()`"""
+        classes = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+        for (name, labels), kind, value in delta:
+            metric = self.__get(classes[kind], name, dict(labels))
+            metric.merge(value)
+
+    def __run_collectors(self):
+        for callback in self.__collectors:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Metrics : collector failed, {e}", file=sys.stderr)
+
+    ###########
+    # EXPORTS #
+    ###########
+
+    def snapshot(self) -> dict:
+        """Current values: {name: [(labels, value, type)]}
+
+        Histograms values are {"count", "sum", "buckets": {upper bound: count}},
+        with cumulative counts
+        """
+        self.__run_collectors()
+        with self.__lock:
+            items = sorted(self.__metrics.items(), key=lambda item: item[0])
+        result = {}
+        for (name, labels), metric in items:
+            if metric.type == "histogram":
+                cumulative, total = [], 0
+                for c in metric.counts:
+                    total += c
+                    cumulative.append(total)
+                bounds = [str(b) for b in metric.buckets] + ["+Inf"]
+                value = {
+                    "count": total,
+                    "sum": metric.sum,
+                    "buckets": dict(zip(bounds, cumulative)),
+                }
+            else:
+                value = metric.value
+            result.setdefault(name, []).append((dict(labels), value, metric.type))
+        return result
+
+    def prometheus(self) -> str:
+        """Values in Prometheus text exposition format"""
+        lines = []
+        for name, values in self.snapshot().items():
+            full = f"{self.namespace}_{name}"
+            kind = values[0][2]
+            if kind == "counter":
+                full += "_total"
+            if name in HELP:
+                lines.append(f"# HELP {full} {HELP[name]}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value, _ in values:
+                if kind == "histogram":
+                    for bound, count in value["buckets"].items():
+                        text = _labels(dict(labels, le=bound))
+                        lines.append(f"{full}_bucket{text} {count}")
+                    lines.append(f"{full}_sum{_labels(labels)} {value['sum']}")
+                    lines.append(f"{full}_count{_labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{full}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def json(self) -> str:
+        """Values as a JSON line, histograms summarized by count and sum"""
+        values = {"time": round(time.time(), 3)}
+        for name, items in self.snapshot().items():
+            for labels, value, kind in items:
+                key = name + "".join(f",{k}={v}" for k, v in sorted(labels.items()))
+                if kind == "histogram":
+                    value = {"count": value["count"], "sum": round(value["sum"], 6)}
+                values[key] = value
+        return json.dumps(values, separators=(",", ":"))
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve `/metrics` over HTTP in a thread
+
+        Raises:
+            OSError: Port can't be bound
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(
+            target=self.__server.serve_forever,
+            daemon=True,
+            name="BGP monitor - metrics server",
+        ).start()
+
+    def log(self, interval, file=sys.stderr):
+        """Write `BGPMetrics.json()` lines every interval seconds, in a thread"""
+
+        def run():
+            while not self.__stopped.wait(interval):
+                print(self.json(), file=file, flush=True)
+
+        threading.Thread(
+            target=run, daemon=True, name="BGP monitor - metrics log"
+        ).start()
+
+    def stop(self):
+        """Stop HTTP server and log thread"""
+        self.__stopped.set()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server = None
+
+
+def _labels(labels) -> str:
+    """Labels in Prometheus format: {name="value",...}"""
+    if not labels:
+        return ""
+    text = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return "{" + text + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = BGPMetrics()
+"""Metrics of the monitor, shared by every module"""
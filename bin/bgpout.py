@@ -4,19 +4,73 @@ Ingest all records, queue, reformat, send, publish, save them.
 
 __all__ = ["BGPOut"]
 
-import os
 import sys
 import json
+import threading
 from typing import TextIO
+from bgpqueue import BGPQueue
+from bgpwriter import BGPWriter
+from bgpparquet import BGPParquet
+from bgpcompare import BGPCompare
+from bgpmetrics import metrics
+from bgprib import BGPRib
+from bgpcheckpoint import BGPCheckpoint
 from Databases.database import BGPDatabases
 from bgpgraph import BGPGraph
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
+
+class BGPEncoder:
+    """
+    Encode bgp elements to JSON text, with sorted keys
+
+    Formats:
+    - `pretty`: indented, for JSON array files
+    - `compact`: single line without spaces, for NDJSON files and console
+
+    Backends:
+    - `json`: standard library. Pretty format uses the pure Python encoder
+    - `orjson`: faster, optional dependency. Pretty format is indented by 2 spaces
+
+    Elements must only contain JSON types, sets must be converted to lists
+    (see `bgpfilter.BGPFilter._make_msg()`)
+    """
+
+    FORMATS = ["pretty", "compact"]
+    BACKENDS = ["json", "orjson"]
+
+    def __init__(self, format="pretty", backend="json"):
+        """
+        Raises:
+            ValueError: Invalid format or backend
+            ImportError: orjson backend is not installed
+        """
+        if format not in BGPEncoder.FORMATS:
+            raise ValueError(f"Invalid JSON format. Valid formats : {self.FORMATS}")
+        if backend not in BGPEncoder.BACKENDS:
+            raise ValueError(f"Invalid JSON backend. Valid backends : {self.BACKENDS}")
+        if backend == "orjson" and orjson is None:
+            raise ImportError("orjson backend requires orjson package")
+        self.format = format
+        self.backend = backend
+        if backend == "orjson":
+            option = orjson.OPT_SORT_KEYS
+            if format == "pretty":
+                option |= orjson.OPT_INDENT_2
+
+            def encode(e):
+                return orjson.dumps(e, option=option).decode()
+
+        elif format == "pretty":
+            encode = json.JSONEncoder(sort_keys=True, indent=4).encode
+        else:
+            encode = json.JSONEncoder(sort_keys=True, separators=(",", ":")).encode
+        self.encode = encode
+        """(Callable[[dict], str]): Encode a bgp element"""
 
 
 class BGPOut:
@@ -34,10 +88,32 @@ class BGPOut:
         """print to console"""
         self.isQueue: bool = False
         """Enable queue, can prevent from blocking BGPStream"""
+        self.queue_size: int = 100000
+        """Max number of records kept in memory by the queue"""
+        self.queue_policy: str = "block"
+        """Policy when the queue is full, see `bgpqueue.BGPQueue`"""
+        self.queue: BGPQueue = None
+        """Queue between `BGPOut.iteration()` and outputs, if enabled"""
+        self.__error = None
         self.isStarted: bool = False
         """Is the stream started or not"""
+        self.__json_format = "pretty"
+        self.__json_backend = "json"
+        self.__json_empty = True
+        self.__encoders = None
+        self.writer: BGPWriter = None
+        """Rotated NDJSON files output, disabled if None"""
+        self.archive: BGPParquet = None
+        """Parquet archive output, disabled if None"""
+        self.rib: BGPRib = None
+        """Current routes of every peer, disabled if None"""
+        self.checkpoint: BGPCheckpoint = None
+        """Periodic checkpoints of positions and RIB, disabled if None"""
+        self.compare = BGPCompare()
+        """Comparison of the JSON file output to `BGPOut.expected_result`"""
         self.databases = BGPDatabases({})
-        self.graph = BGPGraph()
+        self.graph: BGPGraph = None
+        """AS graph following `BGPOut.rib`, disabled if None"""
 
     #######################
     #   GETTERS/SETTERS   #
@@ -66,6 +142,33 @@ class BGPOut:
         if hasattr(json_out, "write"):
             self.__json_out = json_out
 
+    @property
+    def json_format(self) -> str:
+        """
+        JSON output format, see `BGPEncoder`
+        - `pretty`: JSON array of indented elements
+        - `compact`: NDJSON, one element per line.
+            Console and file outputs share the same encoded text
+        """
+        return self.__json_format
+
+    @json_format.setter
+    def json_format(self, json_format):
+        BGPEncoder(json_format, self.__json_backend)
+        self.__json_format = json_format
+        self.__encoders = None
+
+    @property
+    def json_backend(self) -> str:
+        """JSON encoder, `json` or `orjson`, see `BGPEncoder`"""
+        return self.__json_backend
+
+    @json_backend.setter
+    def json_backend(self, json_backend):
+        BGPEncoder(self.__json_format, json_backend)
+        self.__json_backend = json_backend
+        self.__encoders = None
+
     @property
     def expected_result(self) -> TextIO:
         """Expected result when execution end"""
@@ -90,54 +193,211 @@ class BGPOut:
         - Init json output if specified
         - Start queue if enabled
         """
-        if self.__json_out:
+        if self.__json_out and self.__json_format == "pretty":
             self.__json_out.write("[")
+            self.__json_empty = True
+        self.databases.start()
+        if self.isQueue:
+            self.queue = BGPQueue(self.queue_size, self.queue_policy)
+            self.__consumer = threading.Thread(
+                target=self.__consume, name="BGP monitor - output queue"
+            )
+            self.__consumer.start()
+        metrics.collect(self.__collect_metrics)
         self.isStarted = True
 
+    def __collect_metrics(self, m):
+        if self.queue is not None:
+            stats = self.queue.stats()
+            m.gauge("queue_depth", queue="output").set(stats["depth"])
+            m.gauge("queue_dropped", queue="output").set(stats["dropped"])
+        if self.rib is not None:
+            for key, value in self.rib.stats().items():
+                m.gauge("rib_size", table=key).set(value)
+        if self.graph is not None:
+            for key, value in self.graph.stats().items():
+                m.gauge("graph_size", table=key).set(value)
+            if self.graph.history is not None:
+                for key, value in self.graph.history.stats().items():
+                    m.gauge("history_size", table=key).set(value)
+
     def stop(self):
         """
         - Set state as stopped
         - Close file output
         - Check if result is as expected
+
+        Raises:
+            Exception: Error of an output in the queue consumer thread,
+                raised once outputs are closed
         """
         if self.isStarted:
             self.isStarted = False
+            if self.queue is not None:
+                self.queue.close()
+                self.__consumer.join()
+                print(f"Output queue : {self.queue.stats()}", file=sys.stderr)
             self.databases.stop()
-            self.closeFile(self.__json_out)
+            if self.checkpoint is not None:
+                self.save_checkpoint()
+                self.checkpoint.wait()
+                print(f"Checkpoint : {self.checkpoint.path}", file=sys.stderr)
+            if self.writer is not None:
+                self.writer.close()
+                print(f"NDJSON output : {self.writer.stats()}", file=sys.stderr)
+            if self.archive is not None:
+                self.archive.close()
+                print(f"Parquet output : {self.archive.stats()}", file=sys.stderr)
+            if self.rib is not None:
+                print(f"RIB : {self.rib.stats()}", file=sys.stderr)
+            if self.graph is not None:
+                print(f"AS graph : {self.graph.stats()}", file=sys.stderr)
+                if self.graph.history is not None:
+                    print(f"History : {self.graph.history.stats()}", file=sys.stderr)
+            if self.__json_format == "pretty":
+                self.closeFile(self.__json_out)
+            elif self.__json_out not in [None, sys.stdout]:
+                self.__json_out.close()
+            else:
+                sys.stdout.flush()
             if self.__expected_result:
                 print("Testing result: ")
-                with open(self.__json_out.name, "r+") as js:
-                    print(
-                        "Result is as expected"
-                        if checkFiles(js, self.__expected_result)
-                        else "Result is not as expected"
-                    )
-
-    def iteration(self, e):
-        """Iterate over queue to process each bgp element"""
-        # self.redis.xadd()
-
-        if self.verbose:
-            print(json.dumps(e, sort_keys=True, cls=SetEncoder) + "\n", flush=True)
-        if self.json_out:
-            self.json_out.write(
-                json.dumps(e, sort_keys=True, indent=4, cls=SetEncoder) + ",\n"
+                with open(self.__json_out.name, "r") as js:
+                    self.compare.compare(self.__expected_result, js)
+                    print(self.compare.report())
+            if self.__error is not None:
+                raise self.__error
+
+    def save_checkpoint(self):
+        """Sync databases, then checkpoint positions, watermarks, RIB and history"""
+        self.databases.sync()
+        history = self.graph.history if self.graph is not None else None
+        self.checkpoint.save(dict(self.databases.watermarks), self.rib, history)
+
+    def resume(self, state):
+        """Restore a checkpoint read by `bgpcheckpoint.BGPCheckpoint.load()`
+
+        The RIB is restored if enabled, the AS graph is rebuilt from it,
+        with its history if kept.
+        Positions of collectors
+        missing from the new stream are kept in next checkpoints.
+        """
+        if self.rib is not None and state.get("rib") is not None:
+            self.rib = state["rib"]
+            if self.graph is not None:
+                self.graph.attach(self.rib)
+                if self.graph.history is not None and state.get("history"):
+                    self.graph.history = state["history"]
+        if self.checkpoint is not None:
+            self.checkpoint.positions = dict(state["positions"])
+
+    def serialize(self, e):
+        """Encode a bgp element for text outputs (console, JSON file, NDJSON files)
+
+        The element is encoded once in compact format, shared by every output
+        using it, and once more for a pretty JSON file
+
+        Returns:
+            Tuple[str, str, str]: console, JSON file and NDJSON files texts,
+                None if output is disabled
+        """
+        if self.__encoders is None:
+            compact = BGPEncoder("compact", self.__json_backend)
+            pretty = BGPEncoder("pretty", self.__json_backend)
+            self.__encoders = (compact.encode, pretty.encode)
+        compact_encode, pretty_encode = self.__encoders
+
+        compact_text = None
+        if (
+            self.verbose
+            or self.writer is not None
+            or (self.__json_out and self.__json_format == "compact")
+        ):
+            compact_text = compact_encode(e)
+        file_text = None
+        if self.__json_out:
+            file_text = (
+                compact_text if self.__json_format == "compact" else pretty_encode(e)
             )
-        self.graph.update(e)
+        return (
+            compact_text if self.verbose else None,
+            file_text,
+            compact_text if self.writer is not None else None,
+        )
+
+    def iteration(self, e, encoded=None):
+        """Process a bgp element
+
+        Args:
+            e (dict): bgp element
+            encoded (Tuple[str, str, str]): `BGPOut.serialize()` result if already done
+
+        Raises:
+            Exception: Error of an output in the queue consumer thread
+        """
+        if self.queue is not None:
+            try:
+                self.queue.put((e, encoded))
+            except ValueError:  # closed by a failed consumer
+                if self.__error is None:
+                    raise
+            if self.__error is not None:
+                raise self.__error
+        else:
+            self.__process(e, encoded)
+
+    def __consume(self):
+        """Process queued elements until the queue is closed and empty.
+        On an output error, the queue is closed so the producer doesn't wait
+        on a full queue, and the error is raised by `BGPOut.iteration()`"""
+        try:
+            while True:
+                batch = self.queue.get_batch()
+                if not batch and self.queue.closed:
+                    return
+                for e, encoded in batch:
+                    self.__process(e, encoded)
+        except Exception as e:
+            self.__error = e
+            self.queue.close()
+
+    def __process(self, e, encoded):
+        """Send a bgp element to every output"""
+        console_text, json_text, ndjson_text = encoded or self.serialize(e)
+
+        if console_text is not None:
+            print(console_text + "\n", flush=True)
+        if json_text is not None:
+            if self.__json_format == "compact":
+                self.json_out.write(json_text + "\n")
+            elif self.__json_empty:
+                self.json_out.write(json_text)
+                self.__json_empty = False
+            else:
+                self.json_out.write(",\n" + json_text)
+        if ndjson_text is not None:
+            self.writer.write(ndjson_text)
+        if self.archive is not None:
+            self.archive.save(e)
+        if self.rib is not None:
+            self.rib.update(e)
+        if self.checkpoint is not None and self.checkpoint.track(e):
+            self.save_checkpoint()
         self.databases.save(e)
 
     def closeFile(self, file):
-        """Close a JSON file
+        """Close the JSON array of a file, close the file unless it is sys.stdout
 
         Args:
             file (File): The file to close
         """
-        if file == sys.stdout or file is None:
+        if file is None:
             return
-        file.seek(file.tell() - 1, os.SEEK_SET)
-        file.truncate()
-        file.write("]")
-        file.close()
+        file.write("]\n")
+        if file == sys.stdout:
+            file.flush()
+        else:
+            file.close()
 
 
 def checkFiles(f1, f2) -> bool:
@@ -148,8 +408,4 @@ def checkFiles(f1, f2) -> bool:
         f1, f2 (File): json files
     """
 
-    f1.seek(0, os.SEEK_SET)
-    f2.seek(0, os.SEEK_SET)
-    json1 = json.load(f1)
-    json2 = json.load(f2)
-    return json1 == json2
+    return BGPCompare().compare(f1, f2)
@@ -0,0 +1,205 @@
+"""
+Parquet archive output, partitioned by hour and collector
+"""
+
+__all__ = ["BGPParquet"]
+
+import os
+import sys
+import datetime
+from Databases.query import parse_path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+COLUMNS = [
+    "time",
+    "type",
+    "peer_address",
+    "peer_asn",
+    "project",
+    "router",
+    "router_ip",
+    "prefix",
+    "next_hop",
+    "as_path",
+    "communities",
+    "country_code",
+    "source",
+]
+RECORD_KEYS = {
+    "type": "type",
+    "peer_address": "peer_address",
+    "peer_asn": "peer_asn",
+    "project": "project",
+    "router": "router",
+    "router_ip": "router_ip",
+    "prefix": "prefix",
+    "next_hop": "next-hop",
+    "country_code": "country_code",
+}
+"""Columns copied from records as is: record key"""
+DICTIONARY_COLUMNS = ["type", "project", "router", "country_code"]
+"""Columns with few distinct values, dictionary encoded"""
+
+
+def schema():
+    """Arrow schema of archived records"""
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("time", pa.timestamp("us", tz="UTC")),
+            ("type", dictionary),
+            ("peer_address", pa.string()),
+            ("peer_asn", pa.uint32()),
+            ("project", dictionary),
+            ("router", dictionary),
+            ("router_ip", pa.string()),
+            ("prefix", pa.string()),
+            ("next_hop", pa.string()),
+            ("as_path", pa.list_(pa.uint32())),
+            ("communities", pa.list_(pa.string())),
+            ("country_code", dictionary),
+            ("source", pa.uint32()),
+        ]
+    )
+
+
+class BGPParquet:
+    """
+    Archive records in Parquet files
+
+    Files are partitioned by hour (UTC) and collector, hive style:
+        <root>/date=YYYY-MM-DD/hour=HH/collector=<collector>/part-<id>.parquet
+    The collector is only stored in the path, read the archive as a dataset
+    with hive partitioning to get it back as a column.
+
+    Records are kept in memory by partition and written as Arrow record batches
+    of `BGPParquet.batch_size` rows. A file is readable once closed:
+    files of an hour are closed when records two hours later arrive,
+    or when the output stops.
+    """
+
+    def __init__(self, root, batch_size=100000, compression="zstd"):
+        """
+        Args:
+            root (str): Root directory of the archive
+            batch_size (int): Rows of a partition kept in memory before writing
+            compression (str): Parquet compression codec
+
+        Raises:
+            ImportError: pyarrow is not installed
+        """
+        if pa is None:
+            raise ImportError("Parquet output requires pyarrow package")
+        self.root = root
+        self.batch_size = batch_size
+        self.compression = compression
+        self.schema = schema()
+        self.rows = 0
+        """Number of rows written"""
+        self.files = 0
+        """Number of files closed"""
+        self.__partitions = {}
+        self.__latest_hour = None
+        self.__start = int(datetime.datetime.now().timestamp())
+        self.__sequence = 0
+
+    def stats(self) -> dict:
+        """Archive counters"""
+        return {
+            "rows": self.rows,
+            "files": self.files,
+            "open_files": len(self.__partitions),
+        }
+
+    def save(self, record):
+        """Add a record to its partition, write the partition if full"""
+        time = datetime.datetime.fromtimestamp(record["time"], datetime.timezone.utc)
+        hour = time.replace(minute=0, second=0, microsecond=0)
+        key = (hour, record.get("collector"))
+        partition = self.__partitions.get(key)
+        if partition is None:
+            partition = self.__partitions[key] = {"writer": None, "rows": []}
+        partition["rows"].append(record)
+        if len(partition["rows"]) >= self.batch_size:
+            self.__write(key, partition)
+
+        if self.__latest_hour is None or hour > self.__latest_hour:
+            self.__latest_hour = hour
+            self.__close_before(hour - datetime.timedelta(hours=1))
+
+    def __batch(self, records):
+        """Build an Arrow record batch from records"""
+        columns = {c: [] for c in COLUMNS}
+        copied = [c for c in COLUMNS if c in RECORD_KEYS]
+        for r in records:
+            columns["time"].append(int(r["time"] * 1e6))
+            for c in copied:
+                columns[c].append(r.get(RECORD_KEYS[c]))
+            path = r.get("as-path")
+            columns["as_path"].append(parse_path(path) if path is not None else None)
+            communities = r.get("communities")
+            columns["communities"].append(
+                list(communities) if communities is not None else None
+            )
+            source = r.get("source")
+            columns["source"].append(
+                int(source) if source is not None and source.isdigit() else None
+            )
+
+        arrays = []
+        for field in self.schema:
+            if field.name in DICTIONARY_COLUMNS:
+                array = pa.array(columns[field.name], pa.string()).dictionary_encode()
+            else:
+                array = pa.array(columns[field.name], field.type)
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def __write(self, key, partition):
+        if not partition["rows"]:
+            return
+        if partition["writer"] is None:
+            hour, collector = key
+            directory = os.path.join(
+                self.root,
+                f"date={hour:%Y-%m-%d}",
+                f"hour={hour:%H}",
+                f"collector={collector}",
+            )
+            os.makedirs(directory, exist_ok=True)
+            self.__sequence += 1
+            path = os.path.join(
+                directory,
+                f"part-{self.__start}-{os.getpid()}-{self.__sequence}.parquet",
+            )
+            partition["writer"] = pq.ParquetWriter(
+                path, self.schema, compression=self.compression
+            )
+        partition["writer"].write_batch(self.__batch(partition["rows"]))
+        self.rows += len(partition["rows"])
+        partition["rows"] = []
+
+    def __close(self, key):
+        partition = self.__partitions.pop(key)
+        try:
+            self.__write(key, partition)
+        except (OSError, pa.ArrowException) as e:
+            print(f"Parquet output : unable to write {key}, {e}", file=sys.stderr)
+        if partition["writer"] is not None:
+            partition["writer"].close()
+            self.files += 1
+
+    def __close_before(self, hour):
+        """Close partitions of hours before hour"""
+        for key in [k for k in self.__partitions if k[0] < hour]:
+            self.__close(key)
+
+    def close(self):
+        """Write pending records and close every file"""
+        for key in list(self.__partitions):
+            self.__close(key)
@@ -0,0 +1,333 @@
+"""
+Multi-process filtering pipeline used by `bgpfilter.BGPFilter.start()`
+"""
+
+__all__ = ["BGPPipeline"]
+
+import os
+import sys
+import time
+import zlib
+import signal
+import threading
+import multiprocessing
+from queue import Empty, Full
+from multiprocessing.connection import wait
+from bgpmetrics import metrics
+from bgpprofile import profiler
+
+POLL_INTERVAL = 1.0
+"""Seconds between two liveness checks of a process blocked on a queue"""
+
+
+class BGPPipeline:
+    """
+    Split the work of `bgpfilter.BGPFilter` across processes
+
+    - Reader (current process): iterate BGPStream and build records
+    - Workers: enrich, filter and serialize records
+    - Sink: send records to `bgpout.BGPOut` (console, files, graph, databases)
+
+    Records travel between stages as batches through bounded queues,
+    so each batch is pickled once instead of each record. A batch is sent when
+    full, or by a thread of the reader once older than `batch_age`, so a quiet
+    stream doesn't hold records back.
+    Records of a collector are always sent to the same worker,
+    their order is kept until the sink.
+
+    Processes are forked, they share the already configured
+    `BGPFilter` and `BGPOut` instances. There is a single sink on purpose:
+    outputs keep state (RIB, graph, open files, checkpoints) and need records
+    of a collector in order, outputs with their own threads (`--queue`,
+    databases) parallelize writes within the sink.
+
+    If a worker or the sink dies (crash, OOM kill), the reader notices it
+    while reading or waiting on a queue, terminates the other processes
+    and raises RuntimeError. Workers and sink exit if the reader dies.
+    """
+
+    def __init__(
+        self, bgp_filter, workers=2, batch_size=1000, batch_age=0.5, queue_size=64
+    ):
+        """
+        Args:
+            bgp_filter (BGPFilter): Configured filter, stream must be built
+            workers (int): Number of worker processes
+            batch_size (int): Max number of records in a batch
+            batch_age (float): Max age in seconds of a pending batch
+            queue_size (int): Max number of batches waiting in a worker queue
+        """
+        if workers < 1:
+            raise ValueError("Pipeline requires at least one worker")
+        self.filter = bgp_filter
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.isStarted = False
+        """Is the pipeline started or not"""
+
+        ctx = multiprocessing.get_context("fork")
+        self.__worker_queues = [ctx.Queue(queue_size) for _ in range(workers)]
+        self.__sink_queue = ctx.Queue(queue_size * workers)
+        self.__metrics_queue = ctx.Queue()
+        self.__metrics_merger = None
+        self.__processes = [
+            ctx.Process(target=self._worker, args=(i,), name=f"BGP worker {i}")
+            for i in range(workers)
+        ]
+        self.__processes.append(ctx.Process(target=self._sink, name="BGP sink"))
+        self.__batches = [[] for _ in range(workers)]
+        self.__parent = os.getpid()
+        self.__routes = {}
+        self.__lock = threading.Lock()
+        self.__oldest = None
+        self.__error = None
+        self.__stopped = threading.Event()
+        self.__flusher = None
+
+    ##########
+    # READER #
+    ##########
+
+    def run(self):
+        """
+        Start workers and sink, then read the stream until its end.
+        Blocks until every record has been sent to the output.
+        """
+        if self.filter.out.json_out:
+            self.filter.out.json_out.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        for p in self.__processes:
+            p.start()
+        self.isStarted = True
+        metrics.collect(self.__collect_metrics)
+        self.__metrics_merger = threading.Thread(
+            target=self.__merge_metrics, daemon=True, name="BGP monitor - metrics"
+        )
+        self.__metrics_merger.start()
+        self.__flusher = threading.Thread(
+            target=self.__flush_old_batches,
+            daemon=True,
+            name="BGP monitor - pipeline flush",
+        )
+        self.__flusher.start()
+
+        try:
+            for e in self.filter._stream:
+                self.filter.cpt_update()
+                self.filter._read.inc()
+                msg = self.filter._make_msg(e)
+                i = self.__routes.get(msg["collector"])
+                if i is None:
+                    i = zlib.crc32(str(msg["collector"]).encode()) % self.workers
+                    self.__routes[msg["collector"]] = i
+
+                with self.__lock:
+                    if self.__error is not None:
+                        raise self.__error
+                    if self.__oldest is None:
+                        self.__oldest = time.monotonic()
+                    batch = self.__batches[i]
+                    batch.append(msg)
+                    if len(batch) >= self.batch_size:
+                        self.__send(i)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Send pending batches, wait for workers and sink to finish
+
+        Raises:
+            RuntimeError: A worker or the sink died, the others are terminated
+        """
+        if not self.isStarted:
+            return
+        self.isStarted = False
+        try:
+            self.__stopped.set()
+            self.__flusher.join()
+            if self.__error is not None:
+                raise self.__error
+            self.__flush()
+            for q in self.__worker_queues:
+                self.__put(q, None)
+            pending = {p.sentinel: p for p in self.__processes}
+            while pending:
+                for sentinel in wait(list(pending)):
+                    pending.pop(sentinel).join()
+                self.__check()
+        except BaseException:
+            self.__terminate()
+            raise
+        self.__metrics_merger.join()
+
+    def signal(self, signum):
+        """Send a signal to workers and sink, from the reader process only"""
+        if os.getpid() != self.__parent:
+            return
+        for p in self.__processes:
+            if p.pid is not None and p.is_alive():
+                os.kill(p.pid, signum)
+
+    def __send(self, i):
+        self.__put(self.__worker_queues[i], self.__batches[i])
+        self.__batches[i] = []
+
+    def __put(self, queue, item):
+        """Put in a bounded queue, checking processes while it is full"""
+        while True:
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                if os.getpid() == self.__parent:
+                    self.__check()
+                else:
+                    self.__check_reader()
+
+    def __check(self):
+        """
+        Raises:
+            RuntimeError: A worker or the sink exited with an error
+        """
+        for p in self.__processes:
+            if p.exitcode:
+                raise RuntimeError(f"{p.name} exited with code {p.exitcode}")
+
+    def __terminate(self):
+        """Stop processes still running after a failure"""
+        for p in self.__processes:
+            if p.is_alive():
+                p.terminate()
+        for p in self.__processes:
+            p.join()
+        # pending items would never be read, don't wait for them on exit
+        for q in self.__worker_queues + [self.__sink_queue, self.__metrics_queue]:
+            q.cancel_join_thread()
+
+    def __flush(self):
+        for i in range(self.workers):
+            if self.__batches[i]:
+                self.__send(i)
+        self.__oldest = None
+
+    def __flush_old_batches(self):
+        """Send batches older than `batch_age` and check processes, in the reader.
+        An error is raised by the reader with the next record, or by `stop()`"""
+        while not self.__stopped.wait(self.batch_age / 2):
+            with self.__lock:
+                try:
+                    self.__check()
+                    oldest = self.__oldest
+                    if (
+                        oldest is not None
+                        and time.monotonic() - oldest >= self.batch_age
+                    ):
+                        self.__flush()
+                except RuntimeError as e:
+                    self.__error = e
+                    return
+
+    def __merge_metrics(self):
+        """Add metrics of workers and sink until they are all done"""
+        remaining = len(self.__processes)
+        while remaining:
+            delta = self.__metrics_queue.get()
+            if delta is None:
+                remaining -= 1
+            else:
+                metrics.merge(delta)
+
+    def __collect_metrics(self, m):
+        for i, q in enumerate(self.__worker_queues):
+            m.gauge("queue_depth", queue=f"worker-{i}").set(q.qsize())
+        m.gauge("queue_depth", queue="sink").set(self.__sink_queue.qsize())
+
+    def __share_metrics(self, process):
+        """Send metrics of a forked process to the reader"""
+        metrics.reset()
+        metrics.process = process
+        metrics.share(self.__metrics_queue)
+
+    def __close_metrics(self):
+        metrics.push(force=True)
+        self.__metrics_queue.put(None)
+
+    def __get(self, queue):
+        """Next item of a queue, in a worker or the sink"""
+        while True:
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                self.__check_reader()
+
+    def __check_reader(self):
+        """Exit a worker or the sink if the reader died"""
+        if os.getppid() != self.__parent:
+            print(f"{metrics.process} : reader died, exiting", file=sys.stderr)
+            os._exit(1)
+
+    ###########
+    # WORKERS #
+    ###########
+
+    def _worker(self, i):
+        """Enrich, filter and serialize batches from the reader"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.__share_metrics(f"worker-{i}")
+        profiler.after_fork(f"worker-{i}")
+        batch_time = metrics.histogram("stage_seconds", stage="worker_batch")
+        serialize_time = metrics.histogram("stage_seconds", stage="serialize")
+        queue = self.__worker_queues[i]
+        out = self.filter.out
+        while True:
+            batch = self.__get(queue)
+            if batch is None:
+                self.__put(self.__sink_queue, None)
+                if self.filter.geo.path is not None:
+                    print(
+                        f"Worker {i} country cache : {self.filter.geo.stats()}",
+                        file=sys.stderr,
+                    )
+                self.__close_metrics()
+                profiler.stop()
+                return
+            start = time.perf_counter()
+            result = []
+            for msg in batch:
+                if self.filter._process(msg):
+                    if metrics.timing:
+                        t = time.perf_counter()
+                        result.append((msg, out.serialize(msg)))
+                        serialize_time.observe(time.perf_counter() - t)
+                    else:
+                        result.append((msg, out.serialize(msg)))
+            if result:
+                self.__put(self.__sink_queue, result)
+            batch_time.observe(time.perf_counter() - start)
+            metrics.push()
+
+    def _sink(self):
+        """Send records to output until every worker is done"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.__share_metrics("sink")
+        profiler.after_fork("sink")
+        batch_time = metrics.histogram("stage_seconds", stage="output_batch")
+        out = self.filter.out
+        out.start()
+        remaining = self.workers
+        while remaining:
+            batch = self.__get(self.__sink_queue)
+            if batch is None:
+                remaining -= 1
+                continue
+            start = time.perf_counter()
+            for msg, encoded in batch:
+                out.iteration(msg, encoded)
+            batch_time.observe(time.perf_counter() - start)
+            metrics.push()
+        out.stop()
+        self.__close_metrics()
+        profiler.stop()
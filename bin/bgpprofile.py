@@ -0,0 +1,211 @@
+"""
+Profiling of a running monitor, dumped on stop or on SIGUSR1
+"""
+
+__all__ = ["BGPProfiler", "profiler"]
+
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+import tracemalloc
+import collections
+
+
+class BGPProfiler:
+    """
+    Profile every thread of the process, without changes to the hot loops
+
+    Modes:
+    - `sample`: a thread records the stack of every other thread each
+        `BGPProfiler.interval` seconds. Overhead is bounded by the interval
+        and `BGPProfiler.max_depth`. Dumped as collapsed stacks
+        (`<thread>;<frame>;<frame> <count>`), the input format of
+        flamegraph.pl, speedscope or inferno.
+    - `cprofile`: deterministic profile of the main thread (reader loop,
+        outputs without queue). Precise but slows the loop down, dumped as
+        a pstats file and a text summary.
+    - `memory`: tracemalloc traces. Dumped as the top allocations by line,
+        and their growth since the previous dump.
+
+    Nothing runs while no mode is started.
+    Files are named `<UTC time>-<process>.<collapsed|pstats|txt>`.
+    """
+
+    MODES = ["sample", "cprofile", "memory"]
+
+    def __init__(self):
+        self.modes: list = []
+        """Started modes"""
+        self.directory: str = "../profiles"
+        """Directory of dumped files"""
+        self.interval: float = 0.01
+        """Seconds between two samples of `sample` mode"""
+        self.max_depth: int = 64
+        """Max frames kept in a sampled stack"""
+        self.top: int = 25
+        """Number of lines of text summaries"""
+        self.process: str = "main"
+        """Name of the process, in file names"""
+        self.__samples = collections.Counter()
+        self.__labels = {}
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__sampler = None
+        self.__cprofile = None
+        self.__snapshot = None
+
+    def start(self, modes):
+        """
+        Args:
+            modes (List[str]): Subset of `BGPProfiler.MODES`
+
+        Raises:
+            ValueError: Unknown mode
+        """
+        for mode in modes:
+            if mode not in BGPProfiler.MODES:
+                raise ValueError(f"Invalid profile mode. Valid modes : {self.MODES}")
+        self.modes = list(modes)
+        self.__start()
+
+    def __start(self):
+        if "sample" in self.modes:
+            self.__stopped.clear()
+            self.__sampler = threading.Thread(
+                target=self.__sample, daemon=True, name="BGP monitor - profiler"
+            )
+            self.__sampler.start()
+        if "cprofile" in self.modes:
+            self.__cprofile = cProfile.Profile()
+            self.__cprofile.enable()
+        if "memory" in self.modes and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def after_fork(self, process):
+        """Profile a forked process from scratch, threads aren't inherited
+
+        Args:
+            process (str): Name of the process
+        """
+        if not self.modes:
+            return
+        self.process = process
+        self.__samples = collections.Counter()
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        if self.__cprofile is not None:
+            self.__cprofile.disable()
+        self.__snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.clear_traces()
+        self.__start()
+
+    def stop(self):
+        """Dump profiles and stop profiling"""
+        if not self.modes:
+            return
+        self.dump()
+        self.__stopped.set()
+        if self.__cprofile is not None:
+            self.__cprofile.disable()
+            self.__cprofile = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.modes = []
+
+    ############
+    # SAMPLING #
+    ############
+
+    def __label(self, code):
+        label = self.__labels.get(code)
+        if label is None:
+            label = self.__labels[code] = (
+                f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                f":{code.co_firstlineno})"
+            )
+        return label
+
+    def __sample(self):
+        own = threading.get_ident()
+        while not self.__stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(self.__label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(" ", "_"))
+                with self.__lock:
+                    self.__samples[";".join(reversed(stack))] += 1
+
+    ###########
+    # DUMPING #
+    ###########
+
+    def dump(self) -> list:
+        """Write current profiles, profiling goes on
+
+        Returns:
+            List[str]: Paths of written files
+        """
+        if not self.modes:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+        base = os.path.join(self.directory, f"{stamp}-{self.process}")
+        paths = []
+        if "sample" in self.modes:
+            with self.__lock:
+                samples = sorted(self.__samples.items())
+            with open(base + ".collapsed", "w") as f:
+                for stack, count in samples:
+                    f.write(f"{stack} {count}\n")
+            paths.append(base + ".collapsed")
+        if self.__cprofile is not None:
+            self.__cprofile.disable()
+            self.__cprofile.dump_stats(base + ".pstats")
+            text = io.StringIO()
+            pstats.Stats(self.__cprofile, stream=text).sort_stats(
+                "cumulative"
+            ).print_stats(self.top)
+            self.__cprofile.enable()
+            with open(base + "-cprofile.txt", "w") as f:
+                f.write(text.getvalue())
+            paths += [base + ".pstats", base + "-cprofile.txt"]
+        if tracemalloc.is_tracing():
+            with open(base + "-memory.txt", "w") as f:
+                f.write(self.__memory_report())
+            paths.append(base + "-memory.txt")
+        print(f"Profile of {self.process} : {', '.join(paths)}", file=sys.stderr)
+        return paths
+
+    def __memory_report(self) -> str:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Traced memory: {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB",
+            f"{time.strftime('%Y-%m-%d %H:%M:%S')}",
+            "",
+            f"Top {self.top} allocations by line:",
+        ]
+        lines += [str(s) for s in snapshot.statistics("lineno")[: self.top]]
+        if self.__snapshot is not None:
+            lines += ["", f"Top {self.top} growth since previous dump:"]
+            diff = snapshot.compare_to(self.__snapshot, "lineno")
+            lines += [str(s) for s in diff[: self.top]]
+        self.__snapshot = snapshot
+        return "\n".join(lines) + "\n"
+
+
+profiler = BGPProfiler()
+"""Profiler of the monitor, started by `monitor.py --profile`"""
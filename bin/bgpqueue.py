@@ -0,0 +1,171 @@
+"""
+Bounded queue between BGPStream and slow outputs
+"""
+
+__all__ = ["BGPQueue"]
+
+import os
+import pickle
+import tempfile
+import threading
+import collections
+
+
+class BGPQueue:
+    """
+    Bounded FIFO queue (ring buffer) shared by a producer and consumer threads
+
+    When the queue is full, `BGPQueue.policy` is applied:
+    - `block`: wait until the consumer frees a slot
+    - `drop-oldest`: discard the oldest item
+    - `spill`: write items to a temporary file, read them back when possible.
+        Order is kept, spilled items are consumed before newer ones.
+    """
+
+    POLICIES = ["block", "drop-oldest", "spill"]
+
+    def __init__(self, maxsize=100000, policy="block", spill_dir=None):
+        """
+        Args:
+            maxsize (int): Max number of items kept in memory
+            policy (str): One of `BGPQueue.POLICIES`
+            spill_dir (str): Directory of the spill file (spill policy).
+                Default: system temporary directory
+        """
+        if maxsize < 1:
+            raise ValueError("Queue size must be greater than 0")
+        if policy not in BGPQueue.POLICIES:
+            raise ValueError(f"Invalid queue policy. Valid policies : {self.POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.dropped = 0
+        """Number of items discarded by `drop-oldest` policy"""
+        self.spilled = 0
+        """Number of items written to disk by `spill` policy"""
+        self.max_depth = 0
+        """Highest number of waiting items"""
+        self.closed = False
+
+        self.__buffer = collections.deque()
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__not_full = threading.Condition(self.__lock)
+        self.__spill_file = None
+        self.__spill_count = 0
+        self.__spill_offset = 0
+
+    def qsize(self) -> int:
+        """Number of waiting items, in memory and on disk"""
+        return len(self.__buffer) + self.__spill_count
+
+    def stats(self) -> dict:
+        """Queue counters"""
+        return {
+            "depth": self.qsize(),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
+
+    ############
+    # PRODUCER #
+    ############
+
+    def put(self, item):
+        """Add an item, apply `BGPQueue.policy` if the queue is full
+
+        Raises:
+            ValueError: If the queue is closed
+        """
+        with self.__lock:
+            self.__put(item)
+            self.max_depth = max(self.max_depth, self.qsize())
+            self.__not_empty.notify()
+
+    def put_many(self, items):
+        """Add items in order, see `BGPQueue.put()`"""
+        with self.__lock:
+            for item in items:
+                self.__put(item)
+            self.max_depth = max(self.max_depth, self.qsize())
+            self.__not_empty.notify_all()
+
+    def __put(self, item):
+        """Add an item, lock must be held"""
+        if self.closed:
+            raise ValueError("Queue is closed")
+        if self.__spill_count:
+            self.__spill(item)
+        elif len(self.__buffer) < self.maxsize:
+            self.__buffer.append(item)
+        elif self.policy == "block":
+            self.__not_empty.notify_all()
+            while len(self.__buffer) >= self.maxsize and not self.closed:
+                self.__not_full.wait()
+            self.__buffer.append(item)
+        elif self.policy == "drop-oldest":
+            self.__buffer.popleft()
+            self.__buffer.append(item)
+            self.dropped += 1
+        else:
+            self.__spill(item)
+
+    def close(self):
+        """Stop accepting items, consumers can still get waiting ones"""
+        with self.__lock:
+            self.closed = True
+            self.__not_empty.notify_all()
+            self.__not_full.notify_all()
+
+    ############
+    # CONSUMER #
+    ############
+
+    def get_batch(self, max_items=1000, timeout=None) -> list:
+        """Retrieve up to max_items items
+
+        Args:
+            max_items (int): Max number of items to retrieve
+            timeout (float): Max waiting time in seconds if the queue is empty
+
+        Returns:
+            list: Items in insertion order.
+                Empty if timeout expired or if the queue is closed and empty
+        """
+        with self.__lock:
+            if not self.qsize() and not self.closed:
+                self.__not_empty.wait(timeout)
+            if not self.__buffer and self.__spill_count:
+                self.__unspill()
+            n = min(max_items, len(self.__buffer))
+            batch = [self.__buffer.popleft() for _ in range(n)]
+            if n:
+                self.__not_full.notify_all()
+            return batch
+
+    #########
+    # SPILL #
+    #########
+
+    def __spill(self, item):
+        if self.__spill_file is None:
+            self.__spill_file = tempfile.TemporaryFile(
+                prefix="bgp-monitor-", suffix=".spill", dir=self.spill_dir
+            )
+        self.__spill_file.seek(0, os.SEEK_END)
+        pickle.dump(item, self.__spill_file, pickle.HIGHEST_PROTOCOL)
+        self.__spill_count += 1
+        self.spilled += 1
+
+    def __unspill(self):
+        """Move up to maxsize spilled items back to memory"""
+        self.__spill_file.seek(self.__spill_offset)
+        for _ in range(min(self.maxsize, self.__spill_count)):
+            self.__buffer.append(pickle.load(self.__spill_file))
+            self.__spill_count -= 1
+        self.__spill_offset = self.__spill_file.tell()
+        if self.__spill_count == 0:
+            self.__spill_file.seek(0)
+            self.__spill_file.truncate()
+            self.__spill_offset = 0
@@ -0,0 +1,402 @@
+"""
+In-memory routing state (Adj-RIB-In) of every peer, built from records
+"""
+
+__all__ = ["BGPRib"]
+
+import socket
+from array import array
+from typing import Callable, List, Set, Tuple
+
+_V6 = 1 << 136
+
+
+class BGPRib:
+    """
+    Current routes of peers, keyed by (collector, peer, prefix)
+
+    Announcements (`A`) and RIB entries (`R`) replace the route of the peer
+    for the prefix, withdrawals (`W`) remove it.
+
+    Storage is compact, to hold full tables of many peers:
+    - prefixes are packed integers (network << 8 | length, with a flag bit
+        for IPv6), each one gets an index
+    - routes of a prefix are two arrays of 32 bits integers:
+        peer indexes and AS path indexes
+    - AS paths are interned: each distinct path is stored once,
+        with its origin AS and a reference count, and freed when unused
+    - prefixes of each origin AS are indexed
+
+    Not thread safe: updates and queries must come from the same thread,
+    or be serialized by the caller.
+    """
+
+    def __init__(self):
+        self.__prefix_index = {}
+        self.__prefix_keys = []
+        self.__route_peers: List[array] = []
+        self.__route_paths: List[array] = []
+
+        self.__peer_index = {}
+        self.__peer_keys = []
+        self.__peer_routes = array("I")
+
+        self.__path_index = {}
+        self.__paths = []
+        self.__path_origins = array("I")
+        self.__path_refs = array("I")
+        self.__free_paths = []
+
+        self.__origins = {}
+        self.routes = 0
+        """Number of routes"""
+        self.time = 0
+        """Time of the latest record given to `BGPRib.update()`"""
+        self.listeners: List[Callable[[str, bool], None]] = []
+        """Called with (AS path, True) when a distinct AS path gets its first route,
+        (AS path, False) when it loses its last one. Not saved by pickle"""
+        self.origin_listeners: List[Callable[[int, int, bool], None]] = []
+        """Called with (prefix index, origin AS, True) when an origin AS gets
+        its first route for a prefix, False when it loses its last one.
+        Not saved by pickle"""
+
+    def __len__(self):
+        return self.routes
+
+    def __getstate__(self):
+        """Compact state for pickle: routes of prefixes are concatenated"""
+        peers, paths = array("I"), array("I")
+        for a in self.__route_peers:
+            peers.extend(a)
+        for a in self.__route_paths:
+            paths.extend(a)
+        return {
+            "prefixes": self.__prefix_keys,
+            "counts": array("I", map(len, self.__route_peers)),
+            "route_peers": peers,
+            "route_paths": paths,
+            "peers": self.__peer_keys,
+            "peer_routes": self.__peer_routes,
+            "paths": self.__paths,
+            "path_origins": self.__path_origins,
+            "path_refs": self.__path_refs,
+            "free_paths": self.__free_paths,
+            "origins": self.__origins,
+            "routes": self.routes,
+            "time": self.time,
+        }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__prefix_keys = state["prefixes"]
+        self.__prefix_index = {k: i for i, k in enumerate(self.__prefix_keys)}
+        peers, paths, start = state["route_peers"], state["route_paths"], 0
+        for count in state["counts"]:
+            end = start + count
+            self.__route_peers.append(peers[start:end])
+            self.__route_paths.append(paths[start:end])
+            start = end
+        self.__peer_keys = state["peers"]
+        self.__peer_index = {k: i for i, k in enumerate(self.__peer_keys)}
+        self.__peer_routes = state["peer_routes"]
+        self.__paths = state["paths"]
+        self.__path_index = {p: i for i, p in enumerate(self.__paths) if p is not None}
+        self.__path_origins = state["path_origins"]
+        self.__path_refs = state["path_refs"]
+        self.__free_paths = state["free_paths"]
+        self.__origins = state["origins"]
+        self.routes = state["routes"]
+        self.time = state.get("time", 0)
+
+    def stats(self) -> dict:
+        """Table counters"""
+        return {
+            "routes": self.routes,
+            "prefixes": len(self.__prefix_keys),
+            "paths": len(self.__path_index),
+            "peers": len(self.__peer_keys),
+            "origins": len(self.__origins),
+        }
+
+    ############
+    # PREFIXES #
+    ############
+
+    @staticmethod
+    def _pack(prefix) -> int:
+        """Convert a prefix to an integer, host bits are cleared
+
+        Raises:
+            OSError, ValueError: Invalid prefix
+        """
+        address, _, length = prefix.partition("/")
+        if ":" in address:
+            width, flag = 128, _V6
+            key = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big")
+        else:
+            width, flag = 32, 0
+            key = int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+        length = int(length) if length else width
+        key = key >> (width - length) << (width - length)
+        return flag | key << 8 | length
+
+    @staticmethod
+    def _unpack(key) -> str:
+        """Convert a packed prefix back to CIDR format"""
+        length = key & 0xFF
+        if key & _V6:
+            network = (key ^ _V6) >> 8
+            address = socket.inet_ntop(socket.AF_INET6, network.to_bytes(16, "big"))
+        else:
+            address = socket.inet_ntop(socket.AF_INET, (key >> 8).to_bytes(4, "big"))
+        return f"{address}/{length}"
+
+    def prefix_index(self, prefix) -> int:
+        """Index of a prefix, kept for the life of the RIB, None if unknown"""
+        return self.__prefix(prefix)
+
+    def prefix_at(self, i) -> str:
+        """Prefix of an index, see `BGPRib.prefix_index()`"""
+        return self._unpack(self.__prefix_keys[i])
+
+    def __prefix(self, prefix, create=False) -> int:
+        """Index of a prefix, None if unknown and not created"""
+        key = self._pack(prefix)
+        i = self.__prefix_index.get(key)
+        if i is None and create:
+            i = self.__prefix_index[key] = len(self.__prefix_keys)
+            self.__prefix_keys.append(key)
+            self.__route_peers.append(array("I"))
+            self.__route_paths.append(array("I"))
+        return i
+
+    #########
+    # PEERS #
+    #########
+
+    def __peer(self, collector, peer_asn, peer_address, create=False) -> int:
+        key = (collector, peer_asn, peer_address)
+        i = self.__peer_index.get(key)
+        if i is None and create:
+            i = self.__peer_index[key] = len(self.__peer_keys)
+            self.__peer_keys.append(key)
+            self.__peer_routes.append(0)
+        return i
+
+    def peers(self) -> List[Tuple[str, int, str, int]]:
+        """Peers: (collector, peer AS, peer address, number of routes)"""
+        return [k + (n,) for k, n in zip(self.__peer_keys, self.__peer_routes)]
+
+    #########
+    # PATHS #
+    #########
+
+    def __acquire_path(self, path) -> int:
+        i = self.__path_index.get(path)
+        if i is None:
+            last = path.rpartition(" ")[2]
+            origin = int(last) if last.isdigit() else 0  # AS set: unknown
+            if self.__free_paths:
+                i = self.__free_paths.pop()
+                self.__paths[i] = path
+                self.__path_origins[i] = origin
+            else:
+                i = len(self.__paths)
+                self.__paths.append(path)
+                self.__path_origins.append(origin)
+                self.__path_refs.append(0)
+            self.__path_index[path] = i
+            for listener in self.listeners:
+                listener(path, True)
+        self.__path_refs[i] += 1
+        return i
+
+    def __release_path(self, i):
+        self.__path_refs[i] -= 1
+        if not self.__path_refs[i]:
+            path = self.__paths[i]
+            del self.__path_index[path]
+            self.__paths[i] = None
+            self.__free_paths.append(i)
+            for listener in self.listeners:
+                listener(path, False)
+
+    def paths(self) -> List[str]:
+        """Distinct AS paths of current routes"""
+        return list(self.__path_index)
+
+    def __index_origin(self, origin, prefix, delta):
+        prefixes = self.__origins.get(origin)
+        if prefixes is None:
+            prefixes = self.__origins[origin] = {}
+        count = prefixes.get(prefix, 0) + delta
+        if count:
+            prefixes[prefix] = count
+        else:
+            del prefixes[prefix]
+            if not prefixes:
+                del self.__origins[origin]
+        if count == 0 or count == delta:
+            for listener in self.origin_listeners:
+                listener(prefix, origin, count > 0)
+
+    ###########
+    # UPDATES #
+    ###########
+
+    def update(self, record) -> bool:
+        """Apply an announcement, a RIB entry or a withdrawal
+
+        Args:
+            record (dict): Record from `bgpfilter.BGPFilter`
+
+        Returns:
+            bool: True if the table changed
+        """
+        kind = record.get("type")
+        self.time = record.get("time", self.time)
+        if kind in ("A", "R"):
+            path = record.get("as-path")
+            if path is None:
+                return False
+            return self.announce(
+                record["collector"],
+                record["peer_asn"],
+                record["peer_address"],
+                record["prefix"],
+                path,
+            )
+        if kind == "W":
+            return self.withdraw(
+                record["collector"],
+                record["peer_asn"],
+                record["peer_address"],
+                record["prefix"],
+            )
+        return False
+
+    def announce(self, collector, peer_asn, peer_address, prefix, path) -> bool:
+        """Set the route of a peer for a prefix
+
+        Returns:
+            bool: True if the route is new or changed
+        """
+        peer = self.__peer(collector, peer_asn, peer_address, create=True)
+        p = self.__prefix(prefix, create=True)
+        peers, paths = self.__route_peers[p], self.__route_paths[p]
+        try:
+            i = peers.index(peer)
+        except ValueError:
+            i = None
+        if i is not None:
+            old = paths[i]
+            if self.__paths[old] == path:
+                return False
+            new = self.__acquire_path(path)
+            paths[i] = new
+            if self.__path_origins[old] != self.__path_origins[new]:
+                self.__index_origin(self.__path_origins[old], p, -1)
+                self.__index_origin(self.__path_origins[new], p, 1)
+            self.__release_path(old)
+            return True
+        new = self.__acquire_path(path)
+        peers.append(peer)
+        paths.append(new)
+        self.__index_origin(self.__path_origins[new], p, 1)
+        self.__peer_routes[peer] += 1
+        self.routes += 1
+        return True
+
+    def withdraw(self, collector, peer_asn, peer_address, prefix) -> bool:
+        """Remove the route of a peer for a prefix
+
+        Returns:
+            bool: True if the peer had a route
+        """
+        peer = self.__peer(collector, peer_asn, peer_address)
+        p = self.__prefix(prefix)
+        if peer is None or p is None:
+            return False
+        try:
+            i = self.__route_peers[p].index(peer)
+        except ValueError:
+            return False
+        self.__remove(p, i, peer)
+        return True
+
+    def __remove(self, p, i, peer):
+        """Remove the i-th route of a prefix, last route takes its place"""
+        peers, paths = self.__route_peers[p], self.__route_paths[p]
+        path = paths[i]
+        peers[i], paths[i] = peers[-1], paths[-1]
+        peers.pop()
+        paths.pop()
+        self.__index_origin(self.__path_origins[path], p, -1)
+        self.__release_path(path)
+        self.__peer_routes[peer] -= 1
+        self.routes -= 1
+
+    def clear_peer(self, collector, peer_asn, peer_address) -> int:
+        """Remove every route of a peer, after a session reset
+
+        Returns:
+            int: Number of removed routes
+        """
+        peer = self.__peer(collector, peer_asn, peer_address)
+        if peer is None or not self.__peer_routes[peer]:
+            return 0
+        removed = 0
+        for p, peers in enumerate(self.__route_peers):
+            try:
+                i = peers.index(peer)
+            except ValueError:
+                continue
+            self.__remove(p, i, peer)
+            removed += 1
+        return removed
+
+    ###########
+    # QUERIES #
+    ###########
+
+    def get(self, prefix) -> List[dict]:
+        """Current routes of a prefix
+
+        Returns:
+            List[dict]: {"collector", "peer_asn", "peer_address", "as-path"}
+        """
+        p = self.__prefix(prefix)
+        if p is None:
+            return []
+        routes = []
+        for peer, path in zip(self.__route_peers[p], self.__route_paths[p]):
+            collector, peer_asn, peer_address = self.__peer_keys[peer]
+            routes.append(
+                {
+                    "collector": collector,
+                    "peer_asn": peer_asn,
+                    "peer_address": peer_address,
+                    "as-path": self.__paths[path],
+                }
+            )
+        return routes
+
+    def origins(self, prefix) -> Set[int]:
+        """Current origin AS numbers of a prefix, AS sets are skipped"""
+        p = self.__prefix(prefix)
+        if p is None:
+            return set()
+        origins = {self.__path_origins[path] for path in self.__route_paths[p]}
+        origins.discard(0)
+        return origins
+
+    def origin_pairs(self) -> List[Tuple[int, int]]:
+        """(prefix index, origin AS) of current routes"""
+        return [(p, asn) for asn, prefixes in self.__origins.items() for p in prefixes]
+
+    def prefixes(self, asn) -> List[str]:
+        """Prefixes currently originated by an AS number, seen by any peer"""
+        return [
+            self._unpack(self.__prefix_keys[p])
+            for p in self.__origins.get(int(asn), ())
+        ]
@@ -0,0 +1,353 @@
+"""
+Prefix trie for longest prefix match and prefix filtering
+"""
+
+__all__ = ["BGPTrie"]
+
+import socket
+import ipaddress
+from typing import List, Tuple
+
+MATCH_TYPES = ["exact", "more", "less", "any"]
+
+_EMPTY = object()
+
+
+class _Node:
+    __slots__ = ("key", "length", "children", "value")
+
+    def __init__(self, key, length, value=_EMPTY):
+        self.key = key
+        """Network address as integer, bits after length are 0"""
+        self.length = length
+        self.children = [None, None]
+        self.value = value
+        """Stored value, `_EMPTY` if the node only joins its children"""
+
+
+class BGPTrie:
+    """
+    Patricia trie of IPv4 and IPv6 prefixes
+
+    Each prefix may hold a value. A lookup walks at most one node per distinct
+    prefix length on the path, so it doesn't depend on the number of prefixes.
+    Match types are the same as `bgpfilter.BGPFilter.prefix_filter`:
+    - `exact`: the prefix is stored
+    - `more`: the prefix is contained by a stored prefix (or exact)
+    - `less`: the prefix contains a stored prefix (or exact)
+    - `any`: more or less
+    """
+
+    def __init__(self, prefixes=None):
+        """
+        Args:
+            prefixes (Iterable[str]): CIDR prefixes to insert, with None values
+
+        Raises:
+            ValueError: Invalid prefix
+        """
+        self.__roots = {4: None, 6: None}
+        self.__size = 0
+        for p in prefixes or []:
+            self.insert(p)
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __contains__(self, prefix) -> bool:
+        return self.__find(*self._parse(prefix)) is not None
+
+    def __iter__(self):
+        """Iterate over stored prefixes (str), IPv4 first, in address order"""
+        for version in [4, 6]:
+            for node in self.__walk(self.__roots[version]):
+                yield self.__prefix(version, node)
+
+    #############
+    #  PARSING  #
+    #############
+
+    @staticmethod
+    def _parse(prefix) -> Tuple[int, int, int, int]:
+        """Convert a prefix or an address to integers without validation
+
+        Host bits are cleared, an address is a /32 or /128 prefix.
+
+        Returns:
+            Tuple[int, int, int, int]: ip version, address width, network, length
+        """
+        address, _, length = prefix.partition("/")
+        if ":" in address:
+            version, width = 6, 128
+            key = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big")
+        else:
+            version, width = 4, 32
+            key = int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+        length = int(length) if length else width
+        return version, width, key >> (width - length) << (width - length), length
+
+    @staticmethod
+    def _check(prefix) -> Tuple[int, int, int, int]:
+        """Validate a prefix, see `BGPTrie._parse()`
+
+        Raises:
+            ValueError: Invalid prefix or host bits set
+        """
+        try:
+            address, _, length = prefix.partition("/")
+            version, width = (6, 128) if ":" in address else (4, 32)
+            key = int.from_bytes(
+                socket.inet_pton(
+                    socket.AF_INET6 if version == 6 else socket.AF_INET, address
+                ),
+                "big",
+            )
+            length = int(length) if length else width
+        except (OSError, ValueError, AttributeError):
+            raise ValueError(f"{prefix!r} does not appear to be an IP network")
+        if not 0 <= length <= width:
+            raise ValueError(f"Invalid prefix length in {prefix}")
+        if key & ((1 << (width - length)) - 1):
+            raise ValueError(f"{prefix} has host bits set")
+        return version, width, key, length
+
+    @staticmethod
+    def __prefix(version, node) -> str:
+        if version == 4:
+            return str(ipaddress.IPv4Network((node.key, node.length)))
+        return str(ipaddress.IPv6Network((node.key, node.length)))
+
+    ###############
+    #   UPDATES   #
+    ###############
+
+    def insert(self, prefix: str, value=None):
+        """Add a prefix, replace its value if it already exists
+
+        Raises:
+            ValueError: Invalid prefix
+        """
+        version, width, key, length = self._check(prefix)
+        node = self.__roots[version]
+        if node is None:
+            self.__roots[version] = _Node(key, length, value)
+            self.__size += 1
+            return
+
+        parent = None
+        while True:
+            common = min(node.length, length, width - (node.key ^ key).bit_length())
+            if common == node.length == length:
+                if node.value is _EMPTY:
+                    self.__size += 1
+                node.value = value
+                return
+            if common == node.length:
+                b = key >> (width - 1 - node.length) & 1
+                if node.children[b] is None:
+                    node.children[b] = _Node(key, length, value)
+                    self.__size += 1
+                    return
+                parent, node = node, node.children[b]
+                continue
+
+            if common == length:
+                new = _Node(key, length, value)
+                new.children[node.key >> (width - 1 - length) & 1] = node
+            else:
+                new = _Node(key >> (width - common) << (width - common), common)
+                new.children[key >> (width - 1 - common) & 1] = _Node(
+                    key, length, value
+                )
+                new.children[node.key >> (width - 1 - common) & 1] = node
+            if parent is None:
+                self.__roots[version] = new
+            else:
+                parent.children[parent.children[1] is node] = new
+            self.__size += 1
+            return
+
+    def delete(self, prefix: str):
+        """Remove a prefix
+
+        Raises:
+            KeyError: Prefix not stored
+        """
+        version, width, key, length = self._parse(prefix)
+        path = []
+        node = self.__roots[version]
+        while node is not None and node.length <= length:
+            if node.key != key >> (width - node.length) << (width - node.length):
+                break
+            if node.length == length:
+                if node.value is _EMPTY:
+                    break
+                self.__remove(version, path, node)
+                self.__size -= 1
+                return
+            path.append(node)
+            node = node.children[key >> (width - 1 - node.length) & 1]
+        raise KeyError(prefix)
+
+    def __remove(self, version, path, node):
+        """Unset node value, remove nodes that are no longer needed"""
+        node.value = _EMPTY
+        while node is not None and node.value is _EMPTY:
+            children = [c for c in node.children if c is not None]
+            if len(children) == 2:
+                return
+            parent = path.pop() if path else None
+            replacement = children[0] if children else None
+            if parent is None:
+                self.__roots[version] = replacement
+                return
+            parent.children[parent.children[1] is node] = replacement
+            node = parent if replacement is None else None
+
+    ###############
+    #   LOOKUPS   #
+    ###############
+
+    def __find(self, version, width, key, length):
+        """Node holding a value for the prefix, or None"""
+        node = self.__roots[version]
+        while node is not None and node.length < length:
+            node = node.children[key >> (width - 1 - node.length) & 1]
+        if (
+            node is not None
+            and node.length == length
+            and node.key == key
+            and node.value is not _EMPTY
+        ):
+            return node
+        return None
+
+    def get(self, prefix: str, default=None):
+        """Value of an exactly matching prefix, default if not stored"""
+        node = self.__find(*self._parse(prefix))
+        return default if node is None else node.value
+
+    def covering(self, prefix: str) -> List[Tuple[str, object]]:
+        """Stored prefixes that contain prefix or are equal to it
+
+        Args:
+            prefix (str): CIDR prefix or ip address
+
+        Returns:
+            List[Tuple[str, object]]: (prefix, value), least specific first
+        """
+        version, width, key, length = self._parse(prefix)
+        return [
+            (self.__prefix(version, n), n.value)
+            for n in self.__covering(version, width, key, length)
+        ]
+
+    def __covering(self, version, width, key, length):
+        node = self.__roots[version]
+        while node is not None and node.length <= length:
+            if node.key != key >> (width - node.length) << (width - node.length):
+                return
+            if node.value is not _EMPTY:
+                yield node
+            if node.length == length:
+                return
+            node = node.children[key >> (width - 1 - node.length) & 1]
+
+    def longest_match(self, prefix: str):
+        """Most specific stored prefix that contains prefix or is equal to it
+
+        Args:
+            prefix (str): CIDR prefix or ip address
+
+        Returns:
+            Tuple[str, object]: (prefix, value), None if not found
+        """
+        match = self.covering(prefix)
+        return match[-1] if match else None
+
+    def longest_value(self, prefix: str, default=None):
+        """Value of the most specific stored prefix that contains prefix
+
+        Same as `BGPTrie.longest_match()` without formatting the stored prefix.
+
+        Args:
+            prefix (str): CIDR prefix or ip address
+            default: Returned if not found
+        """
+        version, width, key, length = self._parse(prefix)
+        value = default
+        node = self.__roots[version]
+        while node is not None and node.length <= length:
+            if node.key != key >> (width - node.length) << (width - node.length):
+                break
+            if node.value is not _EMPTY:
+                value = node.value
+            if node.length == length:
+                break
+            node = node.children[key >> (width - 1 - node.length) & 1]
+        return value
+
+    def covered(self, prefix: str) -> List[Tuple[str, object]]:
+        """Stored prefixes contained by prefix or equal to it
+
+        Returns:
+            List[Tuple[str, object]]: (prefix, value), in address order
+        """
+        version, width, key, length = self._parse(prefix)
+        return [
+            (self.__prefix(version, n), n.value)
+            for n in self.__walk(self.__subtree(version, width, key, length))
+        ]
+
+    def __subtree(self, version, width, key, length):
+        """First node of the subtree contained by the prefix, or None"""
+        node = self.__roots[version]
+        while node is not None:
+            if node.length >= length:
+                if node.key >> (width - length) << (width - length) == key:
+                    return node
+                return None
+            if node.key != key >> (width - node.length) << (width - node.length):
+                return None
+            node = node.children[key >> (width - 1 - node.length) & 1]
+        return None
+
+    @staticmethod
+    def __walk(node):
+        """Nodes with a value in the subtree, in address order"""
+        stack = [node] if node is not None else []
+        while stack:
+            n = stack.pop()
+            if n.value is not _EMPTY:
+                yield n
+            stack.extend(c for c in reversed(n.children) if c is not None)
+
+    def match(self, prefix: str, match_type: str = "more") -> bool:
+        """Check a prefix against stored prefixes
+
+        Args:
+            prefix (str): CIDR prefix
+            match_type (str): exact, more, less or any. See `BGPTrie`
+
+        Raises:
+            ValueError: Invalid match type
+        """
+        if match_type not in MATCH_TYPES:
+            raise ValueError(f"Match type must be one of {MATCH_TYPES}")
+        version, width, key, length = self._parse(prefix)
+        if match_type == "exact":
+            return self.__find(version, width, key, length) is not None
+        if match_type in ["more", "any"]:
+            node = self.__roots[version]
+            while node is not None and node.length <= length:
+                if node.key != key >> (width - node.length) << (width - node.length):
+                    break
+                if node.value is not _EMPTY:
+                    return True
+                if node.length == length:
+                    break
+                node = node.children[key >> (width - 1 - node.length) & 1]
+        if match_type in ["less", "any"]:
+            # every node without value has two children, a subtree has a value
+            return self.__subtree(version, width, key, length) is not None
+        return False
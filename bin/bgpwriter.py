@@ -0,0 +1,243 @@
+"""
+NDJSON files output with rotation and compression
+"""
+
+__all__ = ["BGPWriter"]
+
+import os
+import sys
+import time
+import gzip
+import zlib
+import datetime
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BGPWriter:
+    """
+    Write records as NDJSON lines to a series of bounded files
+
+    A new file is started when the current one reaches
+    `BGPWriter.max_size` bytes (uncompressed) or `BGPWriter.max_age` seconds.
+    Files are named `<prefix>-<UTC start time>.ndjson[.gz|.zst]`
+    (time format: YYYYMMDDThhmmss_microseconds), names sort in writing order.
+    A file is complete once the next one exists.
+
+    Lines are buffered in memory, written when the buffer is full,
+    and flushed to disk (fsync) every `BGPWriter.fsync_interval` seconds.
+    Compressed files are flushed with a sync point,
+    so they can be read while they are written.
+    A thread does the periodic flushes and closes a file reaching its max age,
+    even when no line comes.
+    """
+
+    COMPRESSIONS = [None, "gzip", "zstd"]
+    EXTENSIONS = {None: ".ndjson", "gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+
+    def __init__(
+        self,
+        prefix,
+        max_size=None,
+        max_age=None,
+        compression=None,
+        buffer_size=1 << 20,
+        fsync_interval=1.0,
+    ):
+        """
+        Args:
+            prefix (str): Path prefix of the files, the directory is created if needed
+            max_size (int): Max size in bytes of a file before compression.
+                None: no size limit
+            max_age (float): Max time in seconds a file is written. None: no limit
+            compression (str): One of `BGPWriter.COMPRESSIONS`
+            buffer_size (int): Bytes kept in memory before writing
+            fsync_interval (float): Max seconds between two fsync
+
+        Raises:
+            ValueError: Invalid compression
+            ImportError: zstd compression requires zstandard package
+        """
+        if compression not in BGPWriter.COMPRESSIONS:
+            raise ValueError(
+                f"Invalid compression. Valid compressions : {self.COMPRESSIONS}"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression requires zstandard package")
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_age = max_age
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.path: str = None
+        """Path of the file being written"""
+        self.files = 0
+        """Number of files opened"""
+        self.lines = 0
+        """Number of lines written"""
+        self.bytes = 0
+        """Number of bytes written, before compression"""
+
+        self.__raw = None
+        self.__stream = None
+        self.__buffer = []
+        self.__buffered = 0
+        self.__size = 0
+        self.__opened = 0
+        self.__last_sync = 0
+        self.__unsynced = False
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__timer = None
+
+    def stats(self) -> dict:
+        """Writer counters"""
+        return {
+            "files": self.files,
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "path": self.path,
+        }
+
+    ##########
+    # WRITES #
+    ##########
+
+    def write(self, line: str):
+        """Add a line, without line feed"""
+        data = line.encode() + b"\n"
+        with self.__lock:
+            now = time.monotonic()
+            if self.__raw is not None and (
+                (self.max_size and self.__size >= self.max_size)
+                or (self.max_age and now - self.__opened >= self.max_age)
+            ):
+                self.__close()
+            if self.__raw is None:
+                self.__open(now)
+
+            self.__buffer.append(data)
+            self.__buffered += len(data)
+            self.__size += len(data)
+            self.__unsynced = True
+            self.lines += 1
+            if self.__buffered >= self.buffer_size:
+                self.__write()
+            if now - self.__last_sync >= self.fsync_interval:
+                self.__sync()
+
+    def __write(self):
+        """Send buffered lines to the file"""
+        if self.__buffer:
+            data = b"".join(self.__buffer)
+            self.__stream.write(data)
+            self.bytes += len(data)
+            self.__buffer = []
+            self.__buffered = 0
+
+    def sync(self):
+        """Write buffered lines and flush them to disk"""
+        with self.__lock:
+            self.__sync()
+
+    def __sync(self):
+        if self.__raw is None:
+            return
+        self.__unsynced = False
+        self.__write()
+        if self.compression == "gzip":
+            self.__stream.flush(zlib.Z_SYNC_FLUSH)
+        elif self.compression == "zstd":
+            self.__stream.flush(zstandard.FLUSH_BLOCK)
+        self.__raw.flush()
+        os.fsync(self.__raw.fileno())
+        self.__last_sync = time.monotonic()
+
+    def __flush_idle(self):
+        """Sync lines waiting for more than fsync_interval, close old files"""
+        interval = min(self.fsync_interval, self.max_age or self.fsync_interval)
+        while not self.__stopped.wait(interval / 2):
+            with self.__lock:
+                if self.__raw is None:
+                    continue
+                now = time.monotonic()
+                try:
+                    if self.max_age and now - self.__opened >= self.max_age:
+                        self.__close()
+                    elif (
+                        self.__unsynced
+                        and now - self.__last_sync >= self.fsync_interval
+                    ):
+                        self.__sync()
+                except OSError as e:
+                    print(f"NDJSON output : {self.path}, {e}", file=sys.stderr)
+
+    ############
+    # ROTATION #
+    ############
+
+    def __open(self, now):
+        directory = os.path.dirname(os.path.abspath(self.prefix))
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+            "%Y%m%dT%H%M%S_%f"
+        )
+        path = f"{self.prefix}-{stamp}{self.EXTENSIONS[self.compression]}"
+        i = 0
+        while os.path.exists(path):
+            i += 1
+            path = f"{self.prefix}-{stamp}.{i}{self.EXTENSIONS[self.compression]}"
+
+        self.__raw = open(path, "xb")
+        if self.compression == "gzip":
+            self.__stream = gzip.GzipFile(
+                fileobj=self.__raw, mode="wb", compresslevel=6
+            )
+        elif self.compression == "zstd":
+            self.__stream = zstandard.ZstdCompressor(level=3).stream_writer(
+                self.__raw, closefd=False
+            )
+        else:
+            self.__stream = self.__raw
+        self.path = path
+        self.files += 1
+        self.__size = 0
+        self.__opened = now
+        self.__last_sync = now
+        if self.__timer is None:
+            self.__stopped.clear()
+            self.__timer = threading.Thread(
+                target=self.__flush_idle, daemon=True, name="BGP monitor - ndjson"
+            )
+            self.__timer.start()
+
+    def close(self):
+        """Write buffered lines, close the current file and stop periodic flushes"""
+        if self.__timer is not None:
+            self.__stopped.set()
+            self.__timer.join()
+            self.__timer = None
+        with self.__lock:
+            self.__close()
+
+    def __close(self):
+        """Close the current file, the next line opens a new one"""
+        if self.__raw is None:
+            return
+        try:
+            self.__write()
+            if self.__stream is not self.__raw:
+                self.__stream.close()
+            self.__raw.flush()
+            os.fsync(self.__raw.fileno())
+        except OSError as e:
+            print(f"NDJSON output : unable to close {self.path}, {e}", file=sys.stderr)
+        finally:
+            self.__raw.close()
+            self.__raw = None
+            self.__stream = None
@@ -8,14 +8,23 @@ import sys
 import signal
 import bgpout
 import argparse
-import urllib.request
 from configobj import ConfigObj
+from bgpgeo import GeoRefresher
 from bgpfilter import BGPFilter
-from Databases.database import BGPDatabases
+from bgpwriter import BGPWriter
+from bgpparquet import BGPParquet
+from bgprib import BGPRib
+from bgpgraph import BGPGraph
+from bgpbootstrap import BGPBootstrap
+from bgpcheckpoint import BGPCheckpoint
+from bgpmetrics import metrics
+from bgpprofile import profiler, BGPProfiler
+from Databases.database import BGPDatabases, load_database
 
 DEFAULT_GEOOPEN_URL = (
     "https://cra.circl.lu/opendata/geo-open/mmdb-country-asn/latest.mmdb"
 )
+DEFAULT_GEOOPEN_PATH = "../geo-open/latest.mmdb"
 
 # define bin/ as default workdir
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -85,6 +94,160 @@ if __name__ == "__main__":
         metavar="<path>",
     )
 
+    parser.add_argument(
+        "--json_format",
+        choices=["pretty", "compact"],
+        default="pretty",
+        help=(
+            "JSON output format ->\n"
+            "pretty: JSON array of indented records\n"
+            "compact: NDJSON, one record per line.\n"
+            "Default: pretty"
+        ),
+    )
+
+    parser.add_argument(
+        "--json_backend",
+        choices=["json", "orjson"],
+        default="json",
+        help="JSON encoder. orjson is faster but must be installed. Default: json",
+    )
+
+    parser.add_argument(
+        "--ndjson",
+        help=(
+            "Write records as NDJSON to rotated files named"
+            " <prefix>-<UTC time>.ndjson[.gz|.zst]"
+        ),
+        metavar="<prefix>",
+    )
+
+    parser.add_argument(
+        "--rotate_size",
+        type=float,
+        help="Start a new NDJSON file after this size in MB (before compression)",
+        metavar="<MB>",
+    )
+
+    parser.add_argument(
+        "--rotate_interval",
+        type=float,
+        help="Start a new NDJSON file after this number of seconds",
+        metavar="<seconds>",
+    )
+
+    parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"],
+        help="Compress NDJSON files. zstd requires zstandard package",
+    )
+
+    parser.add_argument(
+        "--fsync_interval",
+        type=float,
+        default=1,
+        help="Max seconds between two flushes of NDJSON files to disk. Default: 1",
+        metavar="<seconds>",
+    )
+
+    parser.add_argument(
+        "--parquet",
+        help=(
+            "Archive records in Parquet files, partitioned by hour and collector:"
+            " <dir>/date=YYYY-MM-DD/hour=HH/collector=<collector>/. Requires pyarrow"
+        ),
+        metavar="<dir>",
+    )
+
+    parser.add_argument(
+        "--parquet_batch",
+        type=int,
+        default=100000,
+        help="Records of a partition kept in memory before writing. Default: 100000",
+        metavar="<rows>",
+    )
+
+    parser.add_argument(
+        "--rib",
+        action="store_true",
+        help="Keep the current routes of every peer in memory",
+    )
+
+    parser.add_argument(
+        "--graph",
+        action="store_true",
+        help="Keep the AS graph of current routes in memory, implies --rib",
+    )
+
+    parser.add_argument(
+        "--history",
+        type=float,
+        help=(
+            "Keep this many hours of changes of the AS graph and of prefix origins,"
+            " for queries in the past, implies --graph"
+        ),
+        metavar="<hours>",
+    )
+
+    parser.add_argument(
+        "--history_interval",
+        type=float,
+        default=3600,
+        help=(
+            "Seconds of record time between two snapshots of the history,"
+            " the most changes replayed by a past query. Default: 3600"
+        ),
+        metavar="<seconds>",
+    )
+
+    parser.add_argument(
+        "--bootstrap",
+        nargs="*",
+        help=(
+            "Load the routing table of peers before the stream, implies --rib.\n"
+            " Without path, the latest RIB dump of each collector before the start is"
+            " found with the broker, and updates since the dump are replayed.\n"
+            " With paths, MRT RIB dumps given as <collector>=<path> are loaded as"
+            " routes of this collector and its updates since the dump are"
+            " replayed, <path> alone is loaded as is with --input_data"
+        ),
+        metavar="<path>",
+    )
+
+    parser.add_argument(
+        "--bootstrap_processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes parsing RIB dumps. Default: number of CPUs",
+        metavar="<n>",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        help=(
+            "Save position of each collector, database watermarks, RIB and history"
+            " to this file periodically and on stop"
+        ),
+        metavar="<path>",
+    )
+
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=float,
+        default=60,
+        help="Seconds between two checkpoints. Default: 60",
+        metavar="<seconds>",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Continue from the checkpoint: archived updates since the saved"
+            " positions are read, then the live stream"
+        ),
+    )
+
     parser.add_argument(
         "-cf",
         "--country_filter",
@@ -159,7 +322,7 @@ if __name__ == "__main__":
         "--record",
         action="store_true",
         help=(
-            "Retrieve records in the interval --until_time and --f-time arguments"
+            "Retrieve records in the interval --start and --stop arguments"
             " (which are required)"
         ),
     )
@@ -207,6 +370,114 @@ if __name__ == "__main__":
         help="input data type format. ris-live is avaible for updates only",
     )
 
+    parser.add_argument(
+        "--from_db",
+        choices=["clickhouse", "quest"],
+        help=(
+            "Read records of the --start and --stop interval from a database\n"
+            " instead of BGPStream. Records are filtered again and sent to outputs.\n"
+            " The database must be configured in config file, it won't be used as"
+            " output.\n Peer addresses aren't stored, --rib, --graph and --history"
+            " can't be used"
+        ),
+        metavar="<database>",
+    )
+
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help=(
+            "Process outputs (files, databases) in a separate thread.\n Prevents slow"
+            " outputs from blocking BGPStream"
+        ),
+    )
+
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=100000,
+        help="Max number of records waiting in the queue. Default: 100000",
+        metavar="<number>",
+    )
+
+    parser.add_argument(
+        "--queue_policy",
+        choices=["block", "drop-oldest", "spill"],
+        default="block",
+        help=(
+            "Action when the queue is full ->\n"
+            "block: Wait for a free slot\n"
+            "drop-oldest: Discard the oldest record\n"
+            "spill: Write records to a temporary file.\n"
+            "Default: block"
+        ),
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes used to filter records.\n If greater than 1, the"
+            " stream is read, filtered and saved by separate processes.\n Default: 1"
+        ),
+        metavar="<number>",
+    )
+
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        help="Serve Prometheus metrics over HTTP on this port, at /metrics",
+        metavar="<port>",
+    )
+
+    parser.add_argument(
+        "--metrics_host",
+        default="127.0.0.1",
+        help="Address of the metrics HTTP server. Default: 127.0.0.1",
+        metavar="<address>",
+    )
+
+    parser.add_argument(
+        "--metrics_log",
+        type=float,
+        help="Print metrics as a JSON line to stderr every <seconds>",
+        metavar="<seconds>",
+    )
+
+    parser.add_argument(
+        "--metrics_timing",
+        action="store_true",
+        help="Measure processing time of each record by stage (slower)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="+",
+        choices=BGPProfiler.MODES,
+        help=(
+            "Profile the monitor, dumped on stop or on SIGUSR1."
+            " sample: sampled stacks for flamegraphs (bounded overhead),"
+            " cprofile: deterministic profile of the main loop (slow),"
+            " memory: top allocations with tracemalloc"
+        ),
+    )
+
+    parser.add_argument(
+        "--profile_dir",
+        default="../profiles",
+        help="Directory of profile dumps. Default: ../profiles",
+        metavar="<path>",
+    )
+
+    parser.add_argument(
+        "--profile_interval",
+        type=float,
+        default=10,
+        help="Milliseconds between two samples of sample profile. Default: 10",
+        metavar="<ms>",
+    )
+
     parser.add_argument(
         "--expected_result",
         "-expected",
@@ -216,9 +487,33 @@ if __name__ == "__main__":
         help="Check that the result is the same as the expected result",
     )
 
+    parser.add_argument(
+        "--unordered",
+        nargs="?",
+        type=float,
+        const=60,
+        metavar="<seconds>",
+        help=(
+            "With --expected_result, ignore the order of records"
+            " in time buckets of this size. Default: 60"
+        ),
+    )
+
+    parser.add_argument(
+        "--max_diffs",
+        type=int,
+        default=10,
+        metavar="<number>",
+        help="With --expected_result, number of differences shown. Default: 10",
+    )
+
     args = parser.parse_args()
-    if args.record and (args.from_time is None or args.until_time is None):
-        parser.error("--record requires --from_time and --until_time.")
+    if args.record and (args.start is None or args.stop is None):
+        parser.error("--record requires --start and --stop.")
+    if args.from_db and (args.start is None or args.stop is None):
+        parser.error("--from_db requires --start and --stop.")
+    if args.from_db and args.input_data:
+        parser.error("--from_db and --input_data can't be used together.")
 
     if args.input_data and (
         args.input_file_format is None or args.input_record_type is None
@@ -226,8 +521,51 @@ if __name__ == "__main__":
         parser.error(
             "--input_data requires --input_file_format and --input_record_type."
         )
+    if (args.rotate_size or args.rotate_interval or args.compression) and (
+        args.ndjson is None
+    ):
+        parser.error(
+            "--rotate_size, --rotate_interval and --compression require --ndjson"
+        )
+    if args.parquet_batch < 1:
+        parser.error("--parquet_batch must be greater than 0")
+    if args.queue_size < 1:
+        parser.error("--queue_size must be greater than 0")
+    if args.workers < 1:
+        parser.error("--workers must be greater than 0")
+    if args.profile_interval <= 0:
+        parser.error("--profile_interval must be greater than 0")
+    if args.metrics_log is not None and args.metrics_log <= 0:
+        parser.error("--metrics_log must be greater than 0")
     if args.expected_result is not None and args.json_output is None:
         parser.error("--expected_result requires --json_output")
+    if args.unordered is not None and args.unordered <= 0:
+        parser.error("--unordered must be greater than 0")
+    if args.bootstrap is not None and args.from_db:
+        parser.error("--bootstrap and --from_db can't be used together.")
+    if args.from_db and (args.rib or args.graph or args.history is not None):
+        # databases don't store peer addresses, routes of peers can't be told apart
+        parser.error("--rib, --graph and --history can't be used with --from_db.")
+    if args.bootstrap == [] and args.input_data:
+        parser.error("--bootstrap without path requires the broker, not --input_data")
+    if args.bootstrap and not args.input_data:
+        if any("=" not in path for path in args.bootstrap):
+            parser.error(
+                "--bootstrap paths require their collector (<collector>=<path>)"
+                " with the broker, or --input_data"
+            )
+    if args.bootstrap_processes < 1:
+        parser.error("--bootstrap_processes must be greater than 0")
+    if args.history is not None and args.history <= 0:
+        parser.error("--history must be greater than 0")
+    if args.history_interval <= 0:
+        parser.error("--history_interval must be greater than 0")
+    if args.checkpoint_interval <= 0:
+        parser.error("--checkpoint_interval must be greater than 0")
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+    if args.resume and (args.record or args.from_db or args.input_data):
+        parser.error("--resume requires live mode and the broker")
 
     # config
     if os.path.isfile(args.config):
@@ -239,24 +577,37 @@ if __name__ == "__main__":
     filter = BGPFilter()
 
     filter.project = args.project  # ris / routeviews
-    filter.collectors = args.collectors  # there are many collectors
     filter.countries_filter = args.country_filter  # Country codes
     filter.ipversion = args.ipversion  # 4 / 6
+    filter.workers = args.workers
 
-    filter.record_mode(args.record, args.start, args.stop)
+    filter.record_mode(args.record or args.from_db is not None, args.start, args.stop)
+    if args.from_db:
+        filter.database_source(load_database(config["databases"], args.from_db))
     if args.input_data:
         filter.data_source(
             args.input_record_type, args.input_file_format, args.input_data
         )
+    # checked against broker list only if data source is the broker
+    filter.collectors = args.collectors  # there are many collectors
 
     if "geo-open" in config:
-        url = config["geo-open"] or DEFAULT_GEOOPEN_URL  # if "download_url"
-        print("Downloading latest Geo Open Database", file=sys.stderr)
-        urllib.request.urlretrieve(
-            config["geo-open"]["download_url"], "../geo-open/latest.mmdb"
+        geo_conf = config["geo-open"]
+        refresher = GeoRefresher(
+            geo_conf.get("download_url", DEFAULT_GEOOPEN_URL),
+            geo_conf.get("path", DEFAULT_GEOOPEN_PATH),
+            interval=float(geo_conf.get("refresh_interval", 86400)),
+            max_age=float(geo_conf.get("max_age", 86400)),
         )
+        if not os.path.isfile(refresher.path):
+            # nothing to start with, wait for the first download
+            print("Downloading latest Geo Open Database", file=sys.stderr)
+            refresher.refresh(force=True)
+        refresher.start()
 
-        filter.country_file = config["geo-open"]["path"]
+        filter.geo.cache_size = int(geo_conf.get("cache_size", filter.geo.cache_size))
+        filter.geo.watch_interval = float(geo_conf.get("watch_interval", 60))
+        filter.country_file = refresher.path
 
     if args.filter_list is not None:
         res = asnPrefixFromFile(args.filter_list)
@@ -272,16 +623,74 @@ if __name__ == "__main__":
     # Output
     bout = bgpout.BGPOut()
     bout.json_out = args.json_output
+    bout.json_format = args.json_format
+    bout.json_backend = args.json_backend
+    if args.ndjson:
+        bout.writer = BGPWriter(
+            args.ndjson,
+            max_size=int(args.rotate_size * 1e6) if args.rotate_size else None,
+            max_age=args.rotate_interval,
+            compression=args.compression,
+            fsync_interval=args.fsync_interval,
+        )
+    if args.rib or args.graph or args.history or args.bootstrap is not None:
+        bout.rib = BGPRib()
+    if args.graph or args.history:
+        bout.graph = BGPGraph(bout.rib)
+    if args.history:
+        bout.graph.keep_history(args.history_interval, args.history * 3600)
+    if args.parquet:
+        bout.archive = BGPParquet(args.parquet, batch_size=args.parquet_batch)
     bout.expected_result = args.expected_result
+    bout.compare.unordered = args.unordered is not None
+    bout.compare.bucket_size = args.unordered or 60
+    bout.compare.max_diffs = args.max_diffs
     bout.verbose = args.verbose
-    bout.databases = BGPDatabases(config["databases"])
+    bout.isQueue = args.queue
+    bout.queue_size = args.queue_size
+    bout.queue_policy = args.queue_policy
+    bout.databases = BGPDatabases(
+        {k: v for k, v in config["databases"].items() if k != args.from_db}
+    )
 
     filter.out = bout
+    if args.bootstrap is not None:
+        filter.bootstrap = BGPBootstrap(
+            filter, args.bootstrap, processes=args.bootstrap_processes
+        )
+    if args.checkpoint:
+        bout.checkpoint = BGPCheckpoint(args.checkpoint, args.checkpoint_interval)
+    state = bout.checkpoint.load() if args.resume else None
+    if state is not None:
+        bout.resume(state)
+        filter.resume(BGPCheckpoint.resume_positions(state))
+        if state["rib"] is not None:
+            filter.bootstrap = None  # restored
+    elif args.resume:
+        print(f"No checkpoint at {args.checkpoint}, starting now", file=sys.stderr)
 
     # end of program
     def stop(x, y):
         filter.stop()
 
     signal.signal(signal.SIGINT, stop)
+
+    if args.profile:
+        profiler.directory = args.profile_dir
+        profiler.interval = args.profile_interval / 1000
+
+        def dump_profile(x, y):
+            profiler.dump()
+            if filter._pipeline is not None:
+                filter._pipeline.signal(signal.SIGUSR1)
+
+        signal.signal(signal.SIGUSR1, dump_profile)
+        profiler.start(args.profile)
+
+    metrics.timing = args.metrics_timing
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    if args.metrics_log:
+        metrics.log(args.metrics_log)
     filter.start()
     filter.stop()
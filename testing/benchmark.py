@@ -0,0 +1,512 @@
+"""
+Offline benchmark of the filtering pipeline over a recorded fixture.
+
+Elements are replayed from a single file, like `monitor.py -id`, through
+every stage of `BGPFilter` and `BGPOut`, in one process:
+    parse      next element from pybgpstream
+    convert    `BGPFilter._make_msg()`
+    enrich     `BGPFilter._enrich()` (country lookup, source AS)
+    filter     `BGPFilter._check()`
+    serialize  `BGPOut.serialize()`
+    <sink>     `save_many()` of each database or file output, by batches
+
+Sinks use local stand-ins, no server is needed:
+    kvrocks    KvrocksDB on fakeredis (requires fakeredis and lupa)
+    quest      QuestDB line protocol sender to a local TCP listener
+    ndjson     BGPWriter, gzip files in a temporary directory
+    parquet    BGPParquet in a temporary directory (requires pyarrow)
+
+Results (elems/s, latency of each stage, peak RSS) are printed and written
+as JSON, to compare them across commits:
+    python3 benchmark.py -id ../datasets/updates.20220425.1215 -if mrt -ir upd \\
+        --geo ../geo-open/latest.mmdb --sinks kvrocks ndjson -o results.json
+    python3 benchmark.py -id ... --baseline results.json
+
+Small fixtures are bundled in fixtures/ (MRT updates, MRT RIB dump, RIS Live):
+    python3 benchmark.py -id fixtures/updates.mrt.gz -if mrt -ir upd
+    python3 benchmark.py -id fixtures/bview.mrt.gz -if mrt -ir rib
+    python3 benchmark.py -id fixtures/ris-live.ndjson -if ris-live -ir upd
+
+Larger synthetic fixtures of each format can be written the same way:
+    python3 benchmark.py --make_fixture ris-live.ndjson --count 100000
+    python3 benchmark.py --make_fixture updates.mrt.gz -if mrt -ir upd --count 100000
+
+Without pybgpstream, --synthetic replays generated elements (parse stage
+only measures the generator):
+    python3 benchmark.py --synthetic 200000 --sinks ndjson parquet
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import types
+import random
+import struct
+import ipaddress
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import datetime
+import subprocess
+from array import array
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from serialize_benchmark import generate  # noqa: E402
+from bgpfilter import BGPFilter  # noqa: E402
+from bgpout import BGPOut  # noqa: E402
+
+STAGES = ["parse", "convert", "enrich", "filter", "serialize"]
+SINKS = ["kvrocks", "quest", "ndjson", "parquet"]
+
+
+def ris_live_message(e):
+    """RIS Live message of a generated element"""
+    path = [int(a) for a in e["as-path"].split()]
+    return {
+        "type": "ris_message",
+        "data": {
+            "timestamp": e["time"],
+            "peer": e["peer_address"],
+            "peer_asn": str(e["peer_asn"]),
+            "id": f"{e['peer_address']}-{e['time']}",
+            "host": e["collector"],
+            "type": "UPDATE",
+            "path": path,
+            "community": [[int(x) for x in c.split(":")] for c in e["communities"]],
+            "origin": "IGP",
+            "announcements": [{"next_hop": e["next-hop"], "prefixes": [e["prefix"]]}],
+            "withdrawals": [],
+        },
+    }
+
+
+def mrt_record(timestamp, kind, subtype, body):
+    """MRT record: common header then body (RFC 6396)"""
+    return struct.pack("!IHHI", int(timestamp), kind, subtype, len(body)) + body
+
+
+def bgp_attribute(flags, kind, value):
+    """BGP path attribute, extended length if needed"""
+    if len(value) > 255:
+        return struct.pack("!BBH", flags | 0x10, kind, len(value)) + value
+    return struct.pack("!BBB", flags, kind, len(value)) + value
+
+
+def bgp_prefix(prefix):
+    """NLRI encoding of a prefix: length then significant bytes"""
+    network = ipaddress.ip_network(prefix)
+    size = (network.prefixlen + 7) // 8
+    return bytes([network.prefixlen]) + network.network_address.packed[:size]
+
+
+def bgp_attributes(e, next_hop=True):
+    """ORIGIN, AS_PATH (4 bytes AS numbers), NEXT_HOP and COMMUNITIES"""
+    path = [int(a) for a in e["as-path"].split()]
+    communities = sorted(tuple(map(int, c.split(":"))) for c in e["communities"])
+    attributes = bgp_attribute(0x40, 1, b"\x00")
+    attributes += bgp_attribute(
+        0x40, 2, struct.pack(f"!BB{len(path)}I", 2, len(path), *path)
+    )
+    if next_hop:
+        attributes += bgp_attribute(0x40, 3, ipaddress.ip_address(e["next-hop"]).packed)
+    if communities:
+        attributes += bgp_attribute(
+            0xC0, 8, b"".join(struct.pack("!HH", *c) for c in communities)
+        )
+    return attributes
+
+
+def mrt_update(e, withdraw=False):
+    """BGP4MP_MESSAGE_AS4 record of an IPv4 announcement or withdrawal"""
+    if withdraw:
+        withdrawn, attributes, nlri = bgp_prefix(e["prefix"]), b"", b""
+    else:
+        withdrawn, attributes, nlri = b"", bgp_attributes(e), bgp_prefix(e["prefix"])
+    update = (
+        struct.pack("!H", len(withdrawn))
+        + withdrawn
+        + struct.pack("!H", len(attributes))
+        + attributes
+        + nlri
+    )
+    message = b"\xff" * 16 + struct.pack("!HB", 19 + len(update), 2) + update
+    body = (
+        struct.pack("!IIHH", e["peer_asn"], 12654, 0, 1)
+        + ipaddress.ip_address(e["peer_address"]).packed
+        + ipaddress.ip_address("193.0.4.28").packed
+        + message
+    )
+    return mrt_record(e["time"], 16, 4, body)
+
+
+def mrt_rib(elements):
+    """TABLE_DUMP_V2 records: peer index table, then one RIB_IPV4_UNICAST record
+    by prefix, with the latest route of each peer"""
+    peers = sorted({(e["peer_address"], e["peer_asn"]) for e in elements})
+    index = {peer: i for i, peer in enumerate(peers)}
+    routes = {}
+    for e in elements:
+        routes.setdefault(e["prefix"], {})[
+            index[(e["peer_address"], e["peer_asn"])]
+        ] = e
+    timestamp = elements[-1]["time"] if elements else 0
+    table = struct.pack("!4sHH", bytes(4), 0, len(peers))
+    for address, asn in peers:
+        table += (
+            struct.pack("!B", 0x02)
+            + ipaddress.ip_address(address).packed
+            + ipaddress.ip_address(address).packed
+            + struct.pack("!I", asn)
+        )
+    records = [mrt_record(timestamp, 13, 1, table)]
+    for sequence, prefix in enumerate(sorted(routes, key=ipaddress.ip_network)):
+        entries = b""
+        for peer, e in sorted(routes[prefix].items()):
+            attributes = bgp_attributes(e)
+            entries += struct.pack("!HIH", peer, int(e["time"]), len(attributes))
+            entries += attributes
+        body = (
+            struct.pack("!I", sequence)
+            + bgp_prefix(prefix)
+            + struct.pack("!H", len(routes[prefix]))
+            + entries
+        )
+        records.append(mrt_record(timestamp, 13, 2, body))
+    return records
+
+
+def make_fixture(path, count, seed=0, file_format="ris-live", record_type="upd"):
+    """Write a fixture of generated elements, gzip compressed if path ends in .gz
+
+    Args:
+        path (str): Fixture file
+        count (int): Number of elements
+        seed (int): Random seed, a seed always gives the same fixture
+        file_format (str): ris-live or mrt
+        record_type (str): upd (announcements and 10% withdrawals) or rib (mrt)
+    """
+    rnd = random.Random(seed)
+    elements = generate(count, seed)
+    opener = gzip.open if path.endswith(".gz") else open
+    if file_format == "mrt":
+        with opener(path, "wb") as f:
+            if record_type == "rib":
+                f.writelines(mrt_rib(elements))
+                return
+            for e in elements:
+                f.write(mrt_update(e, withdraw=rnd.random() < 0.1))
+        return
+    with opener(path, "wt") as f:
+        for e in elements:
+            message = ris_live_message(e)
+            if rnd.random() < 0.1:
+                data = message["data"]
+                data["withdrawals"] = data.pop("announcements")[0]["prefixes"]
+                del data["path"], data["community"], data["origin"]
+            f.write(json.dumps(message) + "\n")
+
+
+def synthetic_stream(count):
+    """Generated elements with the attributes of a pybgpstream BGPElem"""
+    for e in generate(count):
+        yield types.SimpleNamespace(
+            type=e["type"],
+            time=e["time"],
+            peer_address=e["peer_address"],
+            peer_asn=e["peer_asn"],
+            collector=e["collector"],
+            project=e["project"],
+            router=None,
+            router_ip=None,
+            fields={
+                "next-hop": e["next-hop"],
+                "as-path": e["as-path"],
+                "communities": e["communities"],
+                "prefix": e["prefix"],
+            },
+        )
+
+
+class Listener:
+    """Local TCP server standing in for QuestDB, discards received data"""
+
+    def __init__(self):
+        import socket
+        import threading
+
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.received = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            with conn:
+                while True:
+                    chunk = conn.recv(1 << 20)
+                    if not chunk:
+                        break
+                    self.received += len(chunk)
+
+
+def make_sinks(names, directory):
+    """Outputs with a save_many(records) method and a close function"""
+    sinks = {}
+    for name in names:
+        if name == "kvrocks":
+            import fakeredis
+            import redis
+
+            redis.Redis = fakeredis.FakeRedis
+            from Databases.KvrocksDB import KvrocksDB
+
+            db = KvrocksDB({"host": "127.0.0.1", "port": 6666, "db": 0})
+            db.start()
+            sinks[name] = (db.save_many, db.stop)
+        elif name == "quest":
+            from Databases.QuestDB import QuestDB
+
+            listener = Listener()
+            db = QuestDB({"host": "127.0.0.1", "tcp_port": listener.port, "pg_port": 0})
+            db.sender.start()  # no PostgreSQL connection, writes only
+            sinks[name] = (db.save_many, db.sender.close)
+        elif name == "ndjson":
+            from bgpwriter import BGPWriter
+
+            writer = BGPWriter(
+                os.path.join(directory, "ndjson", "updates"), compression="gzip"
+            )
+
+            def save_many(records, writer=writer, encode=json.JSONEncoder().encode):
+                for r in records:
+                    writer.write(encode(r))
+
+            sinks[name] = (save_many, writer.close)
+        elif name == "parquet":
+            from bgpparquet import BGPParquet
+
+            archive = BGPParquet(os.path.join(directory, "parquet"))
+
+            def save_many(records, archive=archive):
+                for r in records:
+                    archive.save(r)
+
+            sinks[name] = (save_many, archive.close)
+    return sinks
+
+
+def summary(samples, count):
+    """Stage statistics from call durations in ns"""
+    if not samples:
+        return {"calls": 0, "total_s": 0, "mean_us": 0, "p50_us": 0, "p99_us": 0}
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "calls": len(ordered),
+        "total_s": round(total / 1e9, 4),
+        "mean_us": round(total / max(count, 1) / 1e3, 3),
+        "p50_us": round(ordered[len(ordered) // 2] / 1e3, 3),
+        "p99_us": round(
+            ordered[min(len(ordered) - 1, len(ordered) * 99 // 100)] / 1e3, 3
+        ),
+    }
+
+
+def run(stream, bgpfilter, out, sinks, batch_size, limit):
+    """Replay the stream through every stage
+
+    Returns:
+        Tuple[int, int, dict]: elements read, elements output,
+            durations of calls by stage
+    """
+    samples = {name: array("q") for name in STAGES + list(sinks)}
+    parse, convert, enrich, check, serialize = (samples[s] for s in STAGES)
+    clock = time.perf_counter_ns
+    iterator = iter(stream)
+    batch = []
+    count = output = 0
+    while count < limit:
+        t0 = clock()
+        e = next(iterator, None)
+        t1 = clock()
+        if e is None:
+            break
+        msg = bgpfilter._make_msg(e)
+        t2 = clock()
+        bgpfilter._enrich(msg)
+        t3 = clock()
+        keep = bgpfilter._check(msg)
+        t4 = clock()
+        parse.append(t1 - t0)
+        convert.append(t2 - t1)
+        enrich.append(t3 - t2)
+        check.append(t4 - t3)
+        count += 1
+        if not keep:
+            continue
+        out.serialize(msg)
+        serialize.append(clock() - t4)
+        output += 1
+        batch.append(msg)
+        if len(batch) >= batch_size:
+            save(batch, sinks, samples)
+            batch = []
+    if batch:
+        save(batch, sinks, samples)
+    return count, output, samples
+
+
+def save(batch, sinks, samples):
+    for name, (save_many, _) in sinks.items():
+        t = time.perf_counter_ns()
+        save_many(batch)
+        samples[name].append(time.perf_counter_ns() - t)
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(result, baseline):
+    """Print relative changes against a previous result"""
+    print(f"\nAgainst {baseline.get('commit')} ({baseline.get('date')}):")
+    old, new = baseline["elems_per_s"], result["elems_per_s"]
+    print(f"  {'elems/s':<10} {old:>12.0f} -> {new:>12.0f} ({(new / old - 1):+.1%})")
+    for name, stats in result["stages"].items():
+        if name in baseline["stages"] and baseline["stages"][name]["mean_us"]:
+            old, new = baseline["stages"][name]["mean_us"], stats["mean_us"]
+            print(
+                f"  {name:<10} {old:>10.3f}us -> {new:>10.3f}us"
+                f" ({(new / old - 1):+.1%})"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark")
+    parser.add_argument("-id", "--input_data", help="Fixture file")
+    parser.add_argument(
+        "-if", "--input_file_format", choices=["mrt", "bmp", "ris-live"]
+    )
+    parser.add_argument("-ir", "--input_record_type", choices=["upd", "rib"])
+    parser.add_argument("--synthetic", type=int, help="Replay generated elements")
+    parser.add_argument(
+        "--make_fixture", help="Write a fixture of -if/-ir format and exit"
+    )
+    parser.add_argument("--count", type=int, default=100000, help="Fixture size")
+    parser.add_argument("--limit", type=int, default=None, help="Max elements read")
+    parser.add_argument("--geo", help="Geo Open MaxMind database for enrichment")
+    parser.add_argument("-cf", "--country_filter", nargs="+")
+    parser.add_argument("-pf", "--prefix_filter", nargs="+")
+    parser.add_argument("--match", default="more")
+    parser.add_argument("--sinks", nargs="*", choices=SINKS, default=[])
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--json_backend", choices=["json", "orjson"], default="json")
+    parser.add_argument("-o", "--output", help="Write results as JSON")
+    parser.add_argument("--baseline", help="Previous results to compare with")
+    args = parser.parse_args()
+
+    if args.make_fixture:
+        file_format = args.input_file_format or "ris-live"
+        if file_format not in ["ris-live", "mrt"]:
+            parser.error("--make_fixture writes ris-live or mrt fixtures")
+        if file_format == "ris-live" and args.input_record_type == "rib":
+            parser.error("RIS Live fixtures contain updates only")
+        make_fixture(
+            args.make_fixture,
+            args.count,
+            file_format=file_format,
+            record_type=args.input_record_type or "upd",
+        )
+        print(f"{args.count} {file_format} elements written to {args.make_fixture}")
+        sys.exit(0)
+    if (args.input_data is None) == (args.synthetic is None):
+        parser.error("one of --input_data or --synthetic is required")
+
+    bgpfilter = BGPFilter()
+    bgpfilter.record_mode(False, None, None)
+    if args.geo:
+        bgpfilter.country_file = args.geo
+    bgpfilter.countries_filter = args.country_filter
+    bgpfilter.prefix_filter = (args.prefix_filter, args.match)
+    if args.synthetic:
+        fixture = {"synthetic": args.synthetic}
+        stream = synthetic_stream(args.synthetic)
+    else:
+        bgpfilter.data_source(
+            args.input_record_type, args.input_file_format, args.input_data
+        )
+        fixture = {
+            "path": os.path.basename(args.input_data),
+            "size": os.path.getsize(args.input_data),
+            "format": args.input_file_format,
+            "record_type": args.input_record_type,
+        }
+        stream = bgpfilter._build_stream()
+
+    out = BGPOut()
+    out.json_format = "compact"
+    out.json_backend = args.json_backend
+    out.json_out = sys.stderr  # only checked, never written
+    directory = tempfile.mkdtemp(prefix="bgp-benchmark-")
+    sinks = make_sinks(args.sinks, directory)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.perf_counter()
+    count, output, samples = run(
+        stream, bgpfilter, out, sinks, args.batch_size, args.limit or float("inf")
+    )
+    for _, close in sinks.values():
+        close()
+    elapsed = time.perf_counter() - t
+    shutil.rmtree(directory)
+
+    result = {
+        "commit": commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "fixture": fixture,
+        "geo": args.geo is not None,
+        "json_backend": args.json_backend,
+        "batch_size": args.batch_size,
+        "elements": count,
+        "output_elements": output,
+        "elapsed_s": round(elapsed, 3),
+        "elems_per_s": round(count / elapsed, 1),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "start_rss_mb": round(rss / 1024, 1),
+        "stages": {name: summary(samples[name], count) for name in samples},
+    }
+
+    print(
+        f"{count} elements ({output} output) in {elapsed:.2f}s"
+        f" - {result['elems_per_s']:.0f} elems/s - peak RSS {result['peak_rss_mb']} MB"
+    )
+    print(f"  {'stage':<10} {'mean':>10} {'p50':>10} {'p99':>10}  (us, per element)")
+    for name, stats in result["stages"].items():
+        print(
+            f"  {name:<10} {stats['mean_us']:>10.3f} {stats['p50_us']:>10.3f}"
+            f" {stats['p99_us']:>10.3f}"
+            + ("  p50/p99 per batch" if name in sinks else "")
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
@@ -0,0 +1,123 @@
+"""
+Check the Geo Open refresher and reloads against a local HTTP server.
+
+The server stands in for the Geo Open download URL, serves a copy of a MaxMind
+database and answers conditional requests (ETag, If-Modified-Since).
+    python3 geoopen_check.py --mmdb ../geo-open/latest.mmdb
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import http.server
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+import maxminddb  # noqa: E402
+from bgpgeo import BGPGeo, GeoRefresher  # noqa: E402
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """Static files with an ETag made of mtime and size"""
+
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        Handler.requests += 1
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return None
+            self.etag = etag
+        return super().send_head()
+
+    def end_headers(self):
+        if getattr(self, "etag", None):
+            self.send_header("ETag", self.etag)
+            self.etag = None
+        super().end_headers()
+
+
+def check(name, condition):
+    print(f"{'OK  ' if condition else 'FAIL'} {name}")
+    return condition
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Geo Open refresh check")
+    parser.add_argument("--mmdb", default="../geo-open/latest.mmdb")
+    args = parser.parse_args()
+
+    served = tempfile.mkdtemp()
+    local = tempfile.mkdtemp()
+    shutil.copy(args.mmdb, os.path.join(served, "latest.mmdb"))
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        lambda *a: Handler(*a, directory=served),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/latest.mmdb"
+    path = os.path.join(local, "latest.mmdb")
+
+    refresher = GeoRefresher(url, path, max_age=3600)
+    ok = check("first download", refresher.refresh())
+    ok &= check("recent copy not checked", not refresher.refresh())
+    requests = Handler.requests
+    ok &= check(
+        "conditional request, not modified",
+        not refresher.refresh(force=True)
+        and refresher.not_modified == 1
+        and Handler.requests == requests + 1,
+    )
+
+    geo = BGPGeo(watch_interval=0)
+    geo.open(path)
+    geo.country("1.1.1.0/24")
+
+    # new version on server
+    future = time.time() + 10
+    os.utime(os.path.join(served, "latest.mmdb"), (future, future))
+    ok &= check("changed file downloaded", refresher.refresh(force=True))
+    geo.country("1.1.1.0/24")
+    ok &= check("lookups reload the new file", geo.reloads == 1)
+
+    # broken file on server, local copy must be kept
+    with open(os.path.join(served, "latest.mmdb"), "wb") as f:
+        f.write(b"not a database")
+    try:
+        refresher.refresh(force=True)
+        ok &= check("invalid download rejected", False)
+    except maxminddb.InvalidDatabaseError:
+        ok &= check("invalid download rejected", True)
+    maxminddb.open_database(path).close()
+    ok &= check(
+        "local copy kept, no temporary file left",
+        sorted(os.listdir(local)) == ["latest.mmdb", "latest.mmdb.etag"],
+    )
+
+    # local file as source
+    shutil.copy(args.mmdb, os.path.join(served, "latest.mmdb"))
+    file_refresher = GeoRefresher(
+        "file://" + os.path.join(served, "latest.mmdb"),
+        os.path.join(local, "file.mmdb"),
+    )
+    ok &= check("file:// download", file_refresher.refresh())
+    ok &= check("file:// not modified", not file_refresher.refresh(force=True))
+
+    server.shutdown()
+    shutil.rmtree(served)
+    shutil.rmtree(local)
+    print(refresher.stats(), geo.stats())
+    print("All checks passed" if ok else "Some checks failed")
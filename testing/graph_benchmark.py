@@ -0,0 +1,129 @@
+"""
+Measure BGPGraph memory and speed with a synthetic Internet sized topology.
+
+A preferential attachment topology is generated, AS paths of routes follow
+its edges, so the graph ends with about --edges edges:
+    python3 graph_benchmark.py --nodes 80000 --edges 500000 --peers 10
+
+With --history, changes are logged with one hour snapshots, --queries updates
+are spread over the hours, then the graph and neighbors are queried in the past:
+    python3 graph_benchmark.py --history 24
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from bgprib import BGPRib  # noqa: E402
+from bgpgraph import BGPGraph  # noqa: E402
+from rib_benchmark import prefix, rss_mb  # noqa: E402
+
+
+def topology(rnd, nodes, edges):
+    """Preferential attachment: each new AS links to ASes of high degree"""
+    per_node = max(1, edges // nodes)
+    ends = [1, 2]
+    links = [(1, 2)]
+    for asn in range(3, nodes + 1):
+        for peer in {rnd.choice(ends) for _ in range(per_node)}:
+            links.append((peer, asn))
+            ends += [peer, asn]
+    return links
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BGPGraph benchmark")
+    parser.add_argument("--nodes", type=int, default=80000)
+    parser.add_argument("--edges", type=int, default=500000)
+    parser.add_argument("--peers", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100000)
+    parser.add_argument("--history", type=int, default=0, metavar="<hours>")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    links = topology(rnd, args.nodes, args.edges)
+    upstreams = {}
+    for a, b in links:
+        upstreams.setdefault(b, []).append(a)
+
+    def path_to(link):
+        """Path ending with a link, with a few upstream hops before it"""
+        a, b = link
+        path = [b, a]
+        while len(path) < 5 and path[-1] in upstreams:
+            path.append(rnd.choice(upstreams[path[-1]]))
+        return " ".join(map(str, reversed(path)))
+
+    rib = BGPRib()
+    routes = len(links) // args.peers + 1
+    t = time.perf_counter()
+    for j in range(args.peers):
+        peer = (f"rrc{j:02}", 1000000 + j, f"192.0.2.{j}")
+        for i in range(routes):
+            path = f"{peer[1]} {path_to(links[(j * routes + i) % len(links)])}"
+            rib.announce(*peer, prefix(i), path)
+    elapsed = time.perf_counter() - t
+    print(f"RIB: {rib.routes} routes in {elapsed:.1f}s - {rib.stats()}")
+
+    before = rss_mb()
+    t = time.perf_counter()
+    graph = BGPGraph(rib)
+    elapsed = time.perf_counter() - t
+    print(
+        f"Graph built from RIB in {elapsed:.1f}s - {graph.stats()}"
+        f" - {rss_mb() - before:.0f} MB"
+    )
+
+    if args.history:
+        graph.keep_history(3600, args.history * 3600)
+    changes, snapshots, snapshot_time = args.queries, 0, 0
+    t = time.perf_counter()
+    for n in range(changes):
+        rib.time = n * args.history * 3600 / changes
+        if args.history and rib.time // 3600 > snapshots:
+            snapshots += 1
+            snapshot_time -= time.perf_counter()
+            graph.history.snapshot(rib.time)
+            snapshot_time += time.perf_counter()
+        j = rnd.randrange(args.peers)
+        peer = (f"rrc{j:02}", 1000000 + j, f"192.0.2.{j}")
+        i = rnd.randrange(routes)
+        if rnd.random() < 0.5:
+            rib.withdraw(*peer, prefix(i))
+        else:
+            path = f"{peer[1]} {path_to(rnd.choice(links))}"
+            rib.announce(*peer, prefix(i), path)
+    elapsed = time.perf_counter() - t - snapshot_time
+    print(
+        f"{changes} updates with graph: {elapsed / changes * 1e6:.2f} us/update"
+        f" - {graph.stats()}"
+    )
+    if snapshots:
+        print(f"{snapshots} snapshots: {snapshot_time / snapshots:.2f}s/snapshot")
+
+    asns = [rnd.randrange(1, args.nodes + 1) for _ in range(args.queries)]
+    t = time.perf_counter()
+    for a in asns:
+        graph.neighbors(a)
+    elapsed = time.perf_counter() - t
+    print(f"neighbors(asn): {elapsed / len(asns) * 1e6:.2f} us/query")
+
+    if args.history:
+        print(f"History: {graph.history.stats()}")
+        for hours in (1.5, args.history / 2, args.history - 0.5):
+            at = hours * 3600
+            t = time.perf_counter()
+            edges = graph.get(at=at)
+            elapsed = time.perf_counter() - t
+            t = time.perf_counter()
+            for a in asns[:10]:
+                graph.neighbors(a, at=at)
+            per_query = (time.perf_counter() - t) / 10
+            print(
+                f"at {hours}h: get() {len(edges)} edges in {elapsed:.2f}s,"
+                f" neighbors(asn) in {per_query:.2f}s"
+            )
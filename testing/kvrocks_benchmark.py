@@ -0,0 +1,92 @@
+"""
+Measure KvrocksDB write throughput with synthetic announcements and withdrawals.
+
+Run against a local kvrocks/redis server:
+    python3 kvrocks_benchmark.py --host 127.0.0.1 --port 6666
+
+Or without server, using fakeredis (requires fakeredis and lupa for Lua scripts):
+    python3 kvrocks_benchmark.py --fake
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from Databases.KvrocksDB import KvrocksDB  # noqa: E402
+
+
+def generate_records(count, prefixes=10000, withdrawals=0.2, seed=0):
+    """Generate bgp records similar to `BGPFilter` output"""
+    rnd = random.Random(seed)
+    now = time.time()
+    records = []
+    for i in range(count):
+        p = rnd.randrange(prefixes)
+        prefix = f"{10 + p // 65536}.{p // 256 % 256}.{p % 256}.0/24"
+        if rnd.random() < withdrawals:
+            records.append(
+                {
+                    "type": "W",
+                    "time": now + i / 1000,
+                    "peer_asn": 64500 + p % 20,
+                    "peer_address": "192.0.2.1",
+                    "collector": "rrc00",
+                    "country_code": None,
+                    "source": None,
+                    "prefix": prefix,
+                }
+            )
+        else:
+            path = [64500 + p % 20] + [rnd.randrange(1, 65000) for _ in range(3)]
+            records.append(
+                {
+                    "type": "A",
+                    "time": now + i / 1000,
+                    "peer_asn": path[0],
+                    "peer_address": "192.0.2.1",
+                    "collector": "rrc00",
+                    "country_code": rnd.choice(["LU", "FR", "DE", None]),
+                    "source": str(path[-1]),
+                    "prefix": prefix,
+                    "as-path": " ".join(map(str, path)),
+                }
+            )
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KvrocksDB write benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6666)
+    parser.add_argument("--db", type=int, default=0)
+    parser.add_argument("--fake", action="store_true", help="Use fakeredis")
+    parser.add_argument("--count", type=int, default=500000)
+    parser.add_argument("--batch_size", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.fake:
+        import fakeredis
+        import redis
+
+        redis.Redis = fakeredis.FakeRedis
+
+    db = KvrocksDB({"host": args.host, "port": args.port, "db": args.db})
+    db.client.flushdb()
+    db.start()
+
+    records = generate_records(args.count)
+    t = time.perf_counter()
+    for i in range(0, len(records), args.batch_size):
+        db.save_many(records[i : i + args.batch_size])  # noqa: E203
+    elapsed = time.perf_counter() - t
+    db.stop()
+
+    print(
+        f"{len(records)} elems in {elapsed:.2f}s"
+        f" - {len(records) / elapsed:.0f} elems/s"
+        f" - batch size {args.batch_size}"
+    )
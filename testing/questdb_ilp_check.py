@@ -0,0 +1,101 @@
+"""
+Check the QuestDB InfluxDB Line protocol sender against a local TCP listener.
+
+The listener stands in for QuestDB, drops the first connection after a few bytes
+and then accepts a new one. Every line must be received at least once.
+Lines are sent in small writes so most of them go through the buffer.
+Then the listener stops: writes must not wait for it, full buffers are dropped.
+    python3 questdb_ilp_check.py
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from Databases.QuestDB import QuestDB, ILPSender  # noqa: E402
+
+
+class Listener(threading.Thread):
+    """Local ILP server, closes the first connection after drop_after bytes"""
+
+    def __init__(self, drop_after=4096):
+        super().__init__(daemon=True)
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.drop_after = drop_after
+        self.data = bytearray()
+
+    def run(self):
+        first = True
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return  # stopped
+            received = 0
+            with conn:
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    self.data += chunk
+                    received += len(chunk)
+                    if first and received >= self.drop_after:
+                        break
+            first = False
+
+
+if __name__ == "__main__":
+    listener = Listener()
+    listener.start()
+
+    sender = ILPSender(
+        "127.0.0.1", listener.port, buffer_size=1 << 16, flush_interval=0.1
+    )
+    sender.start()
+    records = [
+        {
+            "type": "A",
+            "project": "ris",
+            "collector": "rrc00",
+            "country_code": "LU" if i % 2 else None,
+            "peer_asn": 64500,
+            "prefix": f"10.{i // 256 % 256}.{i % 256}.0/24",
+            "as-path": '64500 {1,2} "3',
+            "source": "3",
+            "time": 1663080130.13 + i,
+        }
+        for i in range(20000)
+    ]
+    for i in range(0, len(records), 50):
+        lines = "".join(map(QuestDB._line, records[i : i + 50]))  # noqa: E203
+        sender.write(lines.encode())
+        time.sleep(0.001)
+    sender.close()
+    time.sleep(0.5)
+
+    expected = set("".join(map(QuestDB._line, records)).encode().splitlines())
+    received = set(bytes(listener.data).splitlines())
+    print(sender.stats())
+    print(
+        "All lines received" if expected <= received else "Missing lines",
+        f"({len(expected - received)} missing)",
+    )
+
+    listener.server.shutdown(socket.SHUT_RDWR)
+    listener.server.close()
+    t = time.perf_counter()
+    for i in range(0, len(records), 50):
+        lines = "".join(map(QuestDB._line, records[i : i + 50]))  # noqa: E203
+        sender.write(lines.encode())
+    sender.close()
+    elapsed = time.perf_counter() - t
+    print(sender.stats())
+    print(
+        f"Server down: {len(records)} lines written in {elapsed:.2f}s,"
+        f" {sender.dropped_bytes} bytes dropped"
+    )
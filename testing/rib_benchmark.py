@@ -0,0 +1,105 @@
+"""
+Measure BGPRib memory and speed with synthetic full tables.
+
+Each peer announces every prefix, with AS paths drawn from a pool so paths
+are shared like in real tables, then some prefixes are withdrawn or moved:
+    python3 rib_benchmark.py --prefixes 1000000 --peers 30
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from bgprib import BGPRib  # noqa: E402
+
+
+def rss_mb():
+    """Resident memory of the process"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+def prefix(i):
+    if i % 10 == 9:
+        return f"2001:{i >> 16 & 0xFFFF:x}:{i & 0xFFFF:x}::/48"
+    return f"{1 + i // 65536 % 223}.{i // 256 % 256}.{i % 256}.0/24"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BGPRib benchmark")
+    parser.add_argument("--prefixes", type=int, default=200000)
+    parser.add_argument("--peers", type=int, default=20)
+    parser.add_argument("--collectors", type=int, default=5)
+    parser.add_argument(
+        "--origins", type=int, help="Origin AS numbers. Default: 1 per 14 prefixes"
+    )
+    parser.add_argument("--transits", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=100000)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    pool = [
+        rnd.randrange(1, 400000) for _ in range(args.origins or args.prefixes // 14)
+    ]
+    origins = [rnd.choice(pool) for _ in range(args.prefixes)]
+    peers = [
+        (f"rrc{i % args.collectors:02}", 64500 + i, f"192.0.2.{i}")
+        for i in range(args.peers)
+    ]
+    # each peer reaches an origin through a few transit paths
+    transits = [
+        " ".join(str(rnd.randrange(1, 60000)) for _ in range(rnd.randint(1, 3)))
+        for _ in range(args.transits)
+    ]
+
+    rib = BGPRib()
+    before = rss_mb()
+    t = time.perf_counter()
+    for collector, peer_asn, peer_address in peers:
+        for i in range(args.prefixes):
+            origin = origins[i]
+            path = (
+                f"{peer_asn} {transits[(origin + peer_asn) % args.transits]} {origin}"
+            )
+            rib.announce(collector, peer_asn, peer_address, prefix(i), path)
+    elapsed = time.perf_counter() - t
+    print(
+        f"Loaded {rib.routes} routes in {elapsed:.1f}s"
+        f" ({rib.routes / elapsed:.0f} routes/s) - {rib.stats()}"
+    )
+    print(
+        f"Memory: {rss_mb() - before:.0f} MB"
+        f" ({(rss_mb() - before) * 1e6 / rib.routes:.1f} bytes/route)"
+    )
+
+    t = time.perf_counter()
+    changes = args.prefixes // 10
+    for _ in range(changes):
+        collector, peer_asn, peer_address = rnd.choice(peers)
+        i = rnd.randrange(args.prefixes)
+        if rnd.random() < 0.5:
+            rib.withdraw(collector, peer_asn, peer_address, prefix(i))
+        else:
+            rib.announce(collector, peer_asn, peer_address, prefix(i), f"{peer_asn} 1")
+    elapsed = time.perf_counter() - t
+    print(f"{changes} updates: {elapsed / changes * 1e6:.2f} us/update")
+
+    samples = [prefix(rnd.randrange(args.prefixes)) for _ in range(args.queries)]
+    t = time.perf_counter()
+    for p in samples:
+        rib.origins(p)
+    elapsed = time.perf_counter() - t
+    print(f"origins(prefix): {elapsed / args.queries * 1e6:.2f} us/query")
+
+    asns = [rnd.choice(origins) for _ in range(args.queries // 10)]
+    t = time.perf_counter()
+    found = sum(len(rib.prefixes(a)) for a in asns)
+    elapsed = time.perf_counter() - t
+    print(
+        f"prefixes(asn): {elapsed / len(asns) * 1e6:.2f} us/query"
+        f" ({found / len(asns):.1f} prefixes/AS)"
+    )
@@ -0,0 +1,133 @@
+"""
+Measure BGPOut JSON serialization, console and file outputs enabled.
+
+Elements are read from an MRT file (requires pybgpstream) or generated,
+then encoded --count times (the pool of elements is reused):
+    python3 serialize_benchmark.py --input_data ../datasets/updates.20220425.1215
+    python3 serialize_benchmark.py --count 1000000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from bgpout import BGPOut, orjson  # noqa: E402
+
+
+class SetEncoder(json.JSONEncoder):
+    """Encoder used before `bgpout.BGPEncoder`"""
+
+    def default(self, obj):
+        if isinstance(obj, set):
+            return list(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def legacy_serialize(e):
+    """Serialization used before `bgpout.BGPEncoder`, communities are a set"""
+    return (
+        json.dumps(e, sort_keys=True, cls=SetEncoder),
+        json.dumps(e, sort_keys=True, indent=4, cls=SetEncoder),
+    )
+
+
+def read_mrt(path, count):
+    """Elements of an MRT updates file, as `BGPFilter._make_msg()` builds them"""
+    import pybgpstream
+
+    stream = pybgpstream.BGPStream(data_interface="singlefile")
+    stream.set_data_interface_option("singlefile", "upd-file", path)
+    elements = []
+    for e in stream:
+        msg = {
+            "type": e.type,
+            "time": e.time,
+            "peer_address": e.peer_address,
+            "peer_asn": e.peer_asn,
+            "collector": e.collector,
+            "project": e.project,
+            "router": e.router,
+            "router_ip": e.router_ip,
+        }
+        msg |= e.fields
+        msg["country_code"] = "LU"
+        msg["source"] = msg["as-path"].split()[-1] if "as-path" in msg else None
+        elements.append(msg)
+        if len(elements) >= count:
+            break
+    return elements
+
+
+def generate(count, seed=0):
+    """Announcements similar to RIS live elements"""
+    rnd = random.Random(seed)
+    elements = []
+    for i in range(count):
+        path = [rnd.randrange(1, 65000) for _ in range(rnd.randint(2, 7))]
+        elements.append(
+            {
+                "type": "A",
+                "time": 1663080130.13 + i / 100,
+                "peer_address": f"80.249.{rnd.randrange(256)}.{rnd.randrange(256)}",
+                "peer_asn": path[0],
+                "collector": f"rrc{rnd.randrange(26):02}",
+                "project": "ris-live",
+                "router": None,
+                "router_ip": None,
+                "next-hop": "80.249.210.85",
+                "as-path": " ".join(map(str, path)),
+                "communities": {
+                    f"{path[0]}:{rnd.randrange(5000)}" for _ in range(rnd.randint(0, 6))
+                },
+                "prefix": f"{rnd.randrange(1, 224)}.{rnd.randrange(256)}.0.0/16",
+                "country_code": rnd.choice(["LU", "FR", "DE", None]),
+                "source": str(path[-1]),
+            }
+        )
+    return elements
+
+
+def run(name, serialize, elements, count):
+    t = time.perf_counter()
+    size = 0
+    for i in range(count):
+        size += len(serialize(elements[i % len(elements)])[1])
+    elapsed = time.perf_counter() - t
+    print(
+        f"{name:<16} {elapsed:6.2f}s - {count / elapsed:8.0f} elems/s"
+        f" - {size / count:5.0f} bytes/elem in file"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON serialization benchmark")
+    parser.add_argument("--input_data", help="MRT updates file")
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--pool", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.input_data:
+        elements = read_mrt(args.input_data, args.pool)
+    else:
+        elements = generate(args.pool)
+    print(f"{args.count} elements, {len(elements)} distinct")
+
+    run("legacy", legacy_serialize, elements, args.count)
+    for e in elements:
+        if "communities" in e:
+            e["communities"] = sorted(e["communities"], key=str)
+
+    backends = ["json"] + (["orjson"] if orjson is not None else [])
+    for backend in backends:
+        for json_format in ["pretty", "compact"]:
+            out = BGPOut()
+            out.verbose = True
+            out.json_out = sys.stderr  # only checked, never written
+            out.json_format = json_format
+            out.json_backend = backend
+            run(f"{backend} {json_format}", out.serialize, elements, args.count)
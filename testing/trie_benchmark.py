@@ -0,0 +1,94 @@
+"""
+Compare prefix filtering with `BGPTrie` and with `ipaddress` on a large prefix list.
+
+The ipaddress path is the validation done by `BGPFilter.prefix_filter`,
+plus a linear scan over the prefixes to match a record,
+as a Python subsystem without BGPStream filters would do.
+    python3 trie_benchmark.py --prefixes 100000 --lookups 100000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import ipaddress
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin"))
+
+from bgptrie import BGPTrie  # noqa: E402
+
+
+def generate_prefixes(count, seed=0):
+    """Random IPv4 /16 to /24 and IPv6 /32 to /48 prefixes, 10% IPv6"""
+    rnd = random.Random(seed)
+    prefixes = set()
+    while len(prefixes) < count:
+        if rnd.random() < 0.9:
+            length = rnd.randint(16, 24)
+            key = rnd.getrandbits(32) >> (32 - length) << (32 - length)
+            prefixes.add(str(ipaddress.IPv4Network((key, length))))
+        else:
+            length = rnd.randint(32, 48)
+            key = (0x2000 << 112 | rnd.getrandbits(112)) >> (128 - length)
+            prefixes.add(str(ipaddress.IPv6Network((key << (128 - length), length))))
+    return list(prefixes)
+
+
+def generate_lookups(prefixes, count, seed=1):
+    """Half more specific prefixes of the list, half random /24"""
+    rnd = random.Random(seed)
+    lookups = []
+    for _ in range(count):
+        if rnd.random() < 0.5:
+            n = ipaddress.ip_network(rnd.choice(prefixes))
+            lookups.append(str(next(n.subnets(new_prefix=n.max_prefixlen - 8))))
+        else:
+            key = rnd.getrandbits(24) << 8
+            lookups.append(str(ipaddress.IPv4Network((key, 24))))
+    return lookups
+
+
+def linear_match(networks, prefix):
+    p = ipaddress.ip_network(prefix)
+    return any(p.version == n.version and p.subnet_of(n) for n in networks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prefix trie benchmark")
+    parser.add_argument("--prefixes", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument(
+        "--linear_lookups",
+        type=int,
+        default=20,
+        help="Lookups done with the linear scan, which is very slow",
+    )
+    args = parser.parse_args()
+
+    prefixes = generate_prefixes(args.prefixes)
+    lookups = generate_lookups(prefixes, args.lookups)
+
+    t = time.perf_counter()
+    networks = [ipaddress.ip_network(p) for p in prefixes]
+    ip_build = time.perf_counter() - t
+
+    t = time.perf_counter()
+    trie = BGPTrie(prefixes)
+    trie_build = time.perf_counter() - t
+
+    t = time.perf_counter()
+    linear = [linear_match(networks, p) for p in lookups[: args.linear_lookups]]
+    ip_lookup = (time.perf_counter() - t) / len(linear)
+
+    t = time.perf_counter()
+    matched = sum(trie.match(p, "more") for p in lookups)
+    trie_lookup = (time.perf_counter() - t) / len(lookups)
+
+    assert linear == [trie.match(p, "more") for p in lookups[: len(linear)]]
+    print(f"{len(prefixes)} prefixes, {len(lookups)} lookups, {matched} matched")
+    print(f"build  - ipaddress {ip_build:.2f}s - trie {trie_build:.2f}s")
+    print(
+        f"lookup - ipaddress {ip_lookup * 1e6:.0f}us"
+        f" - trie {trie_lookup * 1e6:.2f}us ({1 / trie_lookup:.0f} lookups/s)"
+    )